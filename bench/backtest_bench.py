@@ -0,0 +1,153 @@
+from setup import run
+
+from datetime import datetime, timedelta
+
+import argparse
+import asyncio
+import copy
+import os
+import numpy as np
+
+from analysis.backtest import Backtest, BacktestRunner, ParamOptimizer
+from analysis.strategy import PatternStrategy
+from benchmark import \
+    gen_ohlcvs, \
+    run_isolated, \
+    timed, \
+    report_results
+from utils import config
+
+EX = 'bitfinex'
+MARKETS = ['BTC/USD', 'ETH/USD', 'XRP/USD']
+TIMEFRAMES = ['1m', '1h', '8h']
+START = datetime(2018, 1, 1)
+
+
+def bench_config(markets=MARKETS, fast_mode=True):
+    _config = copy.deepcopy(config)
+    _config['analysis']['exchanges'] = {EX: _config['analysis']['exchanges'][EX]}
+    _config['analysis']['exchanges'][EX]['markets'] = markets
+    _config['analysis']['exchanges'][EX]['timeframes'] = TIMEFRAMES
+    _config['analysis']['indicator_tf'] = '8h'
+    _config['analysis']['log_signal'] = False
+    _config['backtest']['fast_mode'] = fast_mode
+    _config['backtest']['skip_idle_ticks'] = False
+    _config['backtest']['pruning']['enable'] = False
+    return _config
+
+
+def create_strategy(_config):
+    strategy = PatternStrategy(EX, custom_config=_config)
+    strategy.set_params({'common': _config['analysis']['params']['common']})
+    return strategy
+
+
+def n_bars(days, markets=MARKETS):
+    """ Number of 1m bars a backtest steps through. """
+    return days * 24 * 60 * len(markets)
+
+
+def bench_fast_run(data_feed, days):
+    _config = bench_config(fast_mode=True)
+    backtest = Backtest(create_strategy(_config), data_feed, START, START + timedelta(days=days),
+                        custom_config=_config)
+    report, secs = timed(backtest.run)
+
+    return {
+        'seconds': round(secs, 3),
+        'bars/s': round(n_bars(days) / secs, 1),
+        'PL(%)': round(report['PL(%)'], 4), # same fixtures should give the same result
+    }
+
+
+def bench_slow_run(data_feed, days):
+    _config = bench_config(fast_mode=False)
+    backtest = Backtest(create_strategy(_config), data_feed, START, START + timedelta(days=days),
+                        custom_config=_config)
+    _, secs = timed(backtest.run)
+
+    return {
+        'seconds': round(secs, 3),
+        'bars/s': round(n_bars(days) / secs, 1),
+    }
+
+
+def bench_run_periods(data_feed, days, period_days, shift_days):
+    """ Run the same periods on one core and with worker processes,
+        fan-out overhead is how much slower the parallel run is than a perfect split.
+    """
+    periods = BacktestRunner.generate_periods_with_shift_step(
+        START, START + timedelta(days=days), period_days, shift_days)
+    loop = asyncio.get_event_loop()
+    secs = {}
+
+    for multicore in [False, True]:
+        _config = bench_config(fast_mode=True)
+        _config['use_multicore'] = multicore
+        runner = BacktestRunner(create_strategy(_config), data_feed, custom_config=_config)
+        _, secs[multicore] = timed(loop.run_until_complete, runner.run_periods(periods))
+
+    workers = min(config['max_processes'], len(periods), os.cpu_count())
+
+    return {
+        '#_periods': len(periods),
+        'workers': workers,
+        'seconds': round(secs[True], 3),
+        'periods/s': round(len(periods) / secs[True], 2),
+        'bars/s': round(n_bars(period_days) * len(periods) / secs[True], 1),
+        'fanout_overhead(s)': round(secs[True] - secs[False] / workers, 3),
+    }
+
+
+def bench_param_grid(data_feed, days):
+    _config = bench_config(markets=MARKETS[:1], fast_mode=True)
+    _config['analysis']['param_chunk_size'] = 3
+    optimizer = ParamOptimizer(None, create_strategy(_config), custom_config=_config)
+    optimizer.optimize_range('stochrsi_upper', 60, 80, 10)
+    optimizer.optimize_range('stochrsi_lower', 20, 40, 10)
+    grid = optimizer.get_grid()
+
+    _, secs = timed(optimizer._backtest_params, grid, np.arange(1, len(grid) + 1), data_feed,
+                    START, START + timedelta(days=days), _config, MARKETS[0])
+
+    return {
+        '#_combos': len(grid),
+        'seconds': round(secs, 3),
+        'combos/s': round(len(grid) / secs, 2),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--days', type=int, default=60,
+        help="Days of synthetic ohlcv, fast mode runs over all of them")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+        help="Fraction of throughput a benchmark may drop from the baseline")
+    parser.add_argument('--update-baseline', action='store_true',
+        help="Save results as the new baseline instead of comparing with it")
+
+    argv = parser.parse_args()
+
+    return argv
+
+
+def main():
+    argv = parse_args()
+
+    ohlcvs = gen_ohlcvs(MARKETS, TIMEFRAMES, START, argv.days)
+    data_feed = {'ohlcvs': {EX: ohlcvs}, 'trades': {EX: {}}}
+
+    # Every benchmark runs in its own process to measure its peak memory
+    results = {
+        'fast_run': run_isolated(bench_fast_run, data_feed, argv.days),
+        'slow_run': run_isolated(bench_slow_run, data_feed, 20),
+        'run_periods': run_isolated(bench_run_periods, data_feed, argv.days, 20, 5),
+        'param_grid': run_isolated(bench_param_grid, data_feed, 30),
+    }
+
+    report_results('backtest', results, argv.update_baseline, argv.tolerance)
+
+
+if __name__ == '__main__':
+    run(main)
@@ -0,0 +1,163 @@
+from multiprocess import Process, Queue
+
+import json
+import os
+import resource
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+from utils import tf_td
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Metrics compared with the baseline, larger is better
+THROUGHPUT_METRICS = ['bars/s', 'combos/s', 'periods/s', 'docs/s']
+
+
+def gen_ohlcvs(markets, timeframes, start, days, seed=0):
+    """ Deterministic random walk ohlcvs of every market,
+        in the format of `ohlcvs[market][tf]`, higher timeframes are resampled from 1m.
+    """
+    rng = np.random.RandomState(seed)
+    minutes = days * 24 * 60
+    index = pd.date_range(start, periods=minutes, freq='1min', name='timestamp')
+    ohlcvs = {}
+
+    for i, market in enumerate(markets):
+        price = 100 * (i + 1)
+        close = price * np.exp(np.cumsum(rng.normal(0, 0.001, minutes)))
+        opens = np.concatenate([[price], close[:-1]])
+        spread = np.abs(rng.normal(0, 0.0005, minutes)) * close
+
+        ohlcv = pd.DataFrame({
+            'open': opens,
+            'high': np.maximum(opens, close) + spread,
+            'low': np.minimum(opens, close) - spread,
+            'close': close,
+            'volume': rng.lognormal(0, 1, minutes),
+        }, index=index)
+
+        ohlcvs[market] = {}
+        for tf in timeframes:
+            if tf == '1m':
+                ohlcvs[market][tf] = ohlcv
+            else:
+                ohlcvs[market][tf] = ohlcv.resample(tf_td(tf)).agg({
+                    'open': 'first',
+                    'high': 'max',
+                    'low': 'min',
+                    'close': 'last',
+                    'volume': 'sum',
+                })
+
+    return ohlcvs
+
+
+def peak_rss_mb():
+    """ Peak resident memory of this process and its finished children in MB. """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss \
+        + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return rss / 1024 # ru_maxrss is in KB on linux
+
+
+def timed(func, *args, **kwargs):
+    """ Returns (result, seconds) of calling `func`. """
+    s = time.perf_counter()
+    res = func(*args, **kwargs)
+    return res, time.perf_counter() - s
+
+
+def run_isolated(func, *args):
+    """ Run a benchmark in a new process so peak memory of every benchmark is measured
+        separately. `func` returns a dict of metrics, `peak_rss(MB)` is added to it.
+    """
+    q = Queue(1)
+
+    def target():
+        metrics = func(*args)
+        metrics['peak_rss(MB)'] = round(peak_rss_mb(), 1)
+        q.put(metrics)
+
+    p = Process(target=target)
+    p.start()
+    metrics = q.get()
+    p.join()
+    return metrics
+
+
+def load_baseline(name):
+    if not os.path.exists(BASELINE_FILE):
+        return {}
+
+    with open(BASELINE_FILE) as f:
+        return json.load(f).get(name, {})
+
+
+def save_baseline(name, results):
+    baseline = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as f:
+            baseline = json.load(f)
+
+    baseline[name] = results
+
+    with open(BASELINE_FILE, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+
+
+def compare_baseline(results, baseline, tolerance):
+    """ Returns a list of regression messages of throughput metrics
+        that are lower than baseline by more than `tolerance` (fraction).
+    """
+    regressions = []
+
+    for bench, metrics in results.items():
+        for metric, value in metrics.items():
+            if metric not in THROUGHPUT_METRICS:
+                continue
+
+            base = baseline.get(bench, {}).get(metric)
+            if not base:
+                continue
+
+            if value < base * (1 - tolerance):
+                regressions.append(f"{bench} {metric}: {value:.1f} < baseline {base:.1f} "
+                                   f"({(value / base - 1) * 100:.1f}%)")
+
+    return regressions
+
+
+def print_results(results, baseline):
+    for bench, metrics in results.items():
+        print(f"{bench}:")
+        for metric, value in metrics.items():
+            base = baseline.get(bench, {}).get(metric)
+            diff = f"  ({(value / base - 1) * 100:+.1f}% vs baseline)" \
+                if base and metric in THROUGHPUT_METRICS else ''
+            print(f"    {metric:<22}{value:>12}{diff}")
+
+
+def report_results(name, results, update_baseline, tolerance):
+    """ Print results and compare them with baseline `name`,
+        exits with status 1 if any throughput drops beyond `tolerance`.
+    """
+    baseline = load_baseline(name)
+    print_results(results, baseline)
+
+    if update_baseline:
+        save_baseline(name, results)
+        print("Baseline is updated.")
+        return
+
+    if not baseline:
+        print("No baseline to compare with, run with --update-baseline to create one.")
+        return
+
+    regressions = compare_baseline(results, baseline, tolerance)
+    if regressions:
+        print("Throughput dropped beyond tolerance:")
+        for reg in regressions:
+            print(f"    {reg}")
+        sys.exit(1)
@@ -0,0 +1,172 @@
+from setup import run
+
+from datetime import datetime
+
+import argparse
+import time
+import numpy as np
+
+from benchmark import \
+    gen_ohlcvs, \
+    report_results
+from db import EXMongo
+from utils import config, ms_dt, dt_ms
+
+START = datetime(2018, 1, 1)
+OHLCV_COLL = 'bench_bitfinex_ohlcv_BTCUSD_1m'
+TRADE_COLL = 'bench_bitfinex_trades_BTCUSD'
+
+
+def gen_trade_docs(n, seed=0):
+    rng = np.random.RandomState(seed)
+    timestamps = dt_ms(START) + np.cumsum(rng.randint(1, 2000, n))
+    prices = 100 * np.exp(np.cumsum(rng.normal(0, 0.0001, n)))
+    amounts = rng.lognormal(0, 1, n)
+    sides = np.where(rng.rand(n) < 0.5, 'buy', 'sell')
+
+    return [{
+        'id': str(i),
+        'timestamp': int(timestamps[i]),
+        'symbol': 'BTC/USD',
+        'side': str(sides[i]),
+        'price': float(prices[i]),
+        'amount': float(amounts[i]),
+    } for i in range(n)]
+
+
+def gen_ohlcv(days):
+    return gen_ohlcvs(['BTC/USD'], ['1m'], START, days)['BTC/USD']['1m']
+
+
+def gen_ohlcv_docs(days):
+    ohlcv = gen_ohlcv(days).reset_index()
+    ohlcv['timestamp'] = ohlcv.timestamp.values.astype('datetime64[ms]').astype(np.int64)
+    return ohlcv.to_dict(orient='records')
+
+
+async def insert_docs(mongo, collection, docs):
+    coll = mongo.get_collection(mongo.config['dbname_exchange'], collection)
+    await coll.drop()
+
+    for i in range(0, len(docs), 10000):
+        await coll.insert_many(docs[i:i+10000])
+
+    await coll.create_index('timestamp')
+
+
+async def bench_write(mongo, ohlcv, runs):
+    """ Time writing ohlcv with EXMongo.write_ohlcv into an empty collection (insert)
+        and over existing ohlcv (upsert).
+    """
+    db = mongo.config['dbname_exchange']
+    coll = mongo.get_collection(db, OHLCV_COLL)
+    secs = {'insert': [], 'upsert': []}
+
+    for _ in range(runs):
+        await coll.drop()
+
+        for path in ['insert', 'upsert']:
+            s = time.perf_counter()
+            await mongo.insert_ohlcv(ohlcv, 'bitfinex', 'BTC/USD', '1m', coll_prefix='bench_')
+            secs[path].append(time.perf_counter() - s)
+
+    results = {}
+    for path, times in secs.items():
+        best = min(times)
+        results[path] = {
+            'seconds': round(best, 3),
+            'docs/s': round(len(ohlcv) / best, 1),
+        }
+
+    return results
+
+
+async def bench_read(mongo, collection, n_docs, fields, runs):
+    """ Time reading a whole collection with the dict based path
+        (_read_to_dataframe) and the numpy path (_read_to_arrays).
+    """
+    db = mongo.config['dbname_exchange']
+    condition = {'timestamp': {'$gte': 0}}
+    secs = {'dicts': [], 'arrays': []}
+
+    for _ in range(runs):
+        s = time.perf_counter()
+        df = await mongo._read_to_dataframe(db, collection, condition,
+                                            index_col='timestamp',
+                                            date_col='timestamp',
+                                            date_parser=ms_dt)
+        secs['dicts'].append(time.perf_counter() - s)
+
+        s = time.perf_counter()
+        arrays = await mongo._read_to_arrays(db, collection, condition, fields)
+        df = mongo._arrays_to_dataframe(arrays, index_col='timestamp')
+        secs['arrays'].append(time.perf_counter() - s)
+
+        assert len(df) == n_docs
+
+    results = {}
+    for path, times in secs.items():
+        best = min(times)
+        results[path] = {
+            'seconds': round(best, 3),
+            'docs/s': round(n_docs / best, 1),
+            'us/doc': round(best / n_docs * 1e6, 3),
+        }
+
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--days', type=int, default=180,
+        help="Days of synthetic 1m ohlcv to read")
+    parser.add_argument('--trades', type=int, default=1000000,
+        help="Number of synthetic trades to read")
+    parser.add_argument('--runs', type=int, default=3,
+        help="Times every read is repeated, the fastest one is reported")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+        help="Fraction of throughput a benchmark may drop from the baseline")
+    parser.add_argument('--update-baseline', action='store_true',
+        help="Save results as the new baseline instead of comparing with it")
+
+    argv = parser.parse_args()
+
+    return argv
+
+
+async def main():
+    argv = parse_args()
+    mongo = EXMongo(ssl=config['database']['ssl'])
+
+    ohlcv_docs = gen_ohlcv_docs(argv.days)
+    trade_docs = gen_trade_docs(argv.trades)
+    await insert_docs(mongo, TRADE_COLL, trade_docs)
+
+    results = {}
+
+    try:
+        for path, metrics in (await bench_write(mongo, gen_ohlcv(argv.days), argv.runs)).items():
+            results[f"ohlcv_write_{path}"] = metrics
+
+        # Read benchmarks start from a collection written by insert_many
+        await insert_docs(mongo, OHLCV_COLL, ohlcv_docs)
+
+        for name, coll, n_docs, fields in [
+                ('ohlcv', OHLCV_COLL, len(ohlcv_docs), mongo.ohlcv_fields),
+                ('trades', TRADE_COLL, len(trade_docs), mongo.trade_fields)]:
+
+            res = await bench_read(mongo, coll, n_docs, fields, argv.runs)
+            for path, metrics in res.items():
+                results[f"{name}_{path}"] = metrics
+
+    finally:
+        db = mongo.config['dbname_exchange']
+        await mongo.get_collection(db, OHLCV_COLL).drop()
+        await mongo.get_collection(db, TRADE_COLL).drop()
+
+    report_results('db', results, argv.update_baseline, argv.tolerance)
+
+
+if __name__ == '__main__':
+    run(main)
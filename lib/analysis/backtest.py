@@ -1,17 +1,24 @@
 from asyncio import ensure_future
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from datetime import timedelta
-from multiprocess import Process, Queue
+from multiprocess import Process, Queue, Pipe
 import asyncio
 import copy
 import itertools
 import random
 import logging
-import queue
 import pandas as pd
 import numpy as np
 
-from analysis.backtest_trader import SimulatedTrader, FastTrader
+from analysis.backtest_trader import \
+    SimulatedTrader, \
+    FastTrader, \
+    BacktestPruner, \
+    BacktestPruned, \
+    TickTrader, \
+    trailing_stop_hits
+from analysis.profiler import Profiler, profiled, cprofile_sampled, run_cprofile
+from analysis.result_store import ResultStore
 from db import EXMongo
 from utils import \
     INF, \
@@ -23,6 +30,7 @@ from utils import \
     utc_now, \
     roundup_dt, \
     rounddown_dt, \
+    rsym, \
     check_periods
 
 logger = logging.getLogger('pyct')
@@ -38,7 +46,12 @@ class Backtest():
 
     def __init__(self, strategy, data_feed, start, end,
                  enable_plot=False,
+                 prune_threshold=None,
                  custom_config=None):
+        """ Param
+                prune_threshold: float, PL(%) a run should be able to reach to not be pruned,
+                    only used if config['backtest']['pruning'] is enabled
+        """
 
         if not data_feed:
             raise ValueError(f"Data feed is empty")
@@ -52,6 +65,7 @@ class Backtest():
         self.trades = data_feed['trades']
         self.start = start
         self.end = end
+        self.prune_threshold = prune_threshold
         self.timer = Timer(self.start, self.config['base_timeframe'])
         self.buff_days = int(self._config['analysis']['ohlcv_buffer_bars'] \
             / (timedelta(hours=24) / tf_td(self._config['analysis']['indicator_tf'])))
@@ -59,12 +73,15 @@ class Backtest():
         if (self.end - self.start).days <= self.buff_days:
             raise RuntimeError(f"ohlcv days < buffer days")
 
-        if self.config['fast_mode']:
-            self.trader = FastTrader(self.timer, self.strategy, custom_config=_config)
-            self.trader.fast_mode = True
-            self.strategy.fast_mode = True
-        else:
-            self.trader = SimulatedTrader(self.timer, self.strategy, custom_config=_config)
+        if self.config['portfolio']['enable'] and not self.config['fast_mode']:
+            raise ValueError("Portfolio mode is only available in fast mode")
+
+        if self.config['intrabar'] and self.config['fast_mode']:
+            for ex, tfs in _config['analysis']['exchanges'].items():
+                if '1m' not in tfs['timeframes']:
+                    raise ValueError(f"Intrabar execution needs 1m ohlcv of {ex}")
+
+        self.trader = self._create_trader()
 
         for ex in self.trader.markets:
             avail_markets = list(data_feed['ohlcvs'][ex].keys())
@@ -75,19 +92,48 @@ class Backtest():
 
         self.strategy.init(self.trader)
 
+    def _create_trader(self):
+        if self.config['fast_mode']:
+            trader = FastTrader(self.timer, self.strategy, custom_config=self._config)
+            trader.fast_mode = True
+            self.strategy.fast_mode = True
+        else:
+            trader = SimulatedTrader(self.timer, self.strategy, custom_config=self._config)
+
+        return trader
+
     def run(self):
         self.report = self._init_report()
 
-        if self.config['fast_mode']:
-            # Feed all data at once and accept and execute a sequence of orders
-            self.fast_run()
+        if self.config['pruning']['enable']:
+            self.trader.pruner = BacktestPruner(
+                self.start + timedelta(days=self.buff_days), self.end,
+                self.report['initial_value'], threshold=self.prune_threshold,
+                custom_config=self._config)
 
-        else:
-            # Feed data by base timeframe, is same as oneline strategy trading,
-            # also stricts stratgy from cheating.
-            self.slow_run()
+        with Profiler(enable=self.config['profile']['enable'],
+                      track_memory=self.config['profile']['memory']) as profiler:
+            try:
+                if self.config['fast_mode']:
+                    # Feed all data at once and accept and execute a sequence of orders
+                    self.fast_run()
+
+                else:
+                    # Feed data by base timeframe, is same as oneline strategy trading,
+                    # also stricts stratgy from cheating.
+                    self.slow_run()
+
+            except BacktestPruned as err:
+                self.report['pruned'] = True
+                self.report['pruned_reason'] = str(err)
+                self.trader.pruner = None
+                self.trader.liquidate()
+
+            self._analyze_orders()
+
+        if profiler.enable:
+            self.report['profile'] = profiler.report()
 
-        self._analyze_orders()
         self.clean_order_history()
 
         if self.enable_plot:
@@ -95,17 +141,23 @@ class Backtest():
 
         return self.report
 
+    @profiled('fast_run')
     def fast_run(self):
         self.trader.feed_data(self.start, self.end, self.ohlcvs)
         self.trader.tick()
         self.trader.liquidate()
 
+    @profiled('slow_run')
     def slow_run(self):
         # Feed one day data to trader to let strategy has initial data to setup variables
         pre_feed_end = self.start + timedelta(days=self.strategy.prefeed_days)
         self.trader.feed_data(self.start, pre_feed_end, self.ohlcvs)
         self.strategy.prefeed()
 
+        clock = EventClock(self.trader, self.strategy, self.ohlcvs, self.end,
+                           custom_config=self._config) \
+                if self.config['skip_idle_ticks'] else None
+
         # Feed the rest of data and tell trader to execute orders
         cur_time = self.timer.now()
         while cur_time < self.end:
@@ -114,6 +166,13 @@ class Backtest():
             self.trader.feed_data(self.start, next_time, self.ohlcvs)
             self.trader.tick()  # execute orders
 
+            if clock:
+                # Jump to one interval before the next event, so data up to the event
+                # is fed on next round, as if every tick in between was run
+                skip_to = clock.next_event(self.timer.now()) - self.timer.interval
+                if skip_to > self.timer.now():
+                    self.timer.set_now(skip_to)
+
         self.trader.liquidate()
 
     def _init_report(self):
@@ -129,8 +188,23 @@ class Backtest():
             "PL_Eff": 0,
             "#_profit_trades": 0,
             "#_loss_trades": 0,
+            "max_drawdown(%)": 0,
+            "exposure(%)": 0, # time with any position open
+            "avg_trade_duration(h)": 0,
+            "pruned": False,
+            "markets": {
+                market: {
+                    "PL": 0,
+                    "PL(%)": 0,
+                    "Fee": 0,
+                    "#_profit_trades": 0,
+                    "#_loss_trades": 0,
+                }
+                for markets in self.trader.markets.values() for market in markets
+            },
         }
 
+    @profiled('analyze_orders')
     def _analyze_orders(self):
         # Calculate total PL
         self.report['final_fund'] = copy.deepcopy(self.trader.wallet)
@@ -142,25 +216,76 @@ class Backtest():
         # PL_Eff = 1 means 100% return in 30 days
         self.report['PL_Eff'] = self.report['PL(%)'] / self.report['days'] * 0.3
 
+        # Contribution of every market to the total PL
+        markets = self.report['markets']
+
         for ex, orders in self.trader.order_history.items():
             for _, order in orders.items():
                 if not order['canceled']:
+                    mrep = markets[order['market']]
 
                     self.report['Fee'] += order['fee']
+                    mrep['Fee'] += order['fee']
 
                     if order['margin']:
                         self.report['Fee'] += order['margin_fee']
+                        mrep['Fee'] += order['margin_fee']
 
                         self.margin_PLs.append(order['PL'])
+                        mrep['PL'] += order['PL']
 
                         # Calculate number of profit/loss trades
                         if order['PL'] >= 0:
                             self.report['#_profit_trades'] += 1
+                            mrep['#_profit_trades'] += 1
                         else:
                             self.report['#_loss_trades'] += 1
+                            mrep['#_loss_trades'] += 1
 
                     # TODO: Add PL calculations for normal order
 
+        for mrep in markets.values():
+            mrep['PL(%)'] = mrep['PL'] / self.report['initial_value'] * 100
+
+        self.report['max_drawdown(%)'] = self._calc_max_drawdown()
+        self.report['exposure(%)'], self.report['avg_trade_duration(h)'] = self._calc_exposure()
+
+    def _calc_max_drawdown(self):
+        """ Max drawdown (%) of the equity curve built from closed margin positions. """
+        if not self.margin_PLs:
+            return 0
+
+        equity = self.report['initial_value'] + np.cumsum(self.margin_PLs)
+        equity = np.insert(equity, 0, self.report['initial_value'])
+        peak = np.maximum.accumulate(equity)
+        return float(np.max((peak - equity) / peak) * 100)
+
+    def _calc_exposure(self):
+        """ Returns percentage of backtest days with any margin position open
+            and average duration (hours) of margin positions, from open to close of their orders.
+        """
+        spans = [
+            (order['open_time'], order['close_time'])
+            for orders in self.trader.order_history.values() for order in orders.values()
+            if order['margin'] and not order['canceled'] and order['close_time']
+        ]
+
+        if not spans or self.report['days'] <= 0:
+            return 0, 0
+
+        spans = np.array(spans, dtype='datetime64[ns]').astype(np.int64)
+        spans = spans[np.argsort(spans[:, 0], kind='stable')]
+        opens, closes = spans[:, 0], spans[:, 1]
+
+        # Overlapping positions are counted once: only time after
+        # the latest close of previous positions is added
+        prev_close = np.concatenate([[opens[0]], np.maximum.accumulate(closes)[:-1]])
+        covered = np.maximum(closes - np.maximum(opens, prev_close), 0).sum()
+
+        hour = timedelta(hours=1) / timedelta(microseconds=1) * 1000 # in ns
+        exposure = covered / (self.report['days'] * 24 * hour) * 100
+        return float(exposure), float((closes - opens).mean() / hour)
+
     def _calc_total_value(self, dt):
         # TODO: Add conversion to BTC than to USD for exchanges that don't have USD pairs.
 
@@ -233,6 +358,157 @@ class Backtest():
                         del order[field]
 
 
+class TickBacktest(Backtest):
+    """ Slow mode backtest which replays every trade, orders are matched against
+        individual trades by TickTrader. Trades are streamed from mongodb in chunks of
+        `backtest.trade_chunk_hours`, so only about two chunks per market are in memory.
+        Report has an extra `slippage` entry comparing fills with the ohlcv model.
+    """
+
+    def __init__(self, strategy, data_feed, start, end, mongo, custom_config=None):
+        _config = custom_config or config
+
+        if _config['backtest']['fast_mode']:
+            raise ValueError("Tick replay is only available in slow mode")
+
+        self.mongo = mongo
+        super().__init__(strategy, data_feed, start, end, custom_config=_config)
+
+    def _create_trader(self):
+        return TickTrader(self.timer, self.strategy, custom_config=self._config)
+
+    async def run(self):
+        self.report = self._init_report()
+
+        with Profiler(enable=self.config['profile']['enable'],
+                      track_memory=self.config['profile']['memory']) as profiler:
+            await self.tick_run()
+            self._analyze_orders()
+
+        if profiler.enable:
+            self.report['profile'] = profiler.report()
+
+        self.report['slippage'] = self.trader.slippage_report()
+        self.clean_order_history()
+
+        return self.report
+
+    async def tick_run(self):
+        pre_feed_end = self.start + timedelta(days=self.strategy.prefeed_days)
+        self.trader.feed_data(self.start, pre_feed_end, self.ohlcvs)
+        self.strategy.prefeed()
+
+        chunk = timedelta(hours=self.config['trade_chunk_hours'])
+        chunk_end = self.timer.now()
+        streams = {
+            (ex, market): self.mongo.iter_trades(ex, market, chunk_end, self.end, chunk, compress=True)
+            for ex, markets in self.trader.markets.items() for market in markets
+        }
+
+        while self.timer.now() < self.end:
+            # Streams have the same chunk bounds
+            chunks = await asyncio.gather(*[stream.__anext__() for stream in streams.values()])
+            chunk_end = min(chunk_end + chunk, self.end)
+
+            trades = {ex: {} for ex in self.trader.markets}
+            for (ex, market), trade in zip(streams.keys(), chunks):
+                trades[ex][market] = trade
+
+            while self.timer.now() < chunk_end:
+                next_time = self.timer.next()
+                self.trader.feed_data(self.start, next_time, self.ohlcvs, trades)
+                self.trader.tick()  # execute orders
+
+        self.trader.liquidate()
+
+
+class EventClock():
+    """ Find the next instant a slow mode backtest has to tick at, the instant is
+        the earliest one of
+            - a new bar of strategy's `wake_timeframes` (default is indicator_tf)
+            - strategy's `next_wakeup`
+            - a limit order, stop or liquidation price in trader's trigger books is crossed
+            - next tick if a market order or a position close is pending
+            - next checkpoint of trader's pruner
+        Future bars are only used to determine when to tick,
+        data is still fed to trader and strategy tick by tick.
+    """
+
+    def __init__(self, trader, strategy, ohlcvs, end, custom_config=None):
+        self._config = custom_config or config
+        self.trader = trader
+        self.strategy = strategy
+        self.end = end
+
+        wake_tfs = strategy.wake_timeframes or [self._config['analysis']['indicator_tf']]
+
+        self.bar_times = [] # index of every market and wake timeframe
+        self.prices = {}    # (ex, market) -> (index, high, low) of the tf trader checks triggers with
+
+        for ex, markets in trader.markets.items():
+            for market in markets:
+                for tf in wake_tfs:
+                    self.bar_times.append(ohlcvs[ex][market][tf].index.values)
+
+                ohlcv = ohlcvs[ex][market][trader.trigger_tfs[ex]]
+                self.prices[(ex, market)] = (ohlcv.index.values, ohlcv.high.values, ohlcv.low.values)
+
+    def next_event(self, now):
+        if self.trader.has_queued_orders():
+            return self.trader.timer.next()
+
+        now64 = np.datetime64(now)
+        events = [self.end, self._next_bar_time(now64)]
+
+        wakeup = self.strategy.next_wakeup(now)
+        if wakeup:
+            events.append(wakeup)
+
+        pruner = self.trader.pruner
+        if pruner and pruner.checkpoints:
+            events.append(pruner.checkpoints[0])
+
+        for ex, market in self.prices:
+            events.append(self._next_trigger_time(ex, market, now64))
+
+        return min(ev for ev in events if ev is not None)
+
+    def _next_bar_time(self, now64):
+        next_time = None
+
+        for times in self.bar_times:
+            i = np.searchsorted(times, now64, side='right')
+            if i < len(times) and (next_time is None or times[i] < next_time):
+                next_time = times[i]
+
+        return pd.Timestamp(next_time).to_pydatetime() if next_time is not None else None
+
+    def _next_trigger_time(self, ex, market, now64):
+        """ First bar after now which crosses a trigger of the market as `SimulatedTrader._process_triggers`. """
+        falling, rising, trailing = self.trader.trigger_levels(ex, market)
+
+        if falling is None and rising is None and not trailing:
+            return None
+
+        times, highs, lows = self.prices[(ex, market)]
+        i = np.searchsorted(times, now64, side='right')
+        hit = np.zeros(len(times) - i, dtype=bool)
+
+        if falling is not None:
+            hit |= lows[i:] <= falling
+
+        if rising is not None:
+            hit |= highs[i:] >= rising
+
+        for position in trailing:
+            hit |= trailing_stop_hits(position, highs[i:], lows[i:])[1]
+
+        if not hit.any():
+            return None
+
+        return pd.Timestamp(times[i + np.argmax(hit)]).to_pydatetime()
+
+
 class BacktestRunner():
     """
         Fixed test period: [(start, end), (start, end), ...]
@@ -246,6 +522,20 @@ class BacktestRunner():
         self.strategy = strategy
         self.data_feed = data_feed
 
+    # Result of one period, sent back from worker processes as raw bytes
+    record_dtype = np.dtype([
+        ('start', 'datetime64[ns]'),
+        ('end', 'datetime64[ns]'),
+        ('days', np.int32),
+        ('#P', np.int32),
+        ('#L', np.int32),
+        ('PL(%)', np.float64),
+        ('PL_Eff', np.float64), # PL_Eff = 1 means 100% return / 30days
+        ('max_drawdown(%)', np.float64),
+        ('exposure(%)', np.float64),
+        ('avg_trade_duration(h)', np.float64),
+    ])
+
     async def run_periods(self, periods):
         """
             Param
@@ -254,77 +544,59 @@ class BacktestRunner():
         if not isinstance(periods, list):
             periods = [periods]
 
-        reports = []
-        reports_q = Queue(self._config['max_processes'])
-        ps = queue.Queue(self._config['max_processes'])
-        n_reports_left = len(periods)
-
-        def run_backtest(backtest):
-            report = backtest.run()
-            reports_q.put({
-                'period': (backtest.start, backtest.end),
-                'report': report
-            })
-            del backtest
+        records = np.zeros(len(periods), dtype=self.record_dtype)
+        ps = deque()
+
+        def run_backtest(backtest, conn):
+            rec = self._to_record(backtest, backtest.run())
+            conn.send_bytes(rec.tobytes())
+            conn.close()
 
-        for start, end in periods:
-            backtest = await Backtest(self.strategy, self.data_feed, start, end,
+        def finish_oldest():
+            p, conn, i = ps.popleft()
+            records[i] = np.frombuffer(conn.recv_bytes(), dtype=self.record_dtype)[0]
+            conn.close()
+            p.join()
+
+        for i, (start, end) in enumerate(periods):
+            backtest = Backtest(self.strategy, self.data_feed, start, end,
                 enable_plot=False, custom_config=self._config)
 
             if self._config['use_multicore']:
-                if ps.full():
-                    reports.append(reports_q.get())
-                    ps.get().join()
-                    n_reports_left -= 1
+                if len(ps) >= self._config['max_processes']:
+                    finish_oldest()
 
-                p = Process(target=run_backtest, args=(backtest,))
+                recv_conn, send_conn = Pipe(duplex=False)
+                p = Process(target=run_backtest, args=(backtest, send_conn))
                 p.start()
-                ps.put(p)
+                send_conn.close() # only the worker writes to the pipe
+                ps.append((p, recv_conn, i))
 
             else:  # use single core
-                if reports_q.full():
-                    reports.append(reports_q.get())
-                    n_reports_left -= 1
-
-                run_backtest(backtest)
-
-        # Results queued by processes must be cleared from the queue,
-        # or some processes will not terminate.
-        for _ in range(n_reports_left):
-            reports.append(reports_q.get())
-
-        # Wait for all processes to terminate
-        # (should be unecessary here because getting reports already blocks)
-        if self._config['use_multicore']:
-            while ps.qsize() > 0:
-                ps.get().join()
+                records[i] = self._to_record(backtest, backtest.run())
 
-        summary = self._analyze_reports(reports)
-        return summary
-
-    @staticmethod
-    def _analyze_reports(reports):
-        if not isinstance(reports, list):
-            reports = [reports]
-
-        summary = pd.DataFrame(columns=['start', 'end', 'days',
-                                        '#P', '#L', 'PL(%)', 'PL_Eff'])
-        for rep in reports:
-            dt = rep['period']
-            report = rep['report']
-
-            summ = {
-                'start': dt[0],
-                'end': dt[1],
-                'days': report['days'],
-                '#P': report['#_profit_trades'],
-                '#L': report['#_loss_trades'],
-                'PL(%)': report['PL(%)'],
-                'PL_Eff': report['PL_Eff'],  # PL_Eff = 1 means 100% return / 30days
-            }
-            summary = summary.append(summ, ignore_index=True)
+            del backtest
 
-        return summary
+        while ps:
+            finish_oldest()
+
+        # One row per period in order of `periods`
+        return pd.DataFrame(records)
+
+    @classmethod
+    def _to_record(cls, backtest, report):
+        rec = np.zeros(1, dtype=cls.record_dtype)
+        rec['start'] = backtest.start
+        rec['end'] = backtest.end
+        rec['days'] = report['days']
+        rec['#P'] = report['#_profit_trades']
+        rec['#L'] = report['#_loss_trades']
+        rec['PL(%)'] = report['PL(%)']
+        rec['PL_Eff'] = report['PL_Eff']
+        rec['max_drawdown(%)'] = report['max_drawdown(%)']
+        rec['exposure(%)'] = report['exposure(%)']
+        rec['avg_trade_duration(h)'] = report['avg_trade_duration(h)']
+        return rec
 
     @staticmethod
     def generate_random_periods(start, end, period_size_range, num_test):
@@ -404,6 +676,7 @@ class ParamOptimizer():
         self.mongo = mongo
         self.strategy = strategy
         self.params = self._config['analysis']['params']['common']
+        self.top_pls = np.array([]) # PLs of the best runs of current optimization
 
         self._init_param_queue()
 
@@ -447,40 +720,38 @@ class ParamOptimizer():
             columns=self.param_d.keys(),
             to_file=f)
 
-    async def run(self, combs, period, ex, market, name=''):
-
-        reports_q = Queue(self._config['max_processes'])
-        ps = queue.Queue(self._config['max_processes'])
-        n_reports_left = len(combs)
-
-        def run_backtest(backtest, idx):
-            report = backtest.run()
-            reports_q.put([idx, report])
-            del backtest
+    def get_grid(self):
+        return ParamGrid(self.param_d.values(), self.param_d.keys())
 
+    async def run(self, grid, period, ex, market, name=''):
+        """ Param
+                grid: ParamGrid, param sets to backtest
+                period: (start, end)
+        """
         if not check_periods(period):
             raise ValueError("Periods is invalid.")
 
-        _config = copy.deepcopy(self._config)
+        # Remove other exchanges and markets by remaining only the market
+        # that is going to run backtest
+        _config = self._single_market_config(ex, market)
 
         # Find last checkpoint to resume
         tf = _config['analysis']['indicator_tf']
         last_idx = await self.last_checkpoint(name, ex, market, tf, period)
 
         start, end = period
-        num_tests = len(combs) - last_idx
+        num_tests = len(grid) - last_idx
         logger.info(f"Running {ex} {market} {start}->{end} "
                     f"optimization with << {num_tests} >> tests.")
         logger.info(f"Starting from param set {last_idx+1}")
 
-        # Remove other exchanges by remaining only the exchange
-        # that is going to run backtest
-        _config['analysis']['exchanges'] = {
-            ex: _config['analysis']['exchanges'][ex]
-        }
+        store = self.get_result_store(name, ex, market, period)
+        if last_idx == 0: # results of a previous optimization of the same period are outdated
+            store.clear()
+            await self.clear_summary(name, ex, market, tf, period)
 
-        # Remove other markets
-        _config['analysis']['exchanges'][ex]['markets'] = [market]
+        # Runs that can't beat the K-th best so far are pruned
+        self.top_pls = np.sort(store.top_k(_config['backtest']['pruning']['top_k'])['PL(%)'].values)
 
         # Read data feed (ohlcv, trades) from db
         data_feed = await get_data_feed(self.mongo, _config, start, end)
@@ -499,93 +770,313 @@ class ParamOptimizer():
         count = 0
 
         # Start optimization
-        for idx, row in combs.iterrows():
-            if idx <= last_idx: # skip backtested params
-                n_reports_left -= 1
-                continue
-
-            param = OrderedDict(row.to_dict())
-            self.strategy.set_params({market: param})
-            backtest = Backtest(self.strategy, data_feed, start, end,
-                enable_plot=False, custom_config=_config)
-
-            if ps.full():
-                reports.append(reports_q.get())
-                n_reports_left -= 1
-                ps.get().join()
-
-            if self._config['use_multicore']:
-                p = Process(target=run_backtest, args=(backtest, idx))
-                p.start()
-                ps.put(p)
-            else: # for debugging
-                if reports_q.full():
-                    reports.append(reports_q.get())
-                    n_reports_left -= 1
-
-                run_backtest(backtest, idx)
-
-            num_tests -= 1
-            count += 1
-            if count == 1000: # periodically log number of remaining tests
+        idxs = np.arange(last_idx + 1, len(grid) + 1)
+        for chunk_reports, checkpoint in self._iter_backtest_chunks(
+                grid, idxs, data_feed, start, end, _config, market, prune=True):
+
+            reports += chunk_reports
+            num_tests -= len(chunk_reports)
+            count += len(chunk_reports)
+            if count >= 1000: # periodically log number of remaining tests
                 count = 0
                 logger.info(f"{num_tests} tests remaining")
 
             if len(reports) >= 1000:
                 await self.save_reports(name, reports, info)
                 await self.update_optimization_meta(name, ex, market, tf, period,
-                                                    last_idx=reports[-1][0])
+                                                    last_idx=checkpoint)
                 reports = []
 
-        while n_reports_left > 0:
-            reports.append(reports_q.get())
-            n_reports_left -= 1
-
         await self.save_reports(name, reports, info)
         await self.update_optimization_meta(name, ex, market, tf, period,
-                                            last_idx=reports[-1][0])
+                                            last_idx=len(grid))
 
-        # Wait for all processes to terminate
-        # (should be unecessary here because getting reports already blocks)
-        if self._config['use_multicore']:
-            while ps.qsize() > 0:
-                ps.get().join()
+    async def run_walk_forward(self, grid, period, ex, market, name=''):
+        """ Walk-forward optimization which reuses results of previous runs.
+            The in-sample window is split into `step_days` segments aligned to a fixed grid,
+            every param set is backtested once per segment and segment PLs are stored in
+            `param_optimization_wf_<name>`. When the window slides, only new segments are
+            backtested, then top-K param sets of the rolling (compounded) PL are
+            re-evaluated in full over the in-sample window and saved as in `run`.
 
-    async def save_reports(self, name, reports, info):
+            Param
+                grid: ParamGrid, param sets to backtest
+                period: (start, end), `start` is ignored, window size is read from
+                    config['analysis']['walk_forward']
+        """
+        wf = self._config['analysis']['walk_forward']
+        tf = self._config['analysis']['indicator_tf']
+        step = timedelta(days=wf['step_days'])
 
-        def parse_report(report):
-            return {
-                'days': report['days'],
-                'PL(%)': report['PL(%)'],
-                'PL_Eff': report['PL_Eff'],
-            }
+        if wf['in_sample_days'] % wf['step_days'] != 0:
+            raise ValueError("in_sample_days must be a multiple of step_days")
+
+        if not check_periods(period):
+            raise ValueError("Periods is invalid.")
+
+        # Align in-sample window to the segment grid so segments can be reused
+        end = period[1]
+        is_end = MIN_DT + (end - timedelta(days=wf['out_sample_days']) - MIN_DT) // step * step
+        is_start = is_end - timedelta(days=wf['in_sample_days'])
+        seg_starts = [is_start + step * i for i in range(wf['in_sample_days'] // wf['step_days'])]
+
+        _config = self._single_market_config(ex, market)
+        _config['backtest']['pruning']['enable'] = False # segment PLs are compounded, keep them complete
+        buff_td = timedelta(days=self._buff_days(_config) + 1)
+
+        logger.info(f"Running {ex} {market} walk-forward optimization, "
+                    f"in-sample {is_start}->{is_end}, out-of-sample {is_end}->{end}")
+
+        data_feed = await get_data_feed(self.mongo, _config, is_start - buff_td, end)
+
+        # Backtest missing segments for every param set
+        coll_wf = self.mongo.get_collection(
+            self.mongo.config['dbname_analysis'], f'param_optimization_wf_{name}')
+        await coll_wf.create_index([('ex', 1), ('symbol', 1), ('tf', 1), ('seg_start', 1)])
+
+        key = {'ex': ex, 'symbol': market, 'tf': tf}
+        await coll_wf.delete_many({**key, 'seg_start': {'$lt': is_start}})
+
+        for seg_start in seg_starts:
+            seg_end = seg_start + step
+            n_done = await coll_wf.count_documents({**key, 'seg_start': seg_start})
+
+            if n_done == len(grid):
+                continue
+            elif n_done > 0: # segment was interrupted, start over
+                await coll_wf.delete_many({**key, 'seg_start': seg_start})
+
+            logger.info(f"Backtesting segment {seg_start}->{seg_end} with << {len(grid)} >> tests")
+
+            docs = []
+            reports = self._backtest_params(grid, np.arange(1, len(grid) + 1), data_feed,
+                                            seg_start - buff_td, seg_end, _config, market)
+            for idx, rep in reports:
+                docs.append({**key,
+                             'seg_start': seg_start,
+                             'seg_end': seg_end,
+                             'param_idx': int(idx),
+                             'PL(%)': rep['PL(%)']})
+
+                if len(docs) >= 10000:
+                    await coll_wf.insert_many(docs)
+                    docs = []
+
+            if docs:
+                await coll_wf.insert_many(docs)
+
+        # Rank param sets by compounded PL of all segments in the window
+        docs = await coll_wf.find(
+            {**key, 'seg_start': {'$in': seg_starts}},
+            {'_id': 0, 'param_idx': 1, 'seg_start': 1, 'PL(%)': 1}).to_list(length=INF)
+
+        seg_pl = pd.DataFrame(docs).pivot(index='param_idx', columns='seg_start', values='PL(%)')
+        rolling_pl = (np.prod(1 + seg_pl.values / 100, axis=1) - 1) * 100
+        top = seg_pl.index.values[np.argsort(-rolling_pl)[:wf['top_k']]]
+
+        # Re-evaluate top-K candidates in full and save as a normal optimization
+        logger.info(f"Re-evaluating top {len(top)} param sets over the in-sample window")
+
+        info = {
+            'name': name,
+            'ex': ex,
+            'symbol': market,
+            'tf': tf,
+            'datetime': roundup_dt(utc_now(), timedelta(minutes=1)),
+            'start': is_start,
+            'end': is_end,
+        }
+        reports = self._backtest_params(grid, top, data_feed, is_start - buff_td, is_end,
+                                        _config, market)
+        reports.sort(key=lambda rep: rep[0])
+
+        # Results of a previous re-evaluation of the window may come from another grid
+        self.get_result_store(name, ex, market, (is_start, is_end)).clear()
+        await self.clear_summary(name, ex, market, tf, (is_start, is_end))
+        await self.save_reports(name, reports, info)
+        await self.update_optimization_meta(name, ex, market, tf, (is_start, end),
+                                            last_idx=len(grid))
+
+        # Out-of-sample check of the best candidate
+        best_idx, best_rep = max(reports, key=lambda rep: rep[1]['PL(%)'])
+        oos_rep = self._backtest_params(grid, [best_idx], data_feed, is_end - buff_td, end,
+                                        _config, market)[0][1]
+        logger.info(f"{market} best param set {best_idx}: "
+                    f"in-sample PL {best_rep['PL(%)']:.2f}%, "
+                    f"out-of-sample PL {oos_rep['PL(%)']:.2f}%")
+
+    def _backtest_params(self, grid, idxs, data_feed, start, end, _config, market):
+        """ Backtest param sets of `idxs` in one period.
+            Returns a list of [idx, report] in order of completion.
+        """
+        reports = []
+        for chunk_reports, _ in self._iter_backtest_chunks(
+                grid, idxs, data_feed, start, end, _config, market):
+            reports += chunk_reports
+        return reports
+
+    def _iter_backtest_chunks(self, grid, idxs, data_feed, start, end, _config, market,
+                              prune=False):
+        """ Hand chunks of param indexes to worker processes, each worker decodes
+            its own param sets and backtests them one by one.
+            Yields (reports, checkpoint) of every finished chunk, where reports is a list
+            of [idx, report] and checkpoint is the largest idx that all idxs before it
+            (including itself) are finished.
+            If `prune` is True, every chunk is given the K-th best PL of finished chunks
+            (`self.top_pls`) as the prune threshold.
+        """
+        reports_q = Queue(self._config['max_processes'])
+        ps = {} # chunk_no -> worker process
+        chunk_size = self._config['analysis']['param_chunk_size']
+        chunks = [idxs[i:i+chunk_size] for i in range(0, len(idxs), chunk_size)]
+        done = [False] * len(chunks)
+        n_chunks_left = len(chunks)
+        next_unfinished = 0
+
+        profile = _config['backtest']['profile']
+
+        def run_chunk(chunk_no, chunk, threshold):
+            reports = []
+            for idx, param in grid.iter_params(chunk):
+                self.strategy.set_params({market: param})
+                backtest = Backtest(self.strategy, data_feed, start, end,
+                    enable_plot=False, prune_threshold=threshold, custom_config=_config)
+
+                if cprofile_sampled(idx, profile['cprofile_rate']):
+                    path = f"{profile['cprofile_dir']}/{rsym(market)}_" \
+                           f"{start:%Y%m%d%H%M}_{end:%Y%m%d%H%M}_{idx}.prof"
+                    reports.append([idx, run_cprofile(backtest.run, path)])
+                else:
+                    reports.append([idx, backtest.run()])
+
+                del backtest
+
+            reports_q.put([chunk_no, reports])
+
+        def finish_chunk():
+            nonlocal next_unfinished, n_chunks_left
+            chunk_no, reports = reports_q.get()
+            done[chunk_no] = True
+
+            # Join only the worker whose reports are received,
+            # a worker can't exit until its reports are read from the queue
+            if chunk_no in ps:
+                ps.pop(chunk_no).join()
+            n_chunks_left -= 1
+
+            while next_unfinished < len(chunks) and done[next_unfinished]:
+                next_unfinished += 1
+
+            checkpoint = int(chunks[next_unfinished-1][-1]) if next_unfinished > 0 else 0
+
+            if prune:
+                self.update_top_pls(reports, _config['backtest']['pruning']['top_k'])
+
+            return reports, checkpoint
+
+        for chunk_no, chunk in enumerate(chunks):
+            threshold = self.prune_threshold(_config['backtest']['pruning']['top_k']) \
+                        if prune else None
+
+            if self._config['use_multicore']:
+                if len(ps) >= self._config['max_processes']:
+                    yield finish_chunk()
+
+                p = Process(target=run_chunk, args=(chunk_no, chunk, threshold))
+                p.start()
+                ps[chunk_no] = p
+            else: # for debugging
+                run_chunk(chunk_no, chunk, threshold)
+                yield finish_chunk()
+
+        while n_chunks_left > 0:
+            yield finish_chunk()
+
+    def update_top_pls(self, reports, k):
+        """ Keep PLs of the K best complete runs. """
+        pls = [rep['PL(%)'] for _, rep in reports if not rep['pruned']]
+        self.top_pls = np.sort(np.concatenate([self.top_pls, pls]))[-k:]
 
+    def prune_threshold(self, k):
+        """ PL(%) of the K-th best run, None until K runs are finished. """
+        return float(self.top_pls[0]) if len(self.top_pls) >= k else None
+
+    def _single_market_config(self, ex, market):
+        """ Copy config and remain only one exchange and one market for backtest. """
+        _config = copy.deepcopy(self._config)
+        _config['analysis']['exchanges'] = {
+            ex: _config['analysis']['exchanges'][ex]
+        }
+        _config['analysis']['exchanges'][ex]['markets'] = [market]
+        return _config
+
+    @staticmethod
+    def _buff_days(_config):
+        return int(_config['analysis']['ohlcv_buffer_bars'] \
+            / (timedelta(hours=24) / tf_td(_config['analysis']['indicator_tf'])))
+
+    async def save_reports(self, name, reports, info):
+        """ Append every report to the local result store and
+            keep only a summary of the best param set in mongo.
+        """
         if not reports:
             return
 
         if not isinstance(reports, list):
             reports = [reports]
 
-        thresh = self._config['analysis']['param_optmization_save_threshold']
-        parsed = []
+        store = self.get_result_store(name, info['ex'], info['symbol'], (info['start'], info['end']))
+        store.append(reports)
 
-        for report in reports:
-            idx = report[0]
-            rep = report[1]
+        complete = [rep for rep in reports if not rep[1]['pruned']]
 
-            if rep['PL(%)'] >= thresh:
-                parsed.append({
-                    **info,
-                    **parse_report(rep),
-                    **{'param_idx': idx},
+        coll = self.mongo.get_collection(
+            self.mongo.config['dbname_analysis'],
+            f'param_optimization_{name}')
+
+        key = {k: info[k] for k in ['name', 'ex', 'symbol', 'tf', 'start', 'end']}
+        summary = await coll.find_one(key)
+        update = {'datetime': info['datetime']}
+
+        if complete:
+            idx, best = max(complete, key=lambda rep: rep[1]['PL(%)'])
+
+            if not summary or 'PL(%)' not in summary or best['PL(%)'] > summary['PL(%)']:
+                update.update({
+                    'param_idx': idx,
+                    'days': best['days'],
+                    'PL(%)': best['PL(%)'],
+                    'PL_Eff': best['PL_Eff'],
+                    '#P': best['#_profit_trades'],
+                    '#L': best['#_loss_trades'],
+                    'max_drawdown(%)': best['max_drawdown(%)'],
                 })
 
-        # Save high PL params
-        if parsed:
-            coll = self.mongo.get_collection(
-                self.mongo.config['dbname_analysis'],
-                f'param_optimization_{name}')
-            await coll.insert_many(parsed)
+        # Reports beyond the last checkpoint are run again on resume, the store keeps one per param set
+        recs = store.load()
+        update.update({'count': len(recs), 'pruned': int(recs['pruned'].sum())})
+
+        await coll.update_one(key, {'$set': update}, upsert=True)
+
+    async def clear_summary(self, name, ex, symbol, tf, period):
+        """ Remove the summary (best result, count, pruned) of an optimization,
+            its param_idx may belong to another grid.
+        """
+        coll = self.mongo.get_collection(
+            self.mongo.config['dbname_analysis'],
+            f'param_optimization_{name}')
+
+        await coll.delete_one({
+            'name': name,
+            'ex': ex,
+            'symbol': symbol,
+            'tf': tf,
+            'start': period[0],
+            'end': period[1],
+        })
+
+    def get_result_store(self, name, ex, symbol, period):
+        return ResultStore(name, ex, symbol, period, custom_config=self._config)
 
     async def last_checkpoint(self, name, ex, symbol, tf, period):
         coll = self.mongo.get_collection(
@@ -630,29 +1121,97 @@ class ParamOptimizer():
             'ex': ex,
             'symbol': symbol,
             'tf': tf,
+            'PL(%)': {'$gte': self._config['analysis']['param_optmization_save_threshold']},
             'datetime': {'$gte': period[1] -
                 timedelta(days=self._config['analysis']['optimization_delay'])}
         }).sort([('PL(%)', -1)]).limit(1).to_list(length=INF)
 
         if not best_result: return [], 0
 
-        coll = self.mongo.get_collection(
-            self.mongo.config['dbname_analysis'], f'param_set_{name}')
-        params = await coll.find_one({'idx': best_result[0]['param_idx']})
-
-        if not params: return [], 0
-
         coll = self.mongo.get_collection(
             self.mongo.config['dbname_analysis'], f'param_set_meta')
         meta = await coll.find_one({'name': name})
 
         if not meta: return [], 0
 
-        p = {col: val for col, val in zip(meta['columns'], params['params'])}
+        grid = ParamGrid.from_meta(meta)
+        p = dict(grid.decode(best_result[0]['param_idx']))
 
         return p, best_result[0]['PL(%)']
 
 
+class ParamGrid():
+    """ Lazy collection of all combinations of param axes.
+        A param set is identified by its index (starts from 1) and decoded in mixed radix
+        over the axes, the first axis varies fastest (same order as `gen_combinations_large`).
+        Only axes are stored, param sets are never materialized as a whole.
+    """
+
+    def __init__(self, axes, columns):
+        self.columns = list(columns)
+        self.axes = [np.asarray(list(axis)) for axis in axes]
+
+        if len(self.columns) != len(self.axes):
+            raise ValueError("Number of columns and axes are different")
+
+        self.radix = np.array([len(axis) for axis in self.axes], dtype=np.int64)
+        self.strides = np.ones(len(self.axes), dtype=np.int64)
+        self.strides[1:] = np.cumprod(self.radix[:-1])
+
+    def __len__(self):
+        return int(np.prod(self.radix))
+
+    def positions(self, idxs):
+        """ Returns position on every axis of param set indexes, shape: (len(idxs), n_axes). """
+        idxs = np.asarray(idxs, dtype=np.int64)
+
+        if len(idxs) > 0 and (idxs.min() < 1 or idxs.max() > len(self)):
+            raise IndexError(f"Param set index out of range [1, {len(self)}]")
+
+        return (idxs[:, None] - 1) // self.strides % self.radix
+
+    def decode(self, idx):
+        """ Returns the param set of an index as OrderedDict. """
+        pos = self.positions([idx])[0]
+        return OrderedDict(
+            (col, axis[p].item()) for col, axis, p in zip(self.columns, self.axes, pos))
+
+    def decode_idxs(self, idxs):
+        """ Returns param sets of indexes as a dict of arrays by column. """
+        pos = self.positions(idxs)
+        return OrderedDict(
+            (col, axis[pos[:, i]]) for i, (col, axis) in enumerate(zip(self.columns, self.axes)))
+
+    def decode_block(self, start, stop):
+        """ Returns param sets of index range [start, stop) as a dict of arrays by column. """
+        return self.decode_idxs(np.arange(start, stop, dtype=np.int64))
+
+    def iter_params(self, idxs):
+        """ Yields (idx, OrderedDict of params) of indexes. """
+        block = self.decode_idxs(idxs)
+        cols = [block[col].tolist() for col in self.columns]
+
+        for i, idx in enumerate(idxs):
+            yield int(idx), OrderedDict((col, vals[i]) for col, vals in zip(self.columns, cols))
+
+    def to_frame(self, idxs):
+        return pd.DataFrame(self.decode_idxs(idxs), index=np.asarray(idxs))
+
+    def to_meta(self):
+        """ Returns axes definitions which can be stored in mongo. """
+        return {
+            'columns': self.columns,
+            'axes': [axis.tolist() for axis in self.axes],
+            'count': len(self),
+        }
+
+    @classmethod
+    def from_meta(cls, meta):
+        if 'axes' not in meta:
+            raise ValueError(f"Param set `{meta['name']}` has no axes, it needs to be generated again.")
+        return cls(meta['axes'], meta['columns'])
+
+
 def gen_combinations(arrays, columns=None, types=None):
     """ Generate all combinations from multiple arrays and returns a DataFrame.
         Param
@@ -669,38 +1228,25 @@ def gen_combinations(arrays, columns=None, types=None):
     return df
 
 
-def gen_combinations_large(arr, columns=None, to_file=None):
+def gen_combinations_large(arr, columns=None, to_file=None, block_size=10000):
     """ Generate large number of combinations without memory limitations. """
-    pos = np.zeros(len(arr))
-
     if not isinstance(arr, list):
         arr = list(arr)
 
+    columns = list(columns) if columns is not None else list(range(len(arr)))
+    grid = ParamGrid(arr, columns)
+
     if to_file:
         to_file.write(','.join(map(str, columns)) + '\n')
 
-    n_combs = 1
-
-    for i in range(len(arr)):
-        n_combs *= len(arr[i])
-
-    for _ in range(n_combs):
-
-        cc = []
-        for i in range(len(arr)):
-            cc.append(arr[i][int(pos[i])])
+    for start in range(1, len(grid) + 1, block_size):
+        block = grid.decode_block(start, min(start + block_size, len(grid) + 1))
 
-        if to_file:
-            to_file.write(','.join(map(str, cc)) + '\n')
-        else:
-            yield cc
-
-        for i in range(len(arr)):
-            if pos[i] < len(arr[i]) - 1:
-                pos[i] += 1
-                break
+        for cc in zip(*[block[col].tolist() for col in columns]):
+            if to_file:
+                to_file.write(','.join(map(str, cc)) + '\n')
             else:
-                pos[i] = 0
+                yield list(cc)
 
 
 def get_types(d):
@@ -750,8 +1296,9 @@ async def get_data_feed(mongo, _config=None, start=None, end=None, trades=False)
 
     data_feed = {'ohlcvs': {}, 'trades': {}}
 
-    # Read data feed
-    for ex in req:
+    # Read data feed of all exchanges at once,
+    # number of concurrent queries is limited by mongo client
+    async def read_ex(ex):
         syms = req[ex]['symbols']
         tfs = req[ex]['timeframes']
         data_feed['ohlcvs'][ex] = await mongo.get_ohlcvs_of_symbols(ex, syms, tfs, start, end)
@@ -759,4 +1306,6 @@ async def get_data_feed(mongo, _config=None, start=None, end=None, trades=False)
         if trades:
             data_feed['trades'][ex] = await mongo.get_trades_of_symbols(ex, syms, start, end)
 
+    await asyncio.gather(*[read_ex(ex) for ex in req])
+
     return data_feed
\ No newline at end of file
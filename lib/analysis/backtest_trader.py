@@ -1,11 +1,16 @@
 import copy
+import heapq
+import itertools
 import logging
+import random
+import numpy as np
 import pandas as pd
 from copy import deepcopy
 from datetime import timedelta
 from pprint import pprint
 from collections import OrderedDict
 
+from analysis.profiler import profiled
 from utils import \
     not_implemented,\
     config,\
@@ -18,7 +23,10 @@ from utils import \
     dt_max,\
     Timer,\
     to_ordered_dict, \
-    tf_td
+    smallest_tf, \
+    tf_td, \
+    gen_scale_orders, \
+    MAX_DT
 
 # TODO: Use different configs (fee etc.) for different exchanges
 # TODO: Add different order types
@@ -75,6 +83,7 @@ class SimulatedTrader():
         self.markets = self.get_markets()
         self.timeframes = self.get_timeframes()
         self.fast_mode = False
+        self.pruner = None # BacktestPruner, checked on every tick if set
         self._init()
 
     def _init(self):
@@ -86,6 +95,7 @@ class SimulatedTrader():
         self.trades = self.create_empty_trade_store()
         self.last_ohlcv = None
         self.last_trade = None
+        self._feed_cursors = {} # window positions of data feed by series
 
     def reset(self):
         self._init()
@@ -100,6 +110,15 @@ class SimulatedTrader():
         self.wallet_history = []
         self._order_count = 0
 
+        # Trigger books of slow mode
+        self._queued = {ex: OrderedDict() for ex in self.markets} # market orders and closes
+        self._books = {}      # (ex, market) -> {'falling': heap, 'rising': heap}
+        self._triggers = {}   # (ex, #, kind) -> seq of the live entry in book
+        self._trailing = {}   # (ex, market) -> {#: position with trailing stop}
+        self._book_pos = {}   # (ex, market) -> (fed df, position) checked on last tick
+        self.trigger_tfs = {ex: smallest_tf(tfs) for ex, tfs in self.timeframes.items()}
+        self._trigger_seq = itertools.count()
+
     def _init_order_records(self):
         ex_empty_dict = {ex: OrderedDict() for ex in self.markets}
 
@@ -176,25 +195,16 @@ class SimulatedTrader():
                     }
                 }
         """
-        last = self.last_ohlcv
+        feeds = []
 
         for ex, syms in ex_ohlcvs.items():
             for sym, tfs in syms.items():
                 for tf, ohlcv in tfs.items():
                     if len(ohlcv) > 0:
+                        self.ohlcvs[ex][sym][tf] = self._feed_window(('ohlcv', ex, sym, tf), ohlcv, start, end)
+                        feeds.append(self._feed_cursors[('ohlcv', ex, sym, tf)])
 
-                        tmp = ohlcv[start:end]
-                        self.ohlcvs[ex][sym][tf] = tmp
-
-                        if len(tmp) > 0 \
-                        and (last is None or tmp.index[-1] > last.name):
-                            last = tmp.iloc[-1]
-
-        if self.last_ohlcv is None or last.name > self.last_ohlcv.name:
-            self.last_ohlcv = last
-        else:
-            last = None
-
+        self.last_ohlcv, last = self._newest_row(feeds, self.last_ohlcv)
         return last
 
     def feed_trade(self, ex_trades, start, end):
@@ -208,26 +218,76 @@ class SimulatedTrader():
                     }
                 }
         """
-        last = self.last_trade
+        feeds = []
 
         for ex, syms in ex_trades.items():
             for sym, trade in syms.items():
                 if len(trade) > 0:
+                    self.trades[ex][sym] = self._feed_window(('trade', ex, sym), trade, start, end)
+                    feeds.append(self._feed_cursors[('trade', ex, sym)])
 
-                    tmp = trade[start:end]
-                    self.trades[ex][sym] = tmp
+        self.last_trade, last = self._newest_row(feeds, self.last_trade)
+        return last
 
-                    if len(tmp) > 0 \
-                    and (last is None or tmp.index[-1] > last.name):
-                        last = tmp.iloc[-1]
+    def _feed_window(self, key, df, start, end):
+        """ Returns rows of `df` in [start, end] (same as `df[start:end]`) as an iloc view.
+            Integer positions of the window are kept per series, so feeding a later `end`
+            only searches from the previous end position, and the same view is returned
+            if no new row is in the window.
+        """
+        cur = self._feed_cursors.get(key)
+        start_ns = pd.Timestamp(start).value
+        end_ns = pd.Timestamp(end).value
+
+        if cur is None or cur['df'] is not df or cur['start_ns'] != start_ns:
+            index = df.index.values.astype('datetime64[ns]').view('i8')
+            begin = int(np.searchsorted(index, start_ns, side='left'))
+            cur = self._feed_cursors[key] = {
+                'df': df,
+                'index': index,
+                'start_ns': start_ns,
+                'begin': begin,
+                'end': begin,
+                'end_ns': None,
+                'view': df.iloc[begin:begin],
+            }
 
-        if self.last_trade is None or last.name > self.last_trade.name:
-            self.last_trade = last
+        index = cur['index']
+        stop = cur['end']
+
+        if cur['end_ns'] is not None and end_ns >= cur['end_ns']:
+            # Moving forward, usually no or only one new row
+            if stop < len(index) and index[stop] <= end_ns:
+                stop += int(np.searchsorted(index[stop:], end_ns, side='right'))
         else:
-            last = None
+            stop = int(np.searchsorted(index, end_ns, side='right'))
 
-        return last
+        if stop != cur['end']:
+            cur['view'] = df.iloc[cur['begin']:max(stop, cur['begin'])]
+            cur['end'] = stop
+
+        cur['end_ns'] = end_ns
+        return cur['view']
+
+    @staticmethod
+    def _newest_row(feeds, prev_last):
+        """ Returns (newest row of all feeds, the row if it's newer than `prev_last` else None). """
+        newest = None
+        newest_ns = pd.Timestamp(prev_last.name).value if prev_last is not None else None
+
+        for cur in feeds:
+            if cur['end'] > cur['begin']:
+                ts = cur['index'][cur['end'] - 1]
+                if newest_ns is None or ts > newest_ns:
+                    newest, newest_ns = cur, ts
+
+        if newest is None:
+            return prev_last, None
 
+        last = newest['df'].iloc[newest['end'] - 1]
+        return last, last
+
+    @profiled('feed_data')
     def feed_data(self, start, end, ex_ohlcvs=None, ex_trades=None):
         """ Param
                 end: datetime, data feed time end for this test period
@@ -266,6 +326,9 @@ class SimulatedTrader():
 
         self._execute_orders()
 
+        if self.pruner is not None and not last:
+            self.pruner.check(self, self.timer.now())
+
         if self.strategy is not None and not last:
             self.strategy.run()
 
@@ -273,18 +336,12 @@ class SimulatedTrader():
         """ Check whether data feed's time exceed timer's.
             Only work for SimulatedTrader, not FastTrader, because data is feed at once.
         """
-        cur_time = self.timer.now()
+        cur_ns = pd.Timestamp(self.timer.now()).value
 
-        for ex, syms in self.ohlcvs.items():
-            for market, tfs in syms.items():
-                for tf, ohlcv in tfs.items():
-                    if len(ohlcv) > 0 and ohlcv.index[-1] > cur_time:
-                        raise ValueError(f"ohlcv feed's timestamp exceeds timer's :: {ohlcv.index[-1]} > {cur_time}")
-
-        for ex, syms in self.trades.items():
-            for market, trades in syms.items():
-                if len(trades) > 0 and trades.index[-1] > cur_time:
-                    raise ValueError(f"trade feed's timestamp exceeds timer's. :: {trades.index[-1]} > {cur_time}")
+        for key, cur in self._feed_cursors.items():
+            if cur['end'] > cur['begin'] and cur['index'][cur['end'] - 1] > cur_ns:
+                last = pd.Timestamp(cur['index'][cur['end'] - 1])
+                raise ValueError(f"{key[0]} feed's timestamp exceeds timer's :: {last} > {self.timer.now()}")
 
     @staticmethod
     def generate_order(ex, market, side, order_type, amount, price=None, *, margin=False, stop_loss=None, stop_profit=None):
@@ -326,6 +383,7 @@ class SimulatedTrader():
             if self.has_enough_balance(ex, order['currency'], order['cost']):
                 self.wallet[ex][order['currency']] -= order['cost']
                 self.orders[ex][order['#']] = order
+                self._add_trigger(order, 'limit', order['open_price'])
                 return order
             else:
                 curr = order['currency']
@@ -338,6 +396,7 @@ class SimulatedTrader():
             # Assume the order will be fully executed anyway.
             # Balance will be substracted on order execution.
             self.orders[ex][order['#']] = order
+            self._queued[ex][order['#']] = order
             return order
 
     def _gen_order(self, order):
@@ -364,7 +423,10 @@ class SimulatedTrader():
             "fee": 0,                   # filled before open
             "canceled": False,          # filled after canceled
             "margin": order['margin'],
-            "op_close_price": close_price
+            "stop_loss": order.get('stop_loss'),
+            "stop_profit": order.get('stop_profit'),
+            "op_close_price": close_price,
+            "op_fill_price": order.get('op_fill_price'), # set for aggregated fills of scale orders
         }
         margin_order = {
             "active": False,
@@ -410,6 +472,7 @@ class SimulatedTrader():
             # queue the order again for trader to close
             if id not in self.orders[ex]:
                 self.orders[ex][id] = order
+                self._queued[ex][id] = order
             return order
         else:
             return None
@@ -424,21 +487,25 @@ class SimulatedTrader():
 
             self.wallet[ex][order['currency']] += order['cost']
             self.order_history[ex][id] = order
-            del self.orders[ex][id]
+            self._dequeue(ex, id)
             return order
         else:
             return None
 
-    def close_all_positions(self, ex, side='all'):
+    def close_all_positions(self, ex, side='all', market=None):
         """
             Param
                 ex: str, which ex's positions to close
                 side: 'buy'/'sell' (optional), which side of positions to close
+                market: str (optional), only close positions of the market
         """
         del_orders = []
         positions = deepcopy(self.positions[ex])
 
         for id, order in positions.items():
+            if market and order['market'] != market:
+                continue
+
             if (side == 'all')\
             or (order['side'] == side):
                 if self.close_position(order):
@@ -446,13 +513,14 @@ class SimulatedTrader():
 
         return del_orders
 
-    def cancel_all_orders(self, ex, side='all'):
+    def cancel_all_orders(self, ex, side='all', market=None):
         """ NOTE: Need to be called before `close_all_positions` or margin orders
                   queued to self.orders will be canceled.
 
             Param
                 ex: str, which ex's orders to cancel
                 side: 'buy'/'sell' (optional), which side of orders to cancel
+                market: str (optional), only cancel orders of the market
         """
         del_orders = []
         orders = deepcopy(self.orders[ex])
@@ -461,6 +529,9 @@ class SimulatedTrader():
             if self.is_margin_close(order):
                 continue # skip if the order is queued to close
 
+            if market and order['market'] != market:
+                continue
+
             if (side == 'all')\
             or (order['side'] == side):
                 if self.cancel_order(order):
@@ -468,94 +539,311 @@ class SimulatedTrader():
 
         return del_orders
 
+    @profiled('execute_orders')
     def _execute_orders(self):
         """ Execute orders in queue.
             If order_type is 'limit', it will check if current price exceeds the target.
             If order_type is 'market', it will execute at current price if balance is enough.
+            In slow mode, limit orders and position stops are only checked when the price range
+            of bars fed since last tick crosses their trigger price (see `_process_triggers`).
         """
-        def execute_open_position(order):
-            order['active'] = True
-            del self.orders[ex][order['#']]
-            self.positions[ex][order['#']] = order
+        if self.fast_mode:
+            copy_orders = deepcopy(self.orders)
+            for ex, orders in copy_orders.items():
+                for id, order in orders.items():
+                    self._execute_order(ex, order)
+            return
 
-        def execute_close_position(order):
-            ex = order['ex']
+        self._process_triggers()
 
-            if order['op_close_price']:
-                order['close_price'] = order['op_close_price']
-            else:
-                order['close_price'] = self.cur_price(ex, order['market'])
+        # Market orders and positions to close
+        for ex, queue in self._queued.items():
+            for order in list(queue.values()):
+                self._execute_order(ex, order)
 
-            order['close_time'] = self.timer.now()
-            order['active'] = False
+    def _execute_order(self, ex, order, matched=None):
+        """ Param
+                matched: bool, whether a limit order's price is reached,
+                    it's checked by `_match_order` if not provided
+        """
+        # Close margin position, all margin orders are closed at market price
+        if self.is_margin_close(order):
+            self._execute_close_position(ex, order)
 
+        # Execute limit order
+        elif order['order_type'] == 'limit':
+
+            if matched or (matched is None and self._match_order(order)):
+                if order['margin']:
+                    self._execute_open_position(ex, order)
+                else:
+                    self._execute_normal_order(ex, order)
+
+        # Execute market order
+        elif order['order_type'] == 'market':
+
+            order['open_price'] = self.fill_price(order)
             self._calc_order(order)
-            earn = self._calc_margin_return(order)
 
-            self.wallet[ex][order['currency']] += earn
-            self.order_history[ex][order['#']] = order
-            self.wallet_history.append(self.wallet[ex][order['currency']])
+            if order['margin']:
 
-            del self.positions[ex][order['#']]
-            del self.orders[ex][order['#']]
+                # print('slow:', self.wallet[ex][order['currency']])
 
-        def execute_normal_order(order):
-            order['close_time'] = self.timer.now()
-            curr = order['currency']
-            opp_curr = self.opposite_currency(order, curr)
+                if self.has_enough_balance(ex, order['currency'], order['cost']):
+                    self.wallet[ex][order['currency']] -= order['cost']
+                    self._execute_open_position(ex, order)
+                else:
+                    logger.warning(f"Not enough balance to open margin position: {order}")
+                    self.wallet[ex][order['currency']] -= order['cost'] # will be restored on cancellation
+                    self.cancel_order(order)
 
-            if self.is_buy(order):
-                self.wallet[ex][opp_curr] += order['amount']
-            else:
-                self.wallet[ex][opp_curr] += order['amount'] * order['open_price']
+            else:  # normal order
 
-            del self.orders[ex][order['#']]
-            self.order_history[ex][order['#']] = order
+                if self.has_enough_balance(ex, order['currency'], order['cost']):
+                    self.wallet[ex][order['currency']] -= order['cost']
+                    self._execute_normal_order(ex, order)
+                else:
+                    logger.warning(f"Not enough balance to execute normal market order: {order}")
+                    self.wallet[ex][order['currency']] -= order['cost'] # will be restored on cancellation
+                    self.cancel_order(order)
+
+    def _execute_open_position(self, ex, order):
+        order['active'] = True
+        self._dequeue(ex, order['#'])
+        self.positions[ex][order['#']] = order
+        self._add_position_triggers(order)
+
+    def _execute_close_position(self, ex, order):
+        if order['op_close_price']:
+            order['close_price'] = order['op_close_price']
+        else:
+            order['close_price'] = self.fill_price(order, closing=True)
 
-        copy_orders = deepcopy(self.orders)
-        for ex, orders in copy_orders.items():
-            for id, order in orders.items():
+        order['close_time'] = self.timer.now()
+        order['active'] = False
+
+        self._calc_order(order)
+        earn = self._calc_margin_return(order)
+
+        self.wallet[ex][order['currency']] += earn
+        self.order_history[ex][order['#']] = order
+        self.wallet_history.append(self.wallet[ex][order['currency']])
+
+        del self.positions[ex][order['#']]
+        self._dequeue(ex, order['#'])
+        self._remove_triggers(order)
+
+    def _execute_normal_order(self, ex, order):
+        order['close_time'] = self.timer.now()
+        curr = order['currency']
+        opp_curr = self.opposite_currency(order, curr)
+
+        if self.is_buy(order):
+            self.wallet[ex][opp_curr] += order['amount']
+        else:
+            self.wallet[ex][opp_curr] += order['amount'] * order['open_price']
+
+        self._dequeue(ex, order['#'])
+        self.order_history[ex][order['#']] = order
+
+    def _dequeue(self, ex, id):
+        """ Remove an order from active orders. """
+        del self.orders[ex][id]
+        self._queued[ex].pop(id, None)
+        self._triggers.pop((ex, id, 'limit'), None)
+
+    def _process_triggers(self):
+        """ Fill limit orders and close positions of which trigger price is crossed
+            by the high/low of bars fed since last tick.
+        """
+        for (ex, market), book in self._books.items():
+            bars = self._tick_bars(ex, market)
+
+            if bars is None:
+                continue
+
+            highs, lows = bars
+            trailed, moved = self._update_trailing_stops(ex, market, highs, lows)
+            fired = self._pop_triggers(book, highs.max(), lows.min())
+
+            # Moved stops are not crossed by any bar after the move, add them after popping
+            for order, level in moved:
+                self._add_trigger(order, 'trailing_stop', level)
+
+            for (_, id, kind), level in fired + trailed:
+                if kind == 'limit':
+                    if id in self.orders[ex]:
+                        self._execute_order(ex, self.orders[ex][id], matched=True)
+
+                elif id in self.positions[ex] and id not in self.orders[ex]:
+                    order = self.positions[ex][id]
+                    order['op_close_price'] = self.stop_fill_price(order, level)
+                    order['close_reason'] = kind
+                    self._remove_triggers(order)
+                    self.close_position(order)
+
+    def _trigger_feed(self, ex, market):
+        """ Returns (feed key, high column, low column) of data trigger books are checked with. """
+        return ('ohlcv', ex, market, self.trigger_tfs[ex]), 'high', 'low'
+
+    def _tick_bars(self, ex, market):
+        """ Returns (highs, lows) of bars fed since last tick, or None if there is no new bar. """
+        key, high, low = self._trigger_feed(ex, market)
+        cur = self._feed_cursors.get(key)
+
+        if cur is None:
+            return None
+
+        df, start = self._book_pos.get((ex, market), (cur['df'], cur['end']))
+        end = cur['end']
+        self._book_pos[(ex, market)] = (cur['df'], end)
+
+        if df is not cur['df']: # a new chunk of data is fed
+            start = cur['begin']
+        elif start > end: # data is fed from an earlier time
+            start = max(end - 1, cur['begin'])
+
+        if end <= start:
+            return None
+
+        df = cur['df']
+        return df[high].values[start:end], df[low].values[start:end]
 
-                # Close margin position, all margin orders are closed at market price
-                if self.is_margin_close(order):
-                    execute_close_position(order)
+    def _get_book(self, ex, market):
+        key = (ex, market)
 
-                # Execute limit order
-                elif order['order_type'] == 'limit':
+        if key not in self._books:
+            # Only bars fed after the book is created are checked
+            cur = self._feed_cursors.get(self._trigger_feed(ex, market)[0])
+            if cur is not None:
+                self._book_pos[key] = (cur['df'], cur['end'])
 
-                    if self._match_order(order):
-                        if order['margin']:
-                            execute_open_position(order)
-                        else:
-                            execute_normal_order(order)
+            # falling: triggered when price falls to the level (buy limit orders, stops of long positions),
+            #          stored by negative level, so the highest level is on the top
+            # rising:  triggered when price rises to the level (sell limit orders, stops of short positions)
+            self._books[key] = {'falling': [], 'rising': []}
 
-                # Execute market order
-                elif order['order_type'] == 'market':
+        return self._books[key]
 
-                    order['open_price'] = self.cur_price(ex, order['market'])
-                    self._calc_order(order)
+    def _add_trigger(self, order, kind, level):
+        """ Add or move a trigger of an order, the previous entry is left in the book
+            and skipped when popped.
+        """
+        if self.fast_mode:
+            return
+
+        key = (order['ex'], order['#'], kind)
+        seq = next(self._trigger_seq)
+        self._triggers[key] = seq
+        book = self._get_book(order['ex'], order['market'])
 
-                    if order['margin']:
+        if self.is_buy(order):
+            heapq.heappush(book['falling'], (-level, seq, key))
+        else:
+            heapq.heappush(book['rising'], (level, seq, key))
+
+    def _remove_triggers(self, order):
+        for kind in ['limit', 'stop_loss', 'trailing_stop', 'liquidation']:
+            self._triggers.pop((order['ex'], order['#'], kind), None)
 
-                        # print('slow:', self.wallet[ex][order['currency']])
+        self._trailing.get((order['ex'], order['market']), {}).pop(order['#'], None)
 
-                        if self.has_enough_balance(ex, order['currency'], order['cost']):
-                            self.wallet[ex][order['currency']] -= order['cost']
-                            execute_open_position(order)
-                        else:
-                            logger.warning(f"Not enough balance to open margin position: {order}")
-                            self.wallet[ex][order['currency']] -= order['cost'] # will be restored on cancellation
-                            self.cancel_order(order)
+    def _add_position_triggers(self, order):
+        if self.fast_mode:
+            return
 
-                    else:  # normal order
+        P = order['open_price']
+        sign = -1 if self.is_buy(order) else 1
 
-                        if self.has_enough_balance(ex, order['currency'], order['cost']):
-                            self.wallet[ex][order['currency']] -= order['cost']
-                            execute_normal_order(order)
-                        else:
-                            logger.warning(f"Not enough balance to execute normal market order: {order}")
-                            self.wallet[ex][order['currency']] -= order['cost'] # will be restored on cancellation
-                            self.cancel_order(order)
+        if order['stop_loss']:
+            self._add_trigger(order, 'stop_loss', P * (1 + sign * order['stop_loss']))
+
+        if self._config['backtest']['force_liquidation']:
+            self._add_trigger(order, 'liquidation', P * (1 + sign * self.config['force_liquidate_percent']))
+
+        if order['stop_profit']:
+            order['trail_price'] = P # highest (long) or lowest (short) price since open
+            self._trailing.setdefault((order['ex'], order['market']), {})[order['#']] = order
+
+    def _update_trailing_stops(self, ex, market, highs, lows):
+        """ Move trailing stops bar by bar with new high (long) or low (short) price,
+            same as stop profit in `op_execute_position_stop` of fast mode.
+            Returns a list of (key, level) of stops hit and a list of (position, level) of
+            active stops not hit.
+        """
+        fired = []
+        moved = []
+
+        for order in list(self._trailing.get((ex, market), {}).values()):
+            key = (ex, order['#'], 'trailing_stop')
+            self._triggers.pop(key, None) # it's checked with every bar below
+            levels, hit = trailing_stop_hits(order, highs, lows)
+
+            if hit.any():
+                fired.append((key, levels[np.argmax(hit)]))
+            else:
+                if self.is_buy(order):
+                    order['trail_price'] = max(order['trail_price'], highs.max())
+                else:
+                    order['trail_price'] = min(order['trail_price'], lows.min())
+
+                level = levels[-1]
+                if (self.is_buy(order) and level > order['open_price']) \
+                or (self.is_sell(order) and level < order['open_price']):
+                    moved.append((order, level))
+
+        return fired, moved
+
+    def _pop_triggers(self, book, high, low):
+        """ Pop triggers crossed by price range [low, high].
+            Returns a list of (key, level), triggers of each side are ordered by
+            distance from the previous price.
+        """
+        fired = []
+
+        falling = book['falling']
+        while falling and -falling[0][0] >= low:
+            level, seq, key = heapq.heappop(falling)
+            if self._triggers.get(key) == seq:
+                del self._triggers[key]
+                fired.append((key, -level))
+
+        rising = book['rising']
+        while rising and rising[0][0] <= high:
+            level, seq, key = heapq.heappop(rising)
+            if self._triggers.get(key) == seq:
+                del self._triggers[key]
+                fired.append((key, level))
+
+        return fired
+
+    def trigger_levels(self, ex, market):
+        """ Returns (highest falling trigger, lowest rising trigger, trailing stop positions)
+            of a market, levels are None if the book is empty.
+        """
+        book = self._books.get((ex, market), {'falling': [], 'rising': []})
+        levels = []
+
+        for name in ['falling', 'rising']:
+            heap = book[name]
+            while heap and self._triggers.get(heap[0][2]) != heap[0][1]:
+                heapq.heappop(heap) # drop stale entries
+
+            levels.append(abs(heap[0][0]) if heap else None)
+
+        return levels[0], levels[1], list(self._trailing.get((ex, market), {}).values())
+
+    def fill_price(self, order, closing=False):
+        """ Price a market order or a position close is filled at. """
+        return self.cur_price(order['ex'], order['market'])
+
+    def stop_fill_price(self, position, level):
+        """ Price a position is closed at when its stop at `level` is triggered. """
+        return level
+
+    def has_queued_orders(self):
+        """ Whether there are market orders or positions waiting to be closed. """
+        return any(len(queue) > 0 for queue in self._queued.values())
 
     def has_enough_balance(self, ex, curr, cost):
         if self.wallet[ex][curr] < cost:
@@ -622,6 +910,7 @@ class SimulatedTrader():
         currs.remove(curr)
         return currs[0]
 
+    @profiled('cur_price')
     def cur_price(self, ex, market):
         if self.fast_mode:
             raise RuntimeError('SimulatedTrader cur_price is called in fast mode.')
@@ -634,6 +923,40 @@ class SimulatedTrader():
         self._order_count += 1
         return self._order_count
 
+    def account_value(self):
+        """ Total value in quote currency of wallet, reserved balance of pending orders
+            and open margin positions valued at current price.
+        """
+        value = 0
+
+        for ex, wallet in self.wallet.items():
+            for curr, amount in wallet.items():
+                value += self._currency_value(ex, curr, amount)
+
+            for order in self.orders[ex].values():
+                if order['#'] not in self.positions[ex] and order['order_type'] == 'limit':
+                    value += self._currency_value(ex, order['currency'], order['cost'])
+
+            for order in self.positions[ex].values():
+                order = copy.copy(order)
+                order['close_price'] = self.cur_price(ex, order['market'])
+                value += self._calc_margin_return(order)
+
+        return value
+
+    def _currency_value(self, ex, curr, amount):
+        if amount == 0:
+            return 0
+
+        for market in self.markets[ex]:
+            base, quote = market.split('/')
+            if curr == quote:
+                return amount
+            elif curr == base:
+                return amount * self.cur_price(ex, market)
+
+        return 0
+
     def is_position_open(self, order):
         if not isinstance(order, dict) or '#' not in order or 'ex' not in order:
             return False
@@ -777,6 +1100,8 @@ class FastTrader(SimulatedTrader):
     def _init(self):
         super()._init()
         self.op_init_account()
+        self._intrabar = {} # (ex, market) -> IntrabarIndex
+        self._scale_rng = random.Random(self._config['backtest']['scale_order']['seed'])
 
     def op_init_account(self):
         funds = self.config['funds']
@@ -798,7 +1123,8 @@ class FastTrader(SimulatedTrader):
         end = self.timer.now()
         self.timer.reset()
 
-        ops = self.strategy.fast_run()
+        # Ops of multiple markets are executed in time order
+        ops = sorted(self.strategy.fast_run(), key=lambda op: op['time'])
         self.ops = ops
 
         if len(ops) == 0:
@@ -815,6 +1141,9 @@ class FastTrader(SimulatedTrader):
 
             self._execute_orders()
 
+            if self.pruner is not None:
+                self.pruner.check(self, cur_time)
+
             executed_ops = []
             for op in ops:
                 dt = op['time']
@@ -831,10 +1160,10 @@ class FastTrader(SimulatedTrader):
                         self.cancel_order(order)
 
                     elif op['name'] == 'close_all_positions':
-                        self.close_all_positions(op['ex'], op['side'])
+                        self.close_all_positions(op['ex'], op['side'], op['market'])
 
                     elif op['name'] == 'cancel_all_orders':
-                        self.cancel_all_orders(op['ex'], op['side'])
+                        self.cancel_all_orders(op['ex'], op['side'], op['market'])
 
                     else:
                         raise ValueError(f"op name is invalid: {op['name']}")
@@ -848,8 +1177,17 @@ class FastTrader(SimulatedTrader):
                 ops.remove(op)
 
             if self.has_open_orders():
-                # Move current time by one interval to execute pending orders on next round
-                self.timer.tick()
+                next_fill = self._next_fill_time()
+
+                if next_fill is None:
+                    # Move current time by one interval to execute pending orders on next round
+                    self.timer.tick()
+                else:
+                    # Only limit orders with known fill time are pending, skip to the earliest
+                    # fill or next op
+                    dt = min([next_fill, end] + ([ops[0]['time']] if ops else []))
+                    self.update_timer(self.timer, max(dt, self.timer.next()))
+
             elif len(ops) > 0:
                 # No active order is waiting for execution, skip to next op.
                 dt = ops[0]['time']
@@ -866,6 +1204,62 @@ class FastTrader(SimulatedTrader):
                 return True
         return False
 
+    def _next_fill_time(self):
+        """ Earliest fill time of open orders if all of them are limit orders
+            with `op_touch_time` (intrabar mode), else None.
+        """
+        times = []
+
+        for orders in self.orders.values():
+            for order in orders.values():
+                if self.is_margin_close(order) or 'op_touch_time' not in order:
+                    return None
+
+                if order['op_touch_time'] is not None:
+                    times.append(order['op_touch_time'])
+
+        return min(times) if times else MAX_DT
+
+    def intrabar(self, ex, market):
+        """ Returns IntrabarIndex of a market if backtest.intrabar is enabled, else None. """
+        if not self._config['backtest']['intrabar']:
+            return None
+
+        if (ex, market) not in self._intrabar:
+            tf = self.config['indicator_tf']
+            ohlcvs = self.ohlcvs[ex][market]
+            self._intrabar[(ex, market)] = IntrabarIndex(ohlcvs['1m'], ohlcvs[tf], tf)
+
+        return self._intrabar[(ex, market)]
+
+    def open(self, order):
+        order = super().open(order)
+
+        if order and order['order_type'] == 'limit':
+            intrabar = self.intrabar(order['ex'], order['market'])
+
+            # Fill time is known in advance, which is checked by `_match_order`
+            if intrabar:
+                order['op_touch_time'] = intrabar.first_touch(
+                    order['open_price'], self.is_buy(order),
+                    order['open_time'] + timedelta(seconds=1), None)
+
+        return order
+
+    def fill_price(self, order, closing=False):
+        if not closing and order['op_fill_price']:
+            return order['op_fill_price']
+
+        return super().fill_price(order, closing)
+
+    def _match_order(self, order):
+        if 'op_touch_time' in order:
+            return order['op_touch_time'] is not None \
+                and order['op_touch_time'] <= self.timer.now()
+
+        return super()._match_order(order)
+
+    @profiled('cur_price')
     def cur_price(self, ex, market, now=None):
         if not self.fast_mode:
             raise RuntimeError('FastTrader cur_price is called in non-fast mode.')
@@ -913,30 +1307,84 @@ class FastTrader(SimulatedTrader):
         self.op_execute(op)
         return op
 
-    def op_close_all_positions(self, ex, now, side='all'):
+    def op_close_all_positions(self, ex, now, side='all', market=None):
         op = {
             'name': 'close_all_positions',
             'time': now,
             'ex': ex,
-            'side': side
+            'side': side,
+            'market': market,
         }
         self.op_execute(op)
         return op
 
-    def op_cancel_all_orders(self, ex, now, side='all'):
+    def op_cancel_all_orders(self, ex, now, side='all', market=None):
         op = {
             'name': 'cancel_all_orders',
             'time': now,
             'ex': ex,
-            'side': side
+            'side': side,
+            'market': market,
         }
         self.op_execute(op)
         return op
 
+    def op_scale_order(self, order, now):
+        """ Simulate an order scaled into a ladder of limit orders like SingleEXTrader does
+            with `scale_order`. Rungs are generated by `gen_scale_orders` with seeded jitter
+            and filled by the price path of `backtest.scale_order.live_bars` indicator_tf bars
+            after `now`, unfilled rungs are assumed to be canceled then.
+            Returns (time of last fill, market order of filled amount at average price of filled rungs),
+            or None if no rung is filled.
+        """
+        ex = order['ex']
+        market = order['market']
+        conf = self._config['trading']
+        price = self.cur_price(ex, market, now)
+        sign = -1 if self.is_buy(order) else 1
+
+        rungs = gen_scale_orders(market, 'limit', order['side'], order['amount'],
+                                 min_amount=self.config['min_order_value'] / price,
+                                 start_price=price * (1 + sign * conf['scale_order_near_percent']),
+                                 end_price=price * (1 + sign * conf['scale_order_far_percent']),
+                                 max_order_count=conf['scale_order_count'],
+                                 rng=self._scale_rng)
+
+        prices = np.array([rung['price'] for rung in rungs])
+        amounts = np.array([rung['amount'] for rung in rungs])
+
+        live = tf_td(self.config['indicator_tf']) * self._config['backtest']['scale_order']['live_bars']
+        ohlcv = self.ohlcvs[ex][market][self.trigger_tfs[ex]]
+        ohlcv = ohlcv[now + timedelta(seconds=1):now + live - timedelta(seconds=1)]
+
+        idxs = ladder_fills(ohlcv.low.values, ohlcv.high.values, order['side'], prices)
+        filled = idxs >= 0
+
+        if not filled.any():
+            return None
+
+        order = copy.deepcopy(order)
+        order['amount'] = amounts[filled].sum()
+        order['op_fill_price'] = (prices[filled] * amounts[filled]).sum() / order['amount']
+
+        return ohlcv.index[idxs[filled].max()], order
+
     def op_order_count(self):
         self._op_order_count += 1
         return self._op_order_count
 
+    def op_account_value(self, ex, curr, now):
+        """ Value of op_wallet and op margin positions (closed at price of `now`) in `curr`. """
+        value = self.op_wallet[ex][curr]
+
+        for order in self.op_positions[ex].values():
+            if self.trading_currency(order=order) == curr:
+                _, earn = self.op_calc_cost_earn(order, self.cur_price(ex, order['market'], now))
+                value += earn
+
+        return value
+
+    @profiled('op_execute')
     def op_execute(self, op):
         """ Roughly calculate balance and maintain op_wallet. """
         now = op['time']
@@ -944,14 +1392,14 @@ class FastTrader(SimulatedTrader):
         # Execute previous limit orders
         executed = []
         for ex, orders in self.op_orders.items():
-            for _, order in orders:
+            for _, order in orders.items():
                 if self.op_match_limit_order(order, now):
-                    self.op_execute_open_order(order, order['op_open_price'])
+                    self.op_execute_open_order(order, order['open_price'])
                     executed.append(order)
 
         # Delete executed orders
         for order in executed:
-            del self.op_orders[order['op_#']]
+            del self.op_orders[order['ex']][order['op_#']]
 
         # Execute open_order
         if op['name'] == 'open_order':
@@ -962,11 +1410,11 @@ class FastTrader(SimulatedTrader):
                 # If order type is limit, just put the order in the queue.
                 # It'll be executed when op_execute is called.
                 # Question: Should balance be preserved (substracted) before execution?
-                self.op_orders[order['op_#']] = order
+                self.op_orders[order['ex']][order['op_#']] = order
 
             else:  # order type: market
                 # Execute market orders immediately
-                price = self.cur_price(order['ex'], order['market'], now)
+                price = order.get('op_fill_price') or self.cur_price(order['ex'], order['market'], now)
                 self.op_execute_open_order(order, price)
 
         elif op['name'] == 'close_position':
@@ -992,18 +1440,24 @@ class FastTrader(SimulatedTrader):
             # Only limit order can be canceled
             # Balance is not preserved at open, so no need to restore balance.
             order = op['order']
-            if order['order_type'] == 'limit' and order['op_#'] in self.op_orders:
-                del self.op_orders[order['op_#']]
+            if order['order_type'] == 'limit' and order['op_#'] in self.op_orders[order['ex']]:
+                del self.op_orders[order['ex']][order['op_#']]
 
         elif op['name'] == 'close_all_positions':
             positions = deepcopy(self.op_positions[op['ex']])
             for id, order in positions.items():
+                if op['market'] and order['market'] != op['market']:
+                    continue
+
                 if op['side'] == 'all' or order['side'] == op['side']:
                     self.op_close_position(order, now)
 
         elif op['name'] == 'cancel_all_orders':
             orders = deepcopy(self.op_orders[op['ex']])
             for id, order in orders.items():
+                if op['market'] and order['market'] != op['market']:
+                    continue
+
                 if op['side'] == 'all' or order['side'] == op['side']:
                     self.op_cancel_order(order, now)
 
@@ -1072,6 +1526,12 @@ class FastTrader(SimulatedTrader):
     def op_match_limit_order(self, order, now):
         ex = order['ex']
         market = order['market']
+        intrabar = self.intrabar(ex, market)
+
+        if intrabar:
+            start = order['op_open_time'] + timedelta(seconds=1)
+            return intrabar.first_touch(order['open_price'], self.is_buy(order), start, now) is not None
+
         tf = self.latest_ohlcv_timeframe(ex, market, now)
 
         # Get the ohlcv between open time and now
@@ -1082,4 +1542,295 @@ class FastTrader(SimulatedTrader):
         elif self.is_sell(order) and (ohlcv.close >= order['open_price']).any():
             return True
 
-        return False
\ No newline at end of file
+        return False
+
+
+class TickTrader(SimulatedTrader):
+    """ SimulatedTrader which matches orders against individual trades fed by `feed_trade`.
+        Market orders are filled at the first trade after they are placed, limit orders
+        and stops are triggered by trades crossing their price, and stops are filled
+        at the price of the crossing trade.
+        Fill prices are compared with the ones of ohlcv model (SimulatedTrader) to report slippage.
+    """
+
+    def _init(self):
+        super()._init()
+        self.fills = [] # (market, side, amount, price, ohlcv model price)
+        self._prints = {} # (ex, market) -> prices of trades fed since last tick
+
+    def _trigger_feed(self, ex, market):
+        return ('trade', ex, market), 'price', 'price'
+
+    def _execute_orders(self):
+        # Every market is checked, so trades since last tick are known for market orders
+        for ex, markets in self.markets.items():
+            for market in markets:
+                self._get_book(ex, market)
+
+        self._prints = {}
+        super()._execute_orders()
+
+    def _tick_bars(self, ex, market):
+        bars = super()._tick_bars(ex, market)
+        self._prints[(ex, market)] = bars[0] if bars is not None else None
+        return bars
+
+    def fill_price(self, order, closing=False):
+        model_price = super().fill_price(order, closing)
+        prints = self._prints.get((order['ex'], order['market']))
+
+        if prints is not None:
+            price = prints[0]
+        elif len(self.trades[order['ex']][order['market']]) > 0:
+            price = self.trades[order['ex']][order['market']]['price'].iloc[-1]
+        else:
+            price = model_price
+
+        self._record_fill(order, closing, price, model_price)
+        return price
+
+    def stop_fill_price(self, position, level):
+        prints = self._prints.get((position['ex'], position['market']))
+        price = level
+
+        if prints is not None:
+            # Stops of long positions are triggered by falling price
+            crossed = prints <= level if self.is_buy(position) else prints >= level
+
+            if crossed.any():
+                price = prints[np.argmax(crossed)]
+
+        self._record_fill(position, True, price, level)
+        return price
+
+    def _record_fill(self, order, closing, price, model_price):
+        side = order['side']
+
+        if closing:
+            side = 'sell' if self.is_buy(order) else 'buy'
+
+        self.fills.append((order['market'], side, order['amount'], price, model_price))
+
+    def slippage_report(self):
+        """ Slippage of fills against ohlcv model, positive values are worse than the model.
+            Returns {
+                '#_fills': int,
+                'mean(bps)': float,
+                'max(bps)': float,
+                'cost': float, total extra cost in quote currency
+            }
+        """
+        if not self.fills:
+            return {'#_fills': 0, 'mean(bps)': 0, 'max(bps)': 0, 'cost': 0}
+
+        _, sides, amounts, prices, model_prices = zip(*self.fills)
+        sign = np.where(np.array(sides) == 'buy', 1, -1)
+        model_prices = np.array(model_prices, dtype=float)
+        diff = sign * (np.array(prices, dtype=float) - model_prices)
+        bps = diff / model_prices * 10000
+
+        return {
+            '#_fills': len(self.fills),
+            'mean(bps)': float(bps.mean()),
+            'max(bps)': float(bps.max()),
+            'cost': float((diff * np.array(amounts, dtype=float)).sum()),
+        }
+
+
+class IntrabarIndex():
+    """ Finds when a price is first touched within bars of a parent timeframe (indicator_tf)
+        at 1m resolution. Parent bars are checked with their high/low first and 1m sub-bars
+        are only scanned for the parent bars which touch the price, so a backtest doesn't
+        have to replay all 1m bars.
+        Time ranges are given as [start, end] of parent bar labels like `ohlcv[start:end]`.
+    """
+
+    def __init__(self, sub_ohlcv, parent_ohlcv, parent_tf):
+        self.times = parent_ohlcv.index.values
+        self.highs = parent_ohlcv.high.values
+        self.lows = parent_ohlcv.low.values
+
+        self.sub_times = sub_ohlcv.index.values
+        self.sub_highs = sub_ohlcv.high.values
+        self.sub_lows = sub_ohlcv.low.values
+
+        # Sub-bars of parent bar i are in [starts[i], ends[i])
+        self.starts = np.searchsorted(self.sub_times, self.times, side='left')
+        self.ends = np.searchsorted(self.sub_times, self.times + np.timedelta64(tf_td(parent_tf)), side='left')
+
+    def _bar_range(self, start, end=None):
+        """ Positions of parent bars labeled in [start, end], `end` is None for no limit. """
+        i0 = np.searchsorted(self.times, np.datetime64(start), side='left')
+        i1 = np.searchsorted(self.times, np.datetime64(end), side='right') \
+             if end is not None else len(self.times)
+        return i0, i1
+
+    def first_touch(self, price, falling, start, end):
+        """ Returns time of the first 1m bar reaching `price`, or None.
+            Param
+                falling: bool, True if triggered when price falls to `price`
+                    (buy limit orders, stops of long positions), else when price rises to it
+        """
+        i0, i1 = self._bar_range(start, end)
+
+        if falling:
+            hit = self.lows[i0:i1] <= price
+        else:
+            hit = self.highs[i0:i1] >= price
+
+        for i in i0 + np.flatnonzero(hit):
+            lo, hi = self.starts[i], self.ends[i]
+
+            if lo == hi: # no 1m data of this bar
+                return pd.Timestamp(self.times[i])
+
+            if falling:
+                sub_hit = self.sub_lows[lo:hi] <= price
+            else:
+                sub_hit = self.sub_highs[lo:hi] >= price
+
+            if sub_hit.any():
+                return pd.Timestamp(self.sub_times[lo + np.argmax(sub_hit)])
+
+        return None
+
+    def first_trailing_touch(self, open_price, diff, long, start, end):
+        """ Returns (time, stop price) of the first 1m bar hitting a trailing stop, or None.
+            The stop trails the highest (long) or lowest (short) price since `start` by `diff`
+            and is only active beyond `open_price`.
+        """
+        i0, i1 = self._bar_range(start, end)
+
+        # Short positions are handled as long ones with negative prices
+        sign = 1 if long else -1
+        ups, downs = (self.highs, self.lows) if long else (self.lows, self.highs)
+        sub_ups, sub_downs = (self.sub_highs, self.sub_lows) if long else (self.sub_lows, self.sub_highs)
+
+        trail = np.maximum.accumulate(sign * ups[i0:i1])
+        levels = trail - diff
+        hit = (levels > sign * open_price) & (sign * downs[i0:i1] <= levels)
+
+        # Running high before each parent bar is exact, the one of parent bar itself
+        # is an upper bound of sub-bars', so a sub-bar can only hit where its parent bar hits.
+        prev_trail = np.concatenate([[-np.inf], trail[:-1]])
+
+        for j in np.flatnonzero(hit):
+            i = i0 + j
+            lo, hi = self.starts[i], self.ends[i]
+
+            if lo == hi: # no 1m data of this bar
+                return pd.Timestamp(self.times[i]), sign * levels[j]
+
+            sub_trail = np.maximum.accumulate(np.maximum(sign * sub_ups[lo:hi], prev_trail[j]))
+            sub_levels = sub_trail - diff
+            sub_hit = (sub_levels > sign * open_price) & (sign * sub_downs[lo:hi] <= sub_levels)
+
+            if sub_hit.any():
+                k = np.argmax(sub_hit)
+                return pd.Timestamp(self.sub_times[lo + k]), sign * sub_levels[k]
+
+        return None
+
+
+class BacktestPruned(Exception):
+    """ Raised by a trader when a backtest is aborted by BacktestPruner. """
+    pass
+
+
+class BacktestPruner():
+    """ Abort a backtest early at checkpoints when it can't be one of the best param sets.
+        A run is pruned at a checkpoint if
+            - account value has dropped `max_drawdown` (%) from its peak, or
+            - no order has been executed (if `no_trade` is enabled), or
+            - PL extrapolated to the whole period multiplied by `optimism`
+              is still under `threshold` (PL(%) of the K-th best param set so far)
+    """
+
+    def __init__(self, start, end, initial_value, threshold=None, custom_config=None):
+        _config = custom_config or config
+        self.config = _config['backtest']['pruning']
+        self.start = start
+        self.end = end
+        self.initial_value = initial_value
+        self.peak_value = initial_value
+        self.threshold = threshold
+        self.checkpoints = [start + (end - start) * ratio
+                            for ratio in sorted(self.config['checkpoints'])]
+
+    def check(self, trader, now):
+        if not self.checkpoints or now < self.checkpoints[0]:
+            return
+
+        while self.checkpoints and self.checkpoints[0] <= now:
+            self.checkpoints.pop(0)
+
+        reason = self._check(trader, now)
+        if reason:
+            raise BacktestPruned(reason)
+
+    def _check(self, trader, now):
+        value = trader.account_value()
+        self.peak_value = max(self.peak_value, value)
+
+        drawdown = (self.peak_value - value) / self.peak_value * 100
+        if drawdown >= self.config['max_drawdown']:
+            return f"drawdown {drawdown:.2f}% at {now}"
+
+        if self.config['no_trade'] and not self._has_traded(trader):
+            return f"no trade until {now}"
+
+        if self.threshold is not None:
+            ratio = (now - self.start) / (self.end - self.start)
+            gain = value / self.initial_value
+
+            if gain <= 0:
+                return f"account is empty at {now}"
+
+            best_case = (gain ** (1 / ratio) * self.config['optimism'] - 1) * 100
+            if best_case < self.threshold:
+                return f"best case PL {best_case:.2f}% < {self.threshold:.2f}% at {now}"
+
+        return None
+
+    @staticmethod
+    def _has_traded(trader):
+        for ex in trader.markets:
+            if len(trader.order_history[ex]) > 0 or len(trader.positions[ex]) > 0:
+                return True
+        return False
+
+
+def ladder_fills(lows, highs, side, prices):
+    """ Returns position of the bar every rung of a ladder of limit orders is filled at,
+        or -1 if it's not filled. Buy rungs are filled when price falls to them,
+        sell rungs when price rises to them.
+    """
+    # Running extreme price is monotonic, so all rungs are searched at once
+    if side == 'buy':
+        reached = -np.minimum.accumulate(lows)
+        idxs = np.searchsorted(reached, -prices, side='left')
+    else:
+        reached = np.maximum.accumulate(highs)
+        idxs = np.searchsorted(reached, prices, side='left')
+
+    return np.where(idxs < len(reached), idxs, -1)
+
+
+def trailing_stop_hits(position, highs, lows):
+    """ Trailing stop levels of a position after each bar and whether the bar hits the stop.
+        The stop trails the highest (long) or lowest (short) price since open by
+        `open_price * stop_profit`, and is only active beyond open price.
+    """
+    P = position['open_price']
+    diff = P * position['stop_profit']
+
+    if position['side'] == 'buy':
+        trail = np.maximum.accumulate(np.maximum(highs, position['trail_price']))
+        levels = trail - diff
+        hit = (levels > P) & (lows <= levels)
+    else:
+        trail = np.minimum.accumulate(np.minimum(lows, position['trail_price']))
+        levels = trail + diff
+        hit = (levels < P) & (highs >= levels)
+
+    return levels, hit
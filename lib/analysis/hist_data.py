@@ -1,10 +1,11 @@
 from datetime import datetime
 
+import asyncio
 import logging
+import numpy as np
 import pandas as pd
 
 from utils import \
-    sec_ms, \
     ms_sec,\
     tf_td,\
     ms_dt,\
@@ -13,7 +14,9 @@ from utils import \
     MAX_DT, \
     timeframe_to_freq,\
     handle_ccxt_request, \
-    ohlcv_to_interval, \
+    ohlcv_to_intervals, \
+    ex_name, \
+    rsym, \
     true_symbol
 
 from db import EXMongo
@@ -153,8 +156,31 @@ def is_empty_response(err):
     return True if str(err).find('empty response') >= 0 else False
 
 
-async def find_missing_ohlcv(coll, start, end, timeframe):
+def ohlcv_gaps(timestamps, start, end, td):
+    """ Ranges of missing ohlcv in [start, end) of a timeframe, ohlcv are expected
+        at every `td` from `start`.
+        Param
+            timestamps: sorted int64 array of ohlcv in [start, end)
+            start, end, td: int, ms
+        Returns int64 array of [gap_start, gap_end) rows.
+    """
+    # Pad with the ohlcv before `start` and after the last expected one before `end`
+    last = start + (end - start - 1) // td * td
+    ts = np.concatenate([[start - td], np.asarray(timestamps, dtype=np.int64), [last + td]])
+
+    at = np.flatnonzero(np.diff(ts) > td)
+    return np.stack([ts[at] + td, ts[at + 1]], axis=1)
+
+
+def gap_timestamps(gaps, td):
+    """ Timestamps (ms) of missing ohlcv in `gaps` of ohlcv_gaps. """
+    counts = (gaps[:, 1] - gaps[:, 0] + td - 1) // td
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(gaps[:, 0], counts) + offsets * td
+
 
+async def find_missing_ohlcv(coll, start, end, timeframe):
+    """ Returns list of timestamps (ms) of missing ohlcv in a collection. """
     start = dt_ms(start)
     end = dt_ms(end)
 
@@ -162,67 +188,114 @@ async def find_missing_ohlcv(coll, start, end, timeframe):
             coll, ['timestamp', 'open', 'close', 'high', 'low', 'volume']):
         raise ValueError('Collection\'s fields do not match candle\'s.')
 
-    td = tf_td(timeframe)
-    td = sec_ms(td.seconds)
+    td = int(tf_td(timeframe).total_seconds()) * 1000
 
-    prev_ts = start - td
-    ts = None
+    docs = await coll.find(
+        {'timestamp': {'$gte': start, '$lt': end}},
+        {'timestamp': 1, '_id': 0}).sort('timestamp', 1).to_list(length=None)
+    timestamps = np.fromiter((doc['timestamp'] for doc in docs), dtype=np.int64, count=len(docs))
 
-    res = coll.find({
-        'timestamp': {
-            '$gte': start,
-            '$lt': end
-        }
-    }).sort('timestamp', 1)
+    return gap_timestamps(ohlcv_gaps(timestamps, start, end, td), td).tolist()
 
-    missing_ohlcv = []
-    async for ohlcv in res:
-        ts = ohlcv['timestamp']
-        while prev_ts + td <= ts:
-            if prev_ts + td != ts:
-                missing_ohlcv.append(prev_ts + td)
-            prev_ts += td
 
-    ts = end - 1
-    while prev_ts + td <= ts:
-        if prev_ts + td != ts:
-            missing_ohlcv.append(prev_ts + td)
-        prev_ts += td
+async def find_ohlcv_gaps(mongo, ex, symbol, timeframe, start, end, save=True):
+    """ Find ranges of missing ohlcv in [start, end) and save them to `{ex}_gaps`,
+        gaps saved before which overlap the range are replaced.
+        Returns int64 array of [gap_start, gap_end) rows in ms.
+    """
+    ex = ex_name(ex)
+    start = dt_ms(start)
+    end = dt_ms(end)
+    td = int(tf_td(timeframe).total_seconds()) * 1000
 
-    return missing_ohlcv
+    arrays = await mongo._read_ohlcv_arrays(
+        f"{ex}_ohlcv_{rsym(symbol)}_{timeframe}", start, end, {'timestamp': np.int64})
+    gaps = ohlcv_gaps(arrays['timestamp'], start, end, td)
 
+    if save:
+        await mongo.set_ohlcv_gaps(ex, symbol, timeframe, gaps, start, end)
 
-async def fill_missing_ohlcv(mongo, ex, symbol, start, end, timeframe):
-    def fill_ohlcv(df):
-        for i in range(len(df)):
-            row = df.iloc[i]
-            if pd.isna(row.close):
-                if i == 0:
-                    raise ValueError("Starting ohlcv is empty.")
-
-                c = df.iloc[i - 1].close
-                row.open = row.close = c
-                row.high = row.low = c
-                row.volume = 0
+    return gaps
 
+
+def fill_ohlcv_gaps(ohlcv):
+    """ Fill missing (NaN) ohlcv with close of the previous ohlcv and zero volume. """
+    missing = ohlcv.close.isna().values
+
+    if len(ohlcv) > 0 and missing[0]:
+        raise ValueError("Starting ohlcv is empty.")
+
+    close = ohlcv.close.ffill()
+    for col in ['open', 'high', 'low']:
+        ohlcv[col] = ohlcv[col].where(~missing, close)
+    ohlcv['close'] = close
+    ohlcv['volume'] = ohlcv.volume.where(~missing, 0)
+
+    return ohlcv
+
+
+async def fill_missing_ohlcv(mongo, ex, symbol, start, end, timeframe):
     df = await mongo.get_ohlcv(ex, symbol, timeframe, start, end)
     df = df.asfreq(timeframe_to_freq(timeframe))
 
-    fill_ohlcv(df)
-    return df
+    return fill_ohlcv_gaps(df)
 
 
 async def build_ohlcv(mongo, ex, symbol, src_tf, target_tf, *,
                       start=None, end=None, coll_prefix='', upsert=True):
+    """ Build ohlcv of `target_tf` from `src_tf` ohlcv,
+        `target_tf` can be a list of timeframes, which are all built from one read of source.
+        With `database.server_side_resample`, every timeframe is resampled inside mongo instead.
+    """
     start = start or MIN_DT
     end = end or MAX_DT
-
-    src_df = await mongo.get_ohlcv(ex, symbol, src_tf, start, end)
-    target_td = tf_td(target_tf)
-    target_df = ohlcv_to_interval(src_df, src_tf, target_td)
-
-    await mongo.insert_ohlcv(
-        target_df, ex, symbol, target_tf, coll_prefix=coll_prefix, upsert=upsert)
+    target_tfs = target_tf if isinstance(target_tf, list) else [target_tf]
+
+    if mongo.config['server_side_resample']:
+        target_dfs = {}
+        for tf in target_tfs:
+            target_dfs[tf_td(tf)] = await mongo.resample_ohlcv(ex, symbol, src_tf, tf, start, end)
+    else:
+        src_df = await mongo.get_ohlcv(ex, symbol, src_tf, start, end)
+        target_dfs = ohlcv_to_intervals(src_df, src_tf, [tf_td(tf) for tf in target_tfs])
+
+    for tf in target_tfs:
+        await mongo.insert_ohlcv(
+            target_dfs[tf_td(tf)], ex, symbol, tf, coll_prefix=coll_prefix, upsert=upsert)
+
+
+async def build_ohlcv_incremental(mongo, ex, symbol, src_tf, target_tfs, coll_prefix=''):
+    """ Build ohlcvs of `target_tfs` from where the last build stopped.
+        Only source ohlcv since the earliest build watermark is read and only bars
+        from the watermark of every timeframe are rebuilt. The watermark is the start of
+        the last built bar, which may be incomplete and is rebuilt on next build.
+        With `database.server_side_resample`, every timeframe is resampled inside mongo instead.
+    """
+    watermarks = await mongo.get_build_watermarks(ex, symbol, target_tfs, coll_prefix=coll_prefix)
+    start = min(watermarks.values())
+
+    if mongo.config['server_side_resample']:
+        target_dfs = {}
+        for tf in target_tfs:
+            target_dfs[tf_td(tf)] = await mongo.resample_ohlcv(
+                ex, symbol, src_tf, tf, start, MAX_DT, coll_prefix=coll_prefix)
+    else:
+        src_df = await mongo.get_ohlcv(ex, symbol, src_tf, start, MAX_DT, coll_prefix=coll_prefix)
+        target_dfs = ohlcv_to_intervals(src_df, src_tf, [tf_td(tf) for tf in target_tfs])
+
+    new_watermarks = {}
+    ops = []
+    for tf in target_tfs:
+        target_df = target_dfs[tf_td(tf)]
+        target_df = target_df[target_df.index >= watermarks[tf]]
+
+        if len(target_df) > 0:
+            new_watermarks[tf] = target_df.index[-1]
+            ops.append(mongo.insert_ohlcv(target_df, ex, symbol, tf,
+                                          coll_prefix=coll_prefix, upsert=True))
+
+    await asyncio.gather(*ops)
+    await mongo.set_build_watermarks(ex, symbol, new_watermarks, coll_prefix=coll_prefix)
 
 
 async def compare_ohlcvs(mongo, ex, symbol, tf, prefix_1, prefix_2):
@@ -0,0 +1,160 @@
+import cProfile
+import functools
+import logging
+import os
+import random
+import time
+import tracemalloc
+
+logger = logging.getLogger('pyct')
+
+_active = None # profiler of the running backtest, None if profiling is disabled
+
+
+class Profiler():
+    """ Wall time, number of calls and allocated memory of named phases of a backtest.
+        Phases are functions decorated with `profiled` or blocks wrapped in `phase`,
+        they are only measured inside `with Profiler(enable=True):`, otherwise
+        they only cost a check of the active profiler.
+        Time of a phase includes time of phases called inside it.
+    """
+
+    def __init__(self, enable=True, track_memory=False):
+        """ Param
+                track_memory: bool, trace allocated memory with tracemalloc,
+                    slows down a backtest several times
+        """
+        self.enable = enable
+        self.track_memory = track_memory
+        self.stats = {}
+        self._prev = None
+        self._tracing = False
+
+    def __enter__(self):
+        global _active
+
+        if self.enable:
+            self._prev = _active
+            _active = self
+
+            if self.track_memory and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._tracing = True
+
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+
+        if self.enable:
+            _active = self._prev
+
+            if self._tracing:
+                tracemalloc.stop()
+                self._tracing = False
+
+    def _start(self):
+        mem = tracemalloc.get_traced_memory()[0] if self.track_memory else 0
+        return time.perf_counter(), mem
+
+    def _stop(self, name, start):
+        secs = time.perf_counter() - start[0]
+        mem = tracemalloc.get_traced_memory()[0] - start[1] if self.track_memory else 0
+
+        stat = self.stats.get(name)
+        if stat is None:
+            stat = self.stats[name] = [0, 0.0, 0]
+
+        stat[0] += 1
+        stat[1] += secs
+        stat[2] += max(mem, 0)
+
+    def report(self):
+        """ Returns {phase: {'#_calls', 'time(s)', 'alloc(MB)'}} sorted by time in descending order,
+            `alloc(MB)` is memory still allocated when a phase returns (only with `track_memory`).
+        """
+        report = {}
+
+        for name, (calls, secs, mem) in sorted(self.stats.items(), key=lambda kv: -kv[1][1]):
+            report[name] = {
+                '#_calls': calls,
+                'time(s)': round(secs, 6),
+            }
+
+            if self.track_memory:
+                report[name]['alloc(MB)'] = round(mem / 1024 / 1024, 3)
+
+        return report
+
+
+class _Phase():
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = self.profiler._start()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler._stop(self.name, self.start)
+
+
+class _NoPhase():
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_no_phase = _NoPhase()
+
+
+def phase(name):
+    """ Context manager measuring a block as phase `name`. """
+    return _no_phase if _active is None else _Phase(_active, name)
+
+
+def profiled(name):
+    """ Decorator measuring every call of a function as phase `name`. """
+    def decorator(func):
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profiler = _active
+            if profiler is None:
+                return func(*args, **kwargs)
+
+            start = profiler._start()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler._stop(name, start)
+
+        return wrapper
+    return decorator
+
+
+def cprofile_sampled(key, rate, seed=0):
+    """ Whether run `key` (eg. param index) is sampled to be profiled with cProfile,
+        the same key is always sampled the same way.
+    """
+    return rate > 0 and random.Random(f"{seed}:{key}").random() < rate
+
+
+def run_cprofile(func, path):
+    """ Call `func` under cProfile and dump pstats to `path`, returns result of `func`. """
+    prof = cProfile.Profile()
+    prof.enable()
+
+    try:
+        return func()
+    finally:
+        prof.disable()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        prof.dump_stats(path)
+        logger.debug(f"cProfile stats are saved to {path}")
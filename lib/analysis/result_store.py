@@ -0,0 +1,200 @@
+import json
+import logging
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+from utils import config, rsym
+
+logger = logging.getLogger('pyct')
+
+
+class ResultStore():
+    """ Local columnar store of optimization results.
+        Every backtested param set is appended as one fixed size record to a binary file
+        and read back with numpy memmap, one partition per name/ex/symbol/period:
+            {result_store_dir}/{name}/{ex}/{symbol}/{start}_{end}/results.bin
+    """
+
+    fields = [
+        ('param_idx', np.int64),
+        ('PL(%)', np.float64),
+        ('PL_Eff', np.float64),
+        ('#P', np.int32),
+        ('#L', np.int32),
+        ('max_drawdown(%)', np.float64),
+        ('pruned', np.bool_),
+    ]
+
+    dtype = np.dtype(fields)
+
+    def __init__(self, name, ex, symbol, period, custom_config=None):
+        self._config = custom_config or config
+        self.name = name
+        self.ex = ex
+        self.symbol = symbol
+        self.period = period
+
+        start, end = period
+        self.dir = os.path.join(
+            self._config['analysis']['result_store_dir'],
+            name or 'default', ex, rsym(symbol),
+            f"{start:%Y%m%d%H%M}_{end:%Y%m%d%H%M}")
+        self.data_file = os.path.join(self.dir, 'results.bin')
+        self.meta_file = os.path.join(self.dir, 'meta.json')
+
+    def append(self, reports):
+        """ Append a list of [idx, report]. """
+        if not reports:
+            return
+
+        recs = np.empty(len(reports), dtype=self.dtype)
+        recs['param_idx'] = [idx for idx, _ in reports]
+        recs['PL(%)'] = [rep['PL(%)'] for _, rep in reports]
+        recs['PL_Eff'] = [rep['PL_Eff'] for _, rep in reports]
+        recs['#P'] = [rep['#_profit_trades'] for _, rep in reports]
+        recs['#L'] = [rep['#_loss_trades'] for _, rep in reports]
+        recs['max_drawdown(%)'] = [rep.get('max_drawdown(%)', np.nan) for _, rep in reports]
+        recs['pruned'] = [rep.get('pruned', False) for _, rep in reports]
+
+        self._write_meta()
+
+        with open(self.data_file, 'ab') as f:
+            recs.tofile(f)
+
+    def load(self, unique=True):
+        """ Returns all records as a structured array (read only).
+            If `unique` is True, only the last record of each param_idx is kept
+            and records are sorted by param_idx.
+        """
+        if not os.path.exists(self.data_file) or os.path.getsize(self.data_file) == 0:
+            return np.empty(0, dtype=self.dtype)
+
+        self._check_meta()
+
+        n_recs = os.path.getsize(self.data_file) // self.dtype.itemsize
+        recs = np.memmap(self.data_file, dtype=self.dtype, mode='r', shape=(n_recs,))
+
+        if unique:
+            # A param set may be appended twice when an optimization is resumed
+            rev = recs[::-1]
+            _, pos = np.unique(rev['param_idx'], return_index=True)
+            recs = rev[pos]
+
+        return recs
+
+    def clear(self):
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+
+    def __len__(self):
+        return len(self.load())
+
+    def top_k(self, k, by='PL(%)', include_pruned=False):
+        """ Returns k records with largest `by` value as a DataFrame, sorted in descending order.
+            Pruned runs are excluded by default because their results are incomplete.
+        """
+        recs = self.load()
+        recs = recs if include_pruned else recs[~recs['pruned']]
+        return pd.DataFrame(recs[self._top_k_pos(recs[by], k)], columns=self.dtype.names)
+
+    def best(self, by='PL(%)'):
+        """ Returns the complete run with largest `by` value as a dict, or None if there is none. """
+        recs = self.load()
+        recs = recs[~recs['pruned']]
+        top = self._top_k_pos(recs[by], 1)
+
+        if len(top) == 0:
+            return None
+
+        return {col: recs[col][top[0]].item() for col in self.dtype.names}
+
+    @staticmethod
+    def _top_k_pos(vals, k):
+        k = min(k, len(vals))
+
+        if k == 0:
+            return np.empty(0, dtype=np.int64)
+
+        vals = np.where(np.isnan(vals), -np.inf, vals)
+        top = np.argpartition(-vals, k - 1)[:k]
+        return top[np.argsort(-vals[top], kind='stable')]
+
+    def marginal_effect(self, grid, by='PL(%)', include_pruned=False):
+        """ Aggregate `by` over every value of every axis of the grid.
+            Returns a dict of DataFrame by column, indexed by axis value,
+            with columns `mean`, `max` and `count`. Pruned runs are excluded by default.
+        """
+        recs = self.load()
+        recs = recs if include_pruned else recs[~recs['pruned']]
+        vals = recs[by]
+        pos = grid.positions(recs['param_idx'])
+        effects = {}
+
+        for i, col in enumerate(grid.columns):
+            n = grid.radix[i]
+            effects[col] = pd.DataFrame(
+                self._aggregate(pos[:, i], vals, n),
+                index=pd.Index(grid.axes[i], name=col))
+
+        return effects
+
+    def heatmap(self, grid, col_x, col_y, by='PL(%)', agg='mean', include_pruned=False):
+        """ Aggregate `by` over every combination of values of two axes.
+            Returns a DataFrame indexed by values of `col_y` with columns of values of `col_x`.
+            Pruned runs are excluded by default.
+        """
+        if agg not in ('mean', 'max', 'count'):
+            raise ValueError(f"Unknown aggregation {agg}")
+
+        recs = self.load()
+        recs = recs if include_pruned else recs[~recs['pruned']]
+        x = grid.columns.index(col_x)
+        y = grid.columns.index(col_y)
+        nx, ny = grid.radix[x], grid.radix[y]
+
+        pos = grid.positions(recs['param_idx'])
+        cell = pos[:, y] * nx + pos[:, x]
+        res = self._aggregate(cell, recs[by], nx * ny)[agg]
+
+        return pd.DataFrame(res.reshape(ny, nx),
+                            index=pd.Index(grid.axes[y], name=col_y),
+                            columns=pd.Index(grid.axes[x], name=col_x))
+
+    @staticmethod
+    def _aggregate(bins, vals, n):
+        """ Returns mean, max and count of `vals` grouped by `bins` in range [0, n). """
+        count = np.bincount(bins, minlength=n)
+        total = np.bincount(bins, weights=vals, minlength=n)
+        maximum = np.full(n, np.nan)
+        np.fmax.at(maximum, bins, vals)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count
+
+        return {'mean': mean, 'max': maximum, 'count': count}
+
+    def _write_meta(self):
+        if os.path.exists(self.meta_file):
+            return
+
+        os.makedirs(self.dir, exist_ok=True)
+
+        with open(self.meta_file, 'w') as f:
+            json.dump({
+                'name': self.name,
+                'ex': self.ex,
+                'symbol': self.symbol,
+                'start': str(self.period[0]),
+                'end': str(self.period[1]),
+                'dtype': self.dtype.descr,
+            }, f, indent=2)
+
+    def _check_meta(self):
+        with open(self.meta_file) as f:
+            meta = json.load(f)
+
+        if [tuple(d) for d in meta['dtype']] != self.dtype.descr:
+            raise RuntimeError(f"Result store {self.dir} has a different record layout, "
+                               f"it needs to be removed and optimized again.")
@@ -0,0 +1,150 @@
+import logging
+import numpy as np
+import pandas as pd
+
+from utils import config
+
+logger = logging.getLogger('pyct')
+
+
+class RobustnessAnalyzer():
+    """ Distribution of backtest outcomes of one param set, estimated from the
+        closed margin positions of a backtest instead of running it again.
+        Every resample is a sequence of trades drawn by block bootstrap (blocks of
+        consecutive trades keep short term dependency), and entry of every trade may be
+        delayed by a few bars, which changes its PL by the price difference.
+        All resamples are computed at once as matrices of (resample, trade).
+    """
+
+    def __init__(self, orders, initial_value, ohlcvs=None, custom_config=None):
+        """ Param
+                orders: list of order dict from trader's order_history
+                initial_value: float, account value at start of the backtest
+                ohlcvs: dict of DataFrame by market (optional), price path entry delays are drawn from,
+                    delays are disabled if not provided
+        """
+        self._config = custom_config or config
+        self.config = self._config['analysis']['robustness']
+        self.initial_value = initial_value
+
+        orders = [
+            order for order in orders
+            if order['margin'] and not order['canceled'] and order.get('PL') is not None
+        ]
+        orders.sort(key=lambda order: order['close_time'])
+
+        self.n_trades = len(orders)
+        pls = np.array([order['PL'] for order in orders], dtype=float)
+
+        # Return of every trade relative to account value before the trade is closed
+        equity = initial_value + np.concatenate([[0], np.cumsum(pls)[:-1]])
+        self.equity_before = equity
+        self.returns = self._delayed_returns(orders, pls, ohlcvs) / equity[:, None]
+
+    @classmethod
+    def from_backtest(cls, backtest, custom_config=None):
+        """ Create from a finished Backtest, entry delays are drawn from bars of
+            the smallest timeframe.
+        """
+        trader = backtest.trader
+        orders = []
+        ohlcvs = {}
+
+        for ex, hist in trader.order_history.items():
+            orders += list(hist.values())
+
+            for market in trader.markets[ex]:
+                ohlcvs[market] = backtest.ohlcvs[ex][market][trader.trigger_tfs[ex]]
+
+        return cls(orders, backtest.report['initial_value'], ohlcvs,
+                   custom_config=custom_config or backtest._config)
+
+    def _delayed_returns(self, orders, pls, ohlcvs):
+        """ Returns PL of every trade if its entry is delayed by 0 to `max_entry_delay` bars,
+            as a matrix of (trade, delay).
+        """
+        max_delay = self.config['max_entry_delay'] if ohlcvs else 0
+        delayed = np.repeat(pls[:, None], max_delay + 1, axis=1)
+
+        if max_delay == 0:
+            return delayed
+
+        for market, ohlcv in ohlcvs.items():
+            rows = [i for i, order in enumerate(orders) if order['market'] == market]
+
+            if not rows or len(ohlcv) == 0:
+                continue
+
+            times = ohlcv.index.values
+            closes = ohlcv.close.values
+
+            open_times = np.array([orders[i]['open_time'] for i in rows], dtype='datetime64[ns]')
+            close_times = np.array([orders[i]['close_time'] for i in rows], dtype='datetime64[ns]')
+            open_prices = np.array([orders[i]['open_price'] for i in rows], dtype=float)
+            amounts = np.array([orders[i]['amount'] for i in rows], dtype=float)
+            signs = np.array([1 if orders[i]['side'] == 'buy' else -1 for i in rows])
+
+            # Entry can't be delayed beyond the last bar before the position is closed
+            first = np.searchsorted(times, open_times, side='right')
+            last = np.maximum(np.searchsorted(times, close_times, side='left') - 1, first)
+            pos = np.minimum(first[:, None] + np.arange(max_delay)[None, :], last[:, None])
+            pos = np.minimum(pos, len(times) - 1)
+
+            price_diff = open_prices[:, None] - closes[pos]
+            delayed[rows, 1:] += (signs * amounts)[:, None] * price_diff
+
+        return delayed
+
+    def resample(self, n=None, seed=None):
+        """ Returns final PL(%) and max drawdown(%) of `n` resampled trade sequences.
+            Resamples are computed in batches of `batch_size` to limit memory usage.
+        """
+        n = n or self.config['resamples']
+        seed = self.config['seed'] if seed is None else seed
+        rng = np.random.RandomState(seed)
+        batch_size = self.config['batch_size']
+
+        if self.n_trades == 0:
+            return np.zeros(n), np.zeros(n)
+
+        pls = []
+        drawdowns = []
+
+        for start in range(0, n, batch_size):
+            pl, dd = self._resample_batch(min(batch_size, n - start), rng)
+            pls.append(pl)
+            drawdowns.append(dd)
+
+        return np.concatenate(pls), np.concatenate(drawdowns)
+
+    def _resample_batch(self, n, rng):
+        n_trades = self.n_trades
+        block = max(min(self.config['block_size'], n_trades), 1)
+        n_blocks = -(-n_trades // block) # ceil
+
+        # Circular block bootstrap: blocks of consecutive trades starting at random trades
+        starts = rng.randint(0, n_trades, size=(n, n_blocks))
+        trades = (starts[:, :, None] + np.arange(block)).reshape(n, -1)[:, :n_trades] % n_trades
+
+        delays = rng.randint(0, self.returns.shape[1], size=(n, n_trades))
+        returns = self.returns[trades, delays]
+
+        equity = np.cumprod(1 + returns, axis=1)
+        equity = np.concatenate([np.ones((n, 1)), equity], axis=1)
+        peak = np.maximum.accumulate(equity, axis=1)
+
+        pl = (equity[:, -1] - 1) * 100
+        drawdown = np.max((peak - equity) / peak, axis=1) * 100
+        return pl, drawdown
+
+    def percentiles(self, n=None, seed=None):
+        """ Returns a DataFrame of percentiles (`percentiles` in config) of
+            PL(%) and max_drawdown(%) over resamples, indexed by percentile.
+        """
+        pl, drawdown = self.resample(n, seed)
+        qs = self.config['percentiles']
+
+        return pd.DataFrame({
+            'PL(%)': np.percentile(pl, qs),
+            'max_drawdown(%)': np.percentile(drawdown, qs),
+        }, index=pd.Index(qs, name='percentile'))
@@ -4,6 +4,7 @@ import copy
 import logging
 
 from analysis import Indicator
+from analysis.profiler import profiled
 from utils import config
 
 logger = logging.getLogger('pyct')
@@ -31,6 +32,8 @@ class SingleExchangeStrategy():
         self.fast_mode = False
         self.prefeed_days = 1 # time period for pre-feed data,
         # default is 1, child class can set to different ones in `init_vars()`
+        self.wake_timeframes = None # timeframes strategy reacts to in slow mode,
+        # used to skip idle ticks, default is indicator_tf
 
     def set_params(self, params):
         self.params = params
@@ -60,6 +63,14 @@ class SingleExchangeStrategy():
         """
         pass
 
+    def next_wakeup(self, now):
+        """ (Optional)
+            Implemented by user.
+            Returns the next datetime strategy needs to run at other than new bars
+            of `wake_timeframes`, or None.
+        """
+        return None
+
     def strategy(self):
         """ Implemented by user.
             Perform buy/sell actions here.
@@ -67,6 +78,7 @@ class SingleExchangeStrategy():
         """
         pass
 
+    @profiled('strategy.run')
     def run(self):
         if not self.fast_mode:
             self.strategy()
@@ -80,6 +92,7 @@ class SingleExchangeStrategy():
         """
         pass
 
+    @profiled('strategy.fast_run')
     def fast_run(self):
         if self.fast_mode:
             self.fast_strategy()
@@ -135,15 +148,16 @@ class SingleExchangeStrategy():
             raise RuntimeError("Wrong method is called in slow mode.")
         self.op_trade('sell', now, market, spend, margin, stop_loss, stop_profit)
 
-    def op_clean_orders(self, side, now):
+    def op_clean_orders(self, side, now, market=None):
         """
             Param
                 side: 'buy' / 'sell' / 'all'
+                market: str (optional), only clean orders of the market
         """
         if not self.fast_mode:
             raise RuntimeError("Wrong method is called in slow mode.")
-        self.append_op(self.trader.op_cancel_all_orders(self.ex, now))
-        self.append_op(self.trader.op_close_all_positions(self.ex, now, side=side))
+        self.append_op(self.trader.op_cancel_all_orders(self.ex, now, market=market))
+        self.append_op(self.trader.op_close_all_positions(self.ex, now, side=side, market=market))
 
     def op_trade(self, side, now, market, spend, margin=False, stop_loss=None, stop_profit=None):
         ## TODO: Add BTC pairs value conversion or more precised min value restraint
@@ -160,6 +174,15 @@ class SingleExchangeStrategy():
                                            stop_loss=stop_loss,
                                            stop_profit=stop_profit)
 
+        if self._config['backtest']['scale_order']['enable']:
+            # Filled part of the ladder is opened at once when its last rung is filled
+            fill = self.trader.op_scale_order(order, now)
+
+            if fill is None:
+                return
+
+            now, order = fill
+
         self.append_op(self.trader.op_open(order, now))
 
     def calc_market_amount(self, side, market, spend, margin=False, now=None):
@@ -186,6 +209,20 @@ class SingleExchangeStrategy():
             for _, pos in positions.items():
 
                 start = pos['op_open_time'] + timedelta(seconds=1)
+                intrabar = self.trader.intrabar(self.ex, pos['market'])
+
+                if intrabar:
+                    stop = self.intrabar_position_stop(intrabar, pos, start, end)
+
+                    if stop:
+                        pos['op_close_time'], pos['op_close_price'] = stop
+                        self.append_op(self.trader.op_close_position(pos, pos['op_close_time']))
+
+                        if self._config['mode'] == 'debug':
+                            logger.debug(f"Stop {pos['side']} @ {pos['op_close_price']:.3f} ({pos['op_close_time']})")
+
+                    continue
+
                 ohlcv = self.trader.ohlcvs[self.ex][pos['market']][self.trader.config['indicator_tf']][start:end]
 
                 if len(ohlcv) > 0:
@@ -256,6 +293,30 @@ class SingleExchangeStrategy():
                             if self._config['mode'] == 'debug':
                                 logger.debug(f"Stop {pos['side']} profit @ {pos['op_close_price']:.3f} ({pos['op_close_time']})")
 
+    @staticmethod
+    def intrabar_position_stop(intrabar, pos, start, end):
+        """ Returns (time, price) of the earlier one of stop loss and
+            stop profit (trailing stop) found in 1m bars, or None.
+        """
+        P = pos['op_open_price']
+        long = pos['side'] == 'buy'
+        stops = []
+
+        if pos['stop_loss']:
+            price = P * (1 - pos['stop_loss']) if long else P * (1 + pos['stop_loss'])
+            time = intrabar.first_touch(price, long, start, end)
+
+            if time is not None:
+                stops.append((time, price))
+
+        if pos['stop_profit']:
+            stop = intrabar.first_trailing_touch(P, P * pos['stop_profit'], long, start, end)
+
+            if stop is not None:
+                stops.append(stop)
+
+        return min(stops, key=lambda stop: stop[0]) if stops else None
+
     def op_force_liquidate_positions(self, end):
         """ Force liquidate positions if loss exceeds m%. """
         op_positions = copy.deepcopy(self.trader.op_positions)
@@ -263,23 +324,33 @@ class SingleExchangeStrategy():
             for _, pos in positions.items():
 
                 start = pos['op_open_time'] + timedelta(seconds=1)
-                ohlcv = self.trader.ohlcvs[self.ex][pos['market']][self.trader.config['indicator_tf']][start:end]
+                liq_percent = self._config['analysis']['force_liquidate_percent']
+                liq_time = []
 
-                if len(ohlcv) > 0:
-                    liq_percent = self._config['analysis']['force_liquidate_percent']
+                if pos['side'] == 'buy':
+                    liq_price = pos['op_open_price'] * (1 - liq_percent)
+                elif pos['side'] == 'sell':
+                    liq_price = pos['op_open_price'] * (1 + liq_percent)
 
-                    if pos['side'] == 'buy':
-                        liq_price = pos['op_open_price'] * (1 - liq_percent)
-                        liq_time = ohlcv[ohlcv.low <= liq_price].index
+                intrabar = self.trader.intrabar(self.ex, pos['market'])
 
-                    elif pos['side'] == 'sell':
-                        liq_price = pos['op_open_price'] * (1 + liq_percent)
-                        liq_time = ohlcv[ohlcv.high >= liq_price].index
+                if intrabar:
+                    touch = intrabar.first_touch(liq_price, pos['side'] == 'buy', start, end)
+                    liq_time = [touch] if touch is not None else []
 
-                    if len(liq_time) > 0:
-                        pos['op_close_price'] = liq_price
-                        pos['op_close_time'] = liq_time[0]
-                        self.append_op(self.trader.op_close_position(pos, pos['op_close_time']))
+                else:
+                    ohlcv = self.trader.ohlcvs[self.ex][pos['market']][self.trader.config['indicator_tf']][start:end]
 
-                        if self._config['mode'] == 'debug':
-                            logger.debug(f'Position was forced to liquidated @ {liq_price} ({liq_time[0]})')
\ No newline at end of file
+                    if len(ohlcv) > 0:
+                        if pos['side'] == 'buy':
+                            liq_time = ohlcv[ohlcv.low <= liq_price].index
+                        elif pos['side'] == 'sell':
+                            liq_time = ohlcv[ohlcv.high >= liq_price].index
+
+                if len(liq_time) > 0:
+                    pos['op_close_price'] = liq_price
+                    pos['op_close_time'] = liq_time[0]
+                    self.append_op(self.trader.op_close_position(pos, pos['op_close_time']))
+
+                    if self._config['mode'] == 'debug':
+                        logger.debug(f'Position was forced to liquidated @ {liq_price} ({liq_time[0]})')
@@ -15,23 +15,30 @@ class PatternStrategy(SingleExchangeStrategy):
 
     def init_vars(self):
         self.margin = self._config['backtest']['margin']
+        self.portfolio = self._config['backtest']['portfolio']
 
     def fast_strategy(self):
         stop_loss = False    # enable or disable stop losss
         stop_profit = False  # enable or disable stop profit
 
+        sigs = {}
         for market in self.markets:
-            if market in self.params:
-                param = self.params[market]
-            else:
-                param = self.params['common']
-
-            sig = self.calc_signal(market, param)
-            self.execute_signal(sig, market, stop_loss, stop_profit)
+            sigs[market] = self.calc_signal(market, self.market_param(market))
 
             if self._config['analysis']['log_signal']:
                 print(market, 'signal:')
-                print(sig)
+                print(sigs[market])
+
+        if self.portfolio['enable']:
+            # Markets share one wallet, so signals are executed in time order
+            self.execute_merged_signals(sigs, stop_loss, stop_profit)
+        else:
+            for market, sig in sigs.items():
+                self.ind.p = self.market_param(market)
+                self.execute_signal(sig, market, stop_loss, stop_profit)
+
+    def market_param(self, market):
+        return self.params[market] if market in self.params else self.params['common']
 
     def calc_signal(self, market, param):
         """ Main algorithm which calculates signals.
@@ -50,35 +57,82 @@ class PatternStrategy(SingleExchangeStrategy):
         return sig
 
     def execute_signal(self, sig, market, stop_loss=False, stop_profit=False):
+        sig = sig.dropna()
+
+        for dt, ss in sig.items():
+            self.execute_signal_at(dt, ss, market, stop_loss, stop_profit)
+
+    def execute_merged_signals(self, sigs, stop_loss=False, stop_profit=False):
+        """ Merge signals of all markets into one timeline and execute them in time order,
+            signals at the same time are executed in order of `self.markets`.
+        """
+        if not sigs:
+            return
+
+        markets = list(sigs.keys())
+        params = [self.market_param(market) for market in markets]
+        sigs = [sigs[market].dropna() for market in markets]
+
+        times = np.concatenate([sig.index.values for sig in sigs])
+        values = np.concatenate([sig.values for sig in sigs])
+        market_idxs = np.concatenate([np.full(len(sig), i) for i, sig in enumerate(sigs)])
+        offsets = np.cumsum([0] + [len(sig) for sig in sigs[:-1]])
+
+        for pos in np.argsort(times, kind='stable'):
+            i = market_idxs[pos]
+            self.ind.p = params[i]
+            dt = sigs[i].index[pos - offsets[i]]
+            self.execute_signal_at(dt, values[pos], markets[i], stop_loss, stop_profit)
+
+    def execute_signal_at(self, dt, ss, market, stop_loss=False, stop_profit=False):
         stop_loss = self.ind.p['stop_loss_percent'] if stop_loss else None
         stop_profit = self.ind.p['stop_profit_percent'] if stop_profit else None
 
-        sig = sig.dropna()
+        self.op_execute_position_stop(dt)
+        # self.op_force_liquidate_positions(dt)
 
-        for dt, ss in sig.items():
+        # Markets share one wallet in portfolio mode, a signal only cleans orders of its market
+        clean_market = market if self.portfolio['enable'] else None
+
+        if ss > 0: # buy
+            ss = abs(ss)
+            self.op_clean_orders('sell', dt, clean_market)
+            curr = self.trader.quote_balance(market)
+            cost = self.calc_spend(ss, curr, dt)
+            self.op_buy(dt, market, cost, margin=self.margin, stop_loss=stop_loss, stop_profit=stop_profit)
 
-            self.op_execute_position_stop(dt)
-            # self.op_force_liquidate_positions(dt)
+        elif ss < 0: # sell
+            ss = abs(ss)
+            self.op_clean_orders('buy', dt, clean_market)
 
-            if ss > 0: # buy
-                ss = abs(ss)
-                self.op_clean_orders('sell', dt)
+            if self.margin:
                 curr = self.trader.quote_balance(market)
-                cost = ss / 100 * self.trader.op_wallet[self.ex][curr] * self.ind.p['trade_portion']
-                self.op_buy(dt, market, cost, margin=self.margin, stop_loss=stop_loss, stop_profit=stop_profit)
+            else:
+                curr = self.trader.base_balance(market)
+
+            cost = self.calc_spend(ss, curr, dt)
+            self.op_sell(dt, market, cost, margin=self.margin, stop_loss=stop_loss, stop_profit=stop_profit)
+
+        else:  # ss == 0
+            # Close all positions and cancel all orders
+            self.op_clean_orders('all', dt, clean_market)
+
+    def calc_spend(self, ss, curr, now):
+        """ Amount of `curr` to spend on a signal with confidence `ss`.
+            In portfolio mode, every market gets its portion of the total account value
+            (capped by `max_fund`) like SingleEXTrader does.
+        """
+        balance = self.trader.op_wallet[self.ex][curr]
 
-            elif ss < 0: # sell
-                ss = abs(ss)
-                self.op_clean_orders('buy', dt)
+        if not self.portfolio['enable']:
+            return ss / 100 * balance * self.ind.p['trade_portion']
 
-                if self.margin:
-                    curr = self.trader.quote_balance(market)
-                else:
-                    curr = self.trader.base_balance(market)
+        total_value = self.trader.op_account_value(self.ex, curr, now)
+        max_fund = self.portfolio['max_fund']
 
-                cost = ss / 100 * self.trader.op_wallet[self.ex][curr] * self.ind.p['trade_portion']
-                self.op_sell(dt, market, cost, margin=self.margin, stop_loss=stop_loss, stop_profit=stop_profit)
+        if max_fund and total_value > max_fund:
+            balance -= total_value - max_fund
+            total_value = max_fund
 
-            else:  # ss == 0
-                # Close all positions and cancel all orders
-                self.op_clean_orders('all', dt)
+        spend = ss / 100 * total_value * self.ind.p['trade_portion'] / len(self.markets)
+        return max(min(spend, balance), 0)
@@ -1,40 +1,75 @@
 from datetime import timedelta
 from collections import MutableMapping
 from motor import motor_asyncio
+from pymongo.errors import OperationFailure
 from redis import StrictRedis
 
 import asyncio
+import bson
 import logging
+import numpy as np
 import pandas as pd
 import pymongo
 import pickle
 import six
 import re
+import time
 
+from ohlcv_cache import OHLCVCache
+from ohlcv_window import OHLCVWindow
 from utils import \
     INF, \
     MIN_DT, \
     ms_dt, \
     dt_ms, \
+    ms_index, \
     ex_name, \
     config, \
     rsym, \
     load_keys, \
     execute_mongo_ops, \
     smallest_tf, \
-    roundup_dt, \
-    utc_now, \
     tf_td, \
     is_within
 
 
 pd.options.mode.chained_assignment = None
 
+DAY_MS = 24 * 60 * 60 * 1000
+
 logger = logging.getLogger('pyct')
 
 
 class EXMongo():
 
+    ohlcv_fields = {
+        'timestamp': np.int64,
+        'open': np.float64,
+        'high': np.float64,
+        'low': np.float64,
+        'close': np.float64,
+        'volume': np.float64,
+    }
+
+    # Keys of fields in a day bucket of ohlcv (ohlcv_buckets)
+    ohlcv_bucket_keys = {
+        'timestamp': 't',
+        'open': 'o',
+        'high': 'h',
+        'low': 'l',
+        'close': 'c',
+        'volume': 'v',
+    }
+
+    trade_fields = {
+        'timestamp': np.int64,
+        'id': object,
+        'symbol': object,
+        'side': object,
+        'price': np.float64,
+        'amount': np.float64,
+    }
+
     def __init__(self, *,
                  host=None,
                  port=None,
@@ -73,6 +108,11 @@ class EXMongo():
 
         self.host = host
         self.port = port
+        self.ohlcv_cache = self.config['ohlcv_cache']['enable']
+        self.ohlcv_buckets = self.config['ohlcv_buckets']
+        self._query_sem = None # created in the running event loop
+        self.ohlcv_windows = {} # {ex: OHLCVWindow}
+        self._ohlcv_starts = {} # {collection: first timestamp (ms)}, they don't change
 
         logger.info(f"Connecting mongo client to {host}:{port} with SSL {ssl_status}")
         self.client = motor_asyncio.AsyncIOMotorClient(
@@ -106,15 +146,15 @@ class EXMongo():
                 # if asked not to raise exception, return MIN_DT instead
                 return {'timestamp': dt_ms(MIN_DT)}
 
-        return res[0]
+        return self._bucket_ohlcv(res[0], 0) if self.ohlcv_buckets else res[0]
 
-    async def get_ohlcv_end(self, ex, sym, tf, exception=True):
+    async def get_ohlcv_end(self, ex, sym, tf, exception=True, coll_prefix=''):
         """ Get datetime of last ohlcv in a collection. """
-        res = await self.get_last_ohclv(ex, sym, tf, exception)
+        res = await self.get_last_ohclv(ex, sym, tf, exception, coll_prefix)
         return ms_dt(res['timestamp'])
 
-    async def get_last_ohclv(self, ex, sym, tf, exception=True):
-        collname = f"{ex}_ohlcv_{rsym(sym)}_{tf}"
+    async def get_last_ohclv(self, ex, sym, tf, exception=True, coll_prefix=''):
+        collname = f"{coll_prefix}{ex}_ohlcv_{rsym(sym)}_{tf}"
         coll = self.get_collection(self.config['dbname_exchange'], collname)
         res = await coll.find({}) \
             .sort([('timestamp', -1)]) \
@@ -128,7 +168,199 @@ class EXMongo():
                 # if asked not to raise exception, return MIN_DT instead
                 return {'timestamp': dt_ms(MIN_DT)}
 
-        return res[0]
+        return self._bucket_ohlcv(res[0], -1) if self.ohlcv_buckets else res[0]
+
+    @classmethod
+    def _bucket_ohlcv(cls, bucket, i):
+        """ The `i`th ohlcv of a day bucket as a flat ohlcv doc. """
+        return {f: bucket[key][i] for f, key in cls.ohlcv_bucket_keys.items()}
+
+    async def get_ohlcvs_start_end(self, ex, symbols, timeframe):
+        """ Get datetime of first and last ohlcv of symbols in one aggregation,
+            falls back to queries of every collection if mongo doesn't support $unionWith (< 4.4).
+            First datetime of a collection is only read once.
+            Returns {symbol: {'start': datetime, 'end': datetime}}, MIN_DT if a collection is empty.
+        """
+        if not symbols:
+            return {}
+
+        ex = ex_name(ex)
+        collnames = {sym: f"{ex}_ohlcv_{rsym(sym)}_{timeframe}" for sym in symbols}
+
+        # (symbol, 'start'/'end', sort order of timestamp)
+        edges = [(sym, 'end', -1) for sym in symbols] \
+              + [(sym, 'start', 1) for sym in symbols if collnames[sym] not in self._ohlcv_starts]
+
+        def edge_pipeline(sym, kind, order):
+            ts = {'$arrayElemAt': ['$t', 0 if order > 0 else -1]} if self.ohlcv_buckets else '$timestamp'
+            return [
+                {'$sort': {'timestamp': order}},
+                {'$limit': 1},
+                {'$project': {'_id': 0, 'symbol': {'$literal': sym}, 'kind': {'$literal': kind}, 'timestamp': ts}},
+            ]
+
+        try:
+            pipeline = edge_pipeline(*edges[0]) + [
+                {'$unionWith': {'coll': collnames[sym], 'pipeline': edge_pipeline(sym, kind, order)}}
+                for sym, kind, order in edges[1:]]
+
+            coll = self.get_collection(self.config['dbname_exchange'], collnames[edges[0][0]])
+            docs = await coll.aggregate(pipeline).to_list(length=INF)
+
+        except OperationFailure as err:
+            logger.debug(f"Query first/last ohlcv one by one, $unionWith failed: {err}")
+
+            res = await asyncio.gather(*[
+                self.get_first_ohclv(ex, sym, timeframe, exception=False) if kind == 'start' else
+                self.get_last_ohclv(ex, sym, timeframe, exception=False)
+                for sym, kind, _ in edges])
+
+            docs = [{'symbol': sym, 'kind': kind, 'timestamp': doc['timestamp']}
+                    for (sym, kind, _), doc in zip(edges, res)]
+
+        empty = dt_ms(MIN_DT)
+        start_end = {sym: {
+            'start': ms_dt(self._ohlcv_starts.get(collnames[sym], empty)),
+            'end': MIN_DT,
+        } for sym in symbols}
+
+        for doc in docs:
+            start_end[doc['symbol']][doc['kind']] = ms_dt(doc['timestamp'])
+
+            if doc['kind'] == 'start' and doc['timestamp'] != empty:
+                self._ohlcv_starts[collnames[doc['symbol']]] = doc['timestamp']
+
+        return start_end
+
+    async def resample_ohlcv(self, ex, symbol, src_tf, target_tf, start, end, coll_prefix=''):
+        """ Resample ohlcv of `src_tf` to `target_tf` inside mongo ($group by interval),
+            intervals are the same as utils.ohlcv_to_interval.
+            Returns DataFrame in the format of get_ohlcv.
+        """
+        ex = ex_name(ex)
+        collection = f"{coll_prefix}{ex}_ohlcv_{rsym(symbol)}_{src_tf}"
+        coll = self.get_collection(self.config['dbname_exchange'], collection)
+        start_ms = dt_ms(start)
+        end_ms = dt_ms(end)
+        target_td = tf_td(target_tf)
+        td_ms = int(target_td.total_seconds()) * 1000
+
+        if target_td < tf_td(src_tf):
+            raise ValueError(f"Target interval {target_td} < original interval {tf_td(src_tf)}")
+
+        # Unwind day buckets to one ohlcv per doc
+        pipeline = []
+        if self.ohlcv_buckets:
+            keys = [f"${key}" for key in self.ohlcv_bucket_keys.values()]
+            pipeline += [
+                {'$match': {'timestamp': {'$gte': start_ms - start_ms % DAY_MS, '$lt': end_ms}}},
+                {'$project': {'_id': 0, 'row': {'$zip': {'inputs': keys}}}},
+                {'$unwind': '$row'},
+                {'$project': {f: {'$arrayElemAt': ['$row', i]} for i, f in enumerate(self.ohlcv_bucket_keys)}},
+            ]
+        pipeline += [
+            {'$match': {'timestamp': {'$gte': start_ms, '$lt': end_ms}}},
+            {'$sort': {'timestamp': 1}},
+        ]
+
+        if target_td < timedelta(days=1):
+            # Intervals restart at every hour/day
+            period = 60 * 60 * 1000 if target_td < timedelta(hours=1) else DAY_MS
+            interval_start = {'$subtract': ['$timestamp', {'$mod': [{'$mod': ['$timestamp', period]}, td_ms]}]}
+
+        else:
+            # Intervals of days start from the first day
+            first = await coll.aggregate(pipeline + [{'$limit': 1}]).to_list(length=1)
+            origin = first[0]['timestamp'] - first[0]['timestamp'] % DAY_MS if first else 0
+            interval_start = {'$subtract': [
+                '$timestamp', {'$mod': [{'$subtract': ['$timestamp', origin]}, td_ms]}]}
+
+        pipeline += [
+            {'$group': {
+                '_id': interval_start,
+                'open': {'$first': '$open'},
+                'high': {'$max': '$high'},
+                'low': {'$min': '$low'},
+                'close': {'$last': '$close'},
+                'volume': {'$sum': '$volume'},
+            }},
+            {'$sort': {'_id': 1}},
+        ]
+
+        docs = await coll.aggregate(pipeline, allowDiskUse=True).to_list(length=INF)
+
+        fields = self.ohlcv_fields
+        arrays = {f: np.array([doc['_id' if f == 'timestamp' else f] for doc in docs], dtype=dtype)
+                  for f, dtype in fields.items()}
+
+        return self._arrays_to_dataframe(arrays, index_col='timestamp').dropna()
+
+    async def get_build_watermarks(self, ex, sym, timeframes, coll_prefix=''):
+        """ Get start datetime of the last built ohlcv of every timeframe (see build_ohlcv_incremental).
+            Timeframes never built incrementally start from the last ohlcv in their collection.
+            Returns {timeframe: datetime}
+        """
+        coll = self.get_collection(self.config['dbname_exchange'], f"{coll_prefix}{ex}_build_watermarks")
+        docs = await coll.find({'symbol': sym, 'timeframe': {'$in': timeframes}}).to_list(length=INF)
+        watermarks = {doc['timeframe']: ms_dt(doc['timestamp']) for doc in docs}
+
+        missing = [tf for tf in timeframes if tf not in watermarks]
+        ends = await asyncio.gather(*[
+            self.get_ohlcv_end(ex, sym, tf, exception=False, coll_prefix=coll_prefix)
+            for tf in missing])
+        watermarks.update(zip(missing, ends))
+
+        return watermarks
+
+    async def set_build_watermarks(self, ex, sym, watermarks, coll_prefix=''):
+        """ Param
+                watermarks: {timeframe: datetime}
+        """
+        coll = self.get_collection(self.config['dbname_exchange'], f"{coll_prefix}{ex}_build_watermarks")
+        ops = [
+            pymongo.UpdateOne(
+                {'symbol': sym, 'timeframe': tf},
+                {'$set': {'symbol': sym, 'timeframe': tf, 'timestamp': dt_ms(dt)}},
+                upsert=True)
+            for tf, dt in watermarks.items()]
+
+        if ops:
+            await execute_mongo_ops(coll.bulk_write(ops))
+
+    async def clear_build_watermarks(self, ex, sym):
+        coll = self.get_collection(self.config['dbname_exchange'], f"{ex}_build_watermarks")
+        await coll.delete_many({'symbol': sym})
+
+    async def get_ohlcv_gaps(self, ex, sym, timeframe):
+        """ Get ranges of missing ohlcv saved by `hist_data.find_ohlcv_gaps`.
+            Returns int64 array of [gap_start, gap_end) rows in ms.
+        """
+        coll = self.get_collection(self.config['dbname_exchange'], f"{ex}_gaps")
+        docs = await coll.find({'symbol': sym, 'timeframe': timeframe}) \
+            .sort([('start', 1)]).to_list(length=INF)
+
+        return np.array([[doc['start'], doc['end']] for doc in docs], dtype=np.int64).reshape(-1, 2)
+
+    async def set_ohlcv_gaps(self, ex, sym, timeframe, gaps, start, end):
+        """ Replace gaps saved in a scanned range [start, end) (ms) by `gaps`,
+            saved gaps crossing the range keep their parts outside of it.
+        """
+        coll = self.get_collection(self.config['dbname_exchange'], f"{ex}_gaps")
+        cond = {'symbol': sym, 'timeframe': timeframe, 'start': {'$lt': end}, 'end': {'$gt': start}}
+
+        ranges = [(int(gs), int(ge)) for gs, ge in gaps]
+        for doc in await coll.find(cond).to_list(length=INF):
+            if doc['start'] < start:
+                ranges.append((doc['start'], start))
+            if doc['end'] > end:
+                ranges.append((end, doc['end']))
+
+        await coll.delete_many(cond)
+
+        if ranges:
+            await coll.insert_many([
+                {'symbol': sym, 'timeframe': timeframe, 'start': gs, 'end': ge}
+                for gs, ge in sorted(ranges)])
 
     async def get_trades_start(self, ex, sym):
         """ Get datetime of first trades in a collection. """
@@ -166,21 +398,22 @@ class EXMongo():
         """
 
         db = self.config['dbname_exchange']
-        condition = self.cond_timestamp_range(start, end)
 
         ex = ex_name(ex)
         collection = f"{coll_prefix}{ex}_ohlcv_{rsym(symbol)}_{timeframe}"
 
-        coll = self.get_collection(db, collection)
-        if not await self.coll_exist(coll):
-            raise ValueError(f"Collection {collection} does not exist.")
+        if self.ohlcv_cache and not fields_condition:
+            ohlcv = await self._get_cached_ohlcv(ex, symbol, timeframe, start, end, coll_prefix)
 
-        ohlcv = await self._read_to_dataframe(db, collection, condition,
-                                             fields_condition=fields_condition,
-                                             index_col='timestamp',
-                                             date_col='timestamp',
-                                             date_parser=ms_dt)
-        ohlcv.sort_index(inplace=True)
+        else:
+            coll = self.get_collection(db, collection)
+            if not await self.coll_exist(coll):
+                raise ValueError(f"Collection {collection} does not exist.")
+
+            fields = self._project_fields(self.ohlcv_fields, fields_condition)
+            arrays = await self._read_ohlcv_arrays(collection, dt_ms(start), dt_ms(end), fields)
+            ohlcv = self._arrays_to_dataframe(arrays, index_col='timestamp')
+            ohlcv.sort_index(inplace=True)
 
         if compress:
             # Covert all float colums to minimum float type, which is float32
@@ -190,20 +423,134 @@ class EXMongo():
 
         return ohlcv
 
+    async def _get_cached_ohlcv(self, ex, symbol, timeframe, start, end, coll_prefix=''):
+        """ Read ohlcv from local cache (OHLCVCache). Cached ohlcv written again since
+            the cache was synced, by any process, are removed first. The cache is synced
+            with mongo if anything was removed or the range reaches its last ohlcv,
+            which may still be updating.
+        """
+        cache = OHLCVCache(ex, symbol, timeframe, custom_config=self._config, coll_prefix=coll_prefix)
+        version, changed_from = await self.get_ohlcv_changes(
+            ex, symbol, timeframe, cache.version(), coll_prefix=coll_prefix)
+
+        if changed_from is not None:
+            cache.invalidate(changed_from)
+
+        last = cache.last_timestamp()
+        if changed_from is not None or last is None or dt_ms(end) > last:
+            await self.sync_ohlcv_cache(cache)
+            cache.set_version(version)
+
+        if len(cache) == 0:
+            raise ValueError(
+                f"Collection {coll_prefix}{ex}_ohlcv_{rsym(symbol)}_{timeframe} does not exist.")
+
+        return cache.get(dt_ms(start), dt_ms(end))
+
+    async def sync_ohlcv_cache(self, cache):
+        """ Append ohlcv newer than the last cached one to the cache.
+            The last cached ohlcv is read again because it may be updated after it's cached.
+        """
+        collection = f"{cache.coll_prefix}{cache.ex}_ohlcv_{rsym(cache.symbol)}_{cache.timeframe}"
+        last = cache.last_timestamp()
+
+        arrays = await self._read_ohlcv_arrays(collection, start_ms=last)
+        cache.append(arrays, replace_from=last)
+
+    async def get_ohlcv_changes(self, ex, symbol, timeframe, since_version, coll_prefix=''):
+        """ Find the first ohlcv written after version `since_version` of ohlcv writes
+            (see _log_ohlcv_write), so local copies of a collection can tell which part is stale.
+            Returns (current version, timestamp in ms of the first ohlcv written since then),
+            the timestamp is None if nothing was written and 0 if it's unknown.
+        """
+        coll = self.get_collection(self.config['dbname_exchange'], f"{coll_prefix}{ex_name(ex)}_write_versions")
+        doc = await coll.find_one({'symbol': symbol, 'timeframe': timeframe})
+        version = doc['version'] if doc else 0
+        writes = doc['writes'] if doc else []
+
+        if since_version == version:
+            return version, None
+
+        n_writes = version - since_version if since_version is not None else -1
+        if not 0 < n_writes <= len(writes):
+            return version, 0
+
+        return version, min(writes[-n_writes:])
+
+    async def _log_ohlcv_write(self, ex, symbol, timeframe, from_ms, coll_prefix=''):
+        """ Increment version of ohlcv writes of a collection and log the first written ohlcv,
+            only the last `ohlcv_cache.logged_writes` writes are kept.
+        """
+        coll = self.get_collection(self.config['dbname_exchange'], f"{coll_prefix}{ex}_write_versions")
+        await coll.update_one(
+            {'symbol': symbol, 'timeframe': timeframe},
+            {
+                '$inc': {'version': 1},
+                '$push': {'writes': {
+                    '$each': [from_ms],
+                    '$slice': -self.config['ohlcv_cache']['logged_writes'],
+                }},
+            },
+            upsert=True)
+
+    async def _read_ohlcv_arrays(self, collection, start_ms=None, end_ms=None, fields=None):
+        """ Read ohlcv in [start_ms, end_ms) sorted by timestamp into arrays (see _read_to_arrays),
+            from flat docs or from day buckets if `ohlcv_buckets` is enabled.
+        """
+        db = self.config['dbname_exchange']
+        fields = fields or self.ohlcv_fields
+        ts_range = {}
+        if start_ms is not None:
+            ts_range['$gte'] = int(start_ms)
+        if end_ms is not None:
+            ts_range['$lt'] = int(end_ms)
+
+        if not self.ohlcv_buckets:
+            condition = {'timestamp': ts_range} if ts_range else {}
+            return await self._read_to_arrays(db, collection, condition, fields, sort='timestamp')
+
+        # A bucket starting before `start_ms` may contain ohlcv after it
+        bucket_range = dict(ts_range)
+        if start_ms is not None:
+            bucket_range['$gte'] = int(start_ms - start_ms % DAY_MS)
+
+        keys = [self.ohlcv_bucket_keys[f] for f in fields]
+        cursor = self.get_collection(db, collection) \
+            .find({'timestamp': bucket_range} if bucket_range else {},
+                  {**{key: 1 for key in keys}, '_id': 0}) \
+            .sort([('timestamp', 1)]) \
+            .batch_size(self.config['read_batch_size'])
+
+        chunks = {f: [] for f in fields}
+        async for bucket in cursor:
+            for f, key in zip(fields, keys):
+                chunks[f].append(np.asarray(bucket[key], dtype=fields[f]))
+
+        arrays = {
+            f: np.concatenate(chunks[f]) if chunks[f] else np.empty(0, dtype=dtype)
+            for f, dtype in fields.items()
+        }
+
+        ts = arrays['timestamp']
+        mask = np.ones(len(ts), dtype=bool)
+        if start_ms is not None:
+            mask &= ts >= start_ms
+        if end_ms is not None:
+            mask &= ts < end_ms
+
+        return {f: arr[mask] for f, arr in arrays.items()}
+
     async def get_trades(self, ex, symbol, start, end, fields_condition={}, compress=False):
-        """ Read ohlcv of 'one' symbol from mongodb into DataFrame. """
+        """ Read trades of 'one' symbol from mongodb into DataFrame. """
         db = self.config['dbname_exchange']
         condition = self.cond_timestamp_range(start, end)
-        fields_condition = {**fields_condition, **{'_id': 0}}
 
         ex = ex_name(ex)
         collection = f"{ex}_trades_{rsym(symbol)}"
 
-        trade = await self._read_to_dataframe(db, collection, condition,
-                                             fields_condition=fields_condition,
-                                             index_col='timestamp',
-                                             date_col='timestamp',
-                                             date_parser=ms_dt)
+        fields = self._project_fields(self.trade_fields, fields_condition)
+        arrays = await self._read_to_arrays(db, collection, condition, fields)
+        trade = self._arrays_to_dataframe(arrays, index_col='timestamp')
         trade.sort_index(inplace=True)
 
         if compress:
@@ -217,6 +564,31 @@ class EXMongo():
 
         return trade
 
+    async def iter_trades(self, ex, symbol, start, end, chunk, fields_condition={}, compress=False):
+        """ Read trades of 'one' symbol in time ordered chunks of `chunk` (timedelta),
+            the next chunk is read while the current one is being processed.
+            Yields DataFrame of every chunk, which may be empty.
+        """
+        bounds = []
+        while start < end:
+            bounds.append((start, min(start + chunk, end)))
+            start += chunk
+
+        if not bounds:
+            return
+
+        read = asyncio.ensure_future(
+            self.get_trades(ex, symbol, *bounds[0], fields_condition, compress))
+
+        for i in range(len(bounds)):
+            trades = await read
+
+            if i + 1 < len(bounds):
+                read = asyncio.ensure_future(
+                    self.get_trades(ex, symbol, *bounds[i + 1], fields_condition, compress))
+
+            yield trades
+
     async def get_ohlcvs_of_symbols(self, ex, symbols, timeframes, start, end, fields_condition={}, compress=False):
         """ Returns ohlcvs of multiple timeframes and symbols in an exchange.
             Return
@@ -227,11 +599,15 @@ class EXMongo():
                     },
                 }
         """
-        ohlcvs = {}
-        for sym in symbols:
-            ohlcvs[sym] = {}
-            for tf in timeframes:
-                ohlcvs[sym][tf] = await self.get_ohlcv(ex, sym, tf, start, end, fields_condition, compress)
+        keys = [(sym, tf) for sym in symbols for tf in timeframes]
+        res = await self.gather_queries([
+            (f"{ex_name(ex)} {sym} {tf} ohlcv",
+             self.get_ohlcv(ex, sym, tf, start, end, fields_condition, compress))
+            for sym, tf in keys])
+
+        ohlcvs = {sym: {} for sym in symbols}
+        for (sym, tf), ohlcv in zip(keys, res):
+            ohlcvs[sym][tf] = ohlcv
         return ohlcvs
 
     async def get_trades_of_symbols(self, ex, symbols, start, end, fields_condition={}, compress=False):
@@ -242,37 +618,170 @@ class EXMongo():
                     'ETH/USD': DataFrame(...),
                 }
         """
-        trades = {}
-        for sym in symbols:
-            trades[sym] = await self.get_trades(ex, sym, start, end, fields_condition, compress)
-        return trades
+        res = await self.gather_queries([
+            (f"{ex_name(ex)} {sym} trades",
+             self.get_trades(ex, sym, start, end, fields_condition, compress))
+            for sym in symbols])
+
+        return dict(zip(symbols, res))
+
+    async def gather_queries(self, queries):
+        """ Run queries concurrently, at most `max_concurrent_queries` of all queries
+            of this client run at once. Duration of every query is logged.
+            Param
+                queries: list of (name, coroutine)
+            Returns results in order of `queries`.
+        """
+        if self._query_sem is None:
+            self._query_sem = asyncio.Semaphore(self.config['max_concurrent_queries'])
+
+        async def run(name, coro):
+            async with self._query_sem:
+                s = time.time()
+                res = await coro
+                logger.debug(f"Read {name} in {time.time() - s:.3f}s")
+                return res
+
+        return await asyncio.gather(*[run(name, coro) for name, coro in queries])
 
     async def insert_ohlcv(self, ohlcv_df, ex, symbol, timeframe, *, coll_prefix='', upsert=True):
-        """ Insert ohlcv dateframe to mongodb. """
+        """ Insert ohlcv dateframe to mongodb (see write_ohlcv). """
+        arrays = {col: ohlcv_df[col].values for col in ohlcv_df.columns}
+        arrays['timestamp'] = ohlcv_df.index.values.astype('datetime64[ms]').astype(np.int64)
+
+        return await self.write_ohlcv(arrays, ex, symbol, timeframe,
+                                      coll_prefix=coll_prefix, upsert=upsert)
+
+    async def write_ohlcv(self, arrays, ex, symbol, timeframe, *, coll_prefix='', upsert=True):
+        """ Bulk write ohlcv to mongodb, every ohlcv writer goes through it.
+            Docs are built column by column and written in unordered bulk writes
+            of about `write_batch_mb`. Docs are inserted instead of upserted
+            if `upsert` is False or no ohlcv exists in the timestamp range of `arrays`.
+            With `ohlcv_buckets`, ohlcv are merged into day buckets (see _write_ohlcv_buckets).
+            Param
+                arrays: dict of arrays by field, 'timestamp' in ms
+            Returns number of ohlcv written.
+        """
+        n_docs = len(arrays['timestamp'])
+        if n_docs == 0:
+            return 0
+
+        s = time.time()
         db = self.config['dbname_exchange']
         ex = ex_name(ex)
-        coll = f"{coll_prefix}{ex}_ohlcv_{rsym(symbol)}_{timeframe}"
-        coll = self.get_collection(db, coll)
+        coll = self.get_collection(db, f"{coll_prefix}{ex}_ohlcv_{rsym(symbol)}_{timeframe}")
+        ts = np.asarray(arrays['timestamp'], dtype=np.int64)
 
-        # put 'timestamp' index to first column
-        ohlcv_df.reset_index(level=0, inplace=True)
-        ohlcv_df.timestamp = ohlcv_df.timestamp.apply(dt_ms)
+        if self.ohlcv_buckets:
+            upsert = await self._write_ohlcv_buckets(coll, arrays, upsert)
 
-        records = ohlcv_df.to_dict(orient='records')
+        else:
+            fields = list(arrays)
+            columns = [ts.tolist() if f == 'timestamp' else np.asarray(arrays[f]).tolist() for f in fields]
+            docs = [dict(zip(fields, values)) for values in zip(*columns)]
+
+            if upsert:
+                upsert = await coll.find_one(
+                    {'timestamp': {'$gte': int(ts.min()), '$lte': int(ts.max())}}, {'_id': 1}) is not None
+
+            await self._bulk_write(coll, docs, upsert)
+
+        # Cached ohlcv from the first written one are read from mongo again on next read,
+        # in every process that caches the collection. Writes are only logged if the cache
+        # is enabled in config, so writers and readers of a cache should share the setting.
+        if self.config['ohlcv_cache']['enable']:
+            await self._log_ohlcv_write(ex, symbol, timeframe, int(ts.min()), coll_prefix)
+
+        secs = time.time() - s
+        logger.debug(f"{'Upserted' if upsert else 'Inserted'} {n_docs} ohlcv to {coll.name} "
+                     f"in {secs:.3f}s ({n_docs / max(secs, 1e-9):.0f} docs/s)")
+
+        return n_docs
+
+    async def _write_ohlcv_buckets(self, coll, arrays, upsert=True):
+        """ Write ohlcv into day buckets, ohlcv of existing buckets are kept
+            unless they're in `arrays`. `upsert` is ignored, a day may already have
+            a bucket even if its ohlcv are new, so existing buckets of the range are
+            always read and merged. Buckets are inserted if none of them exists.
+            Merging is a read-modify-write: if two writers (eg. the ohlcv stream and
+            fetch_all_ohlcvs.py) write the same day at the same time, ohlcv of one of
+            them may be lost from the bucket, run them on different days or ranges.
+            Returns whether buckets are upserted.
+        """
+        order = np.argsort(arrays['timestamp'], kind='stable')
+        ts = np.asarray(arrays['timestamp'], dtype=np.int64)[order]
+        values = {
+            f: np.asarray(arrays[f], dtype=dtype)[order] if f in arrays else np.full(len(ts), np.nan)
+            for f, dtype in self.ohlcv_fields.items() if f != 'timestamp'
+        }
+        days = ts - ts % DAY_MS
+
+        docs = await coll.find({'timestamp': {'$gte': int(days[0]), '$lte': int(days[-1])}},
+                               {'_id': 0}).to_list(length=INF)
+        existing = {doc['timestamp']: doc for doc in docs}
+
+        buckets = []
+        bounds = np.append(np.flatnonzero(np.diff(days)) + 1, len(ts))
+        lo = 0
+
+        for hi in bounds:
+            day = int(days[lo])
+            bucket_ts = ts[lo:hi]
+            bucket = {f: vals[lo:hi] for f, vals in values.items()}
+
+            if day in existing:
+                # New ohlcv go first to replace old ones of the same timestamp
+                old = existing[day]
+                all_ts = np.concatenate([bucket_ts, np.asarray(old['t'], dtype=np.int64)])
+                bucket_ts, idx = np.unique(all_ts, return_index=True)
+                bucket = {
+                    f: np.concatenate([vals, np.asarray(old[self.ohlcv_bucket_keys[f]], dtype=np.float64)])[idx]
+                    for f, vals in bucket.items()
+                }
 
-        ops = []
-        for rec in records:
-            ops.append(
-                pymongo.UpdateOne(
-                    {'timestamp': rec['timestamp']},
-                    {'$set': rec},
-                    upsert=upsert))
+            buckets.append({
+                'timestamp': day,
+                'count': len(bucket_ts),
+                't': bucket_ts.tolist(),
+                **{self.ohlcv_bucket_keys[f]: vals.tolist() for f, vals in bucket.items()},
+            })
+            lo = hi
 
-            if len(ops) > 10000:
-                await execute_mongo_ops(coll.bulk_write(ops))
-                ops = []
+        upsert = len(existing) > 0
+        await self._bulk_write(coll, buckets, upsert)
 
-        await execute_mongo_ops(coll.bulk_write(ops))
+        return upsert
+
+    async def _bulk_write(self, coll, docs, upsert):
+        """ Write docs keyed by 'timestamp' in unordered bulk writes of about `write_batch_mb`,
+            fields of docs are set by upserts or docs are inserted.
+        """
+        # An upsert carries a doc twice (filter and $set), docs are about the same size
+        doc_size = len(bson.BSON.encode(docs[0])) * (2 if upsert else 1)
+        batch_size = max(1, int(self.config['write_batch_mb'] * 1024 * 1024 / doc_size))
+
+        writes = []
+        for i in range(0, len(docs), batch_size):
+            batch = docs[i:i+batch_size]
+
+            if upsert:
+                writes.append(coll.bulk_write([
+                    pymongo.UpdateOne({'timestamp': doc['timestamp']}, {'$set': doc}, upsert=True)
+                    for doc in batch], ordered=False))
+            else:
+                writes.append(coll.insert_many(batch, ordered=False))
+
+        await execute_mongo_ops(writes)
+
+    @staticmethod
+    def ohlcv_rows_to_arrays(rows):
+        """ Convert ohlcv fetched by ccxt ([[timestamp, open, high, low, close, volume], ...])
+            to arrays of `write_ohlcv`.
+        """
+        rows = np.asarray(rows, dtype=np.float64).reshape(-1, 6)
+        arrays = {f: rows[:, i] for i, f in enumerate(EXMongo.ohlcv_fields)}
+        arrays['timestamp'] = arrays['timestamp'].astype(np.int64)
+        return arrays
 
     async def _read_to_dataframe(self, db, collection, condition={}, *,
                                 fields_condition={},
@@ -318,6 +827,72 @@ class EXMongo():
 
         return df
 
+    async def _read_to_arrays(self, db, collection, condition, fields, sort=None):
+        """ Read `fields` of docs into numpy arrays, only `fields` are projected.
+            Docs are copied into preallocated arrays batch by batch (`read_batch_size`),
+            arrays are doubled in size when full.
+            Param
+                fields: dict, {field: dtype}, missing float fields are NaN,
+                    missing object fields are None
+                sort: str, field to sort docs by in mongo
+            Returns dict of arrays by field.
+        """
+        batch_size = self.config['read_batch_size']
+        projection = {**{f: 1 for f in fields}, '_id': 0}
+
+        cursor = self.get_collection(db, collection).find(condition, projection)
+        if sort:
+            cursor = cursor.sort([(sort, 1)])
+        cursor = cursor.batch_size(batch_size)
+
+        cap = batch_size
+        arrays = {f: np.empty(cap, dtype=dtype) for f, dtype in fields.items()}
+        fills = {f: np.nan if np.dtype(dtype).kind == 'f' else None for f, dtype in fields.items()}
+        n = 0
+
+        while True:
+            docs = await cursor.to_list(length=batch_size)
+            if not docs:
+                break
+
+            k = len(docs)
+            if n + k > cap:
+                while n + k > cap:
+                    cap *= 2
+
+                for f, arr in arrays.items():
+                    arrays[f] = np.empty(cap, dtype=arr.dtype)
+                    arrays[f][:n] = arr[:n]
+
+            for f, arr in arrays.items():
+                fill = fills[f]
+                arr[n:n+k] = [doc.get(f, fill) for doc in docs]
+
+            n += k
+
+        return {f: arr[:n] for f, arr in arrays.items()}
+
+    @staticmethod
+    def _arrays_to_dataframe(arrays, index_col='timestamp'):
+        """ Build a DataFrame from arrays of `_read_to_arrays`,
+            `index_col` is converted from ms timestamps to datetime.
+        """
+        columns = {f: arr for f, arr in arrays.items() if f != index_col}
+        index = ms_index(arrays[index_col], name=index_col)
+        return pd.DataFrame(columns, index=index, columns=list(columns))
+
+    @staticmethod
+    def _project_fields(fields, fields_condition):
+        """ Fields of `fields` remained after a mongo projection (fields_condition),
+            'timestamp' is always kept.
+        """
+        included = [f for f, v in fields_condition.items() if v and f != '_id']
+
+        return {
+            f: dtype for f, dtype in fields.items()
+            if f == 'timestamp' or ((not included or f in included) and fields_condition.get(f, 1))
+        }
+
     def get_database(self, dbname):
         return getattr(self.client, dbname)
 
@@ -370,15 +945,19 @@ class EXMongo():
         return params
 
     async def get_latest_ohlcvs(self, ex, markets, timeframes):
-        """ Get latest ohlcvs for trading. """
+        """ Get latest ohlcvs for trading,
+            only ohlcvs newer than the last call are read from mongo (see OHLCVWindow).
+        """
         if not isinstance(timeframes, list):
             timeframes = [timeframes]
 
-        # Get newest ohlcvs
-        td = timedelta(days=config['trading']['strategy']['data_days'])
-        end = roundup_dt(utc_now(), timedelta(minutes=1))
-        start = end - td
-        ohlcvs = await self.get_ohlcvs_of_symbols(ex, markets, timeframes, start, end)
+        ex = ex_name(ex)
+        if ex not in self.ohlcv_windows:
+            self.ohlcv_windows[ex] = OHLCVWindow(self, ex, custom_config=self._config)
+
+        window = self.ohlcv_windows[ex]
+        await window.refresh(markets, timeframes)
+        ohlcvs = {sym: {tf: window.get(sym, tf) for tf in timeframes} for sym in markets}
 
         for symbol, tfs in ohlcvs.items():
             sm_tf = smallest_tf(list(ohlcvs[symbol].keys()))
@@ -0,0 +1,143 @@
+from contextlib import contextmanager
+
+import fcntl
+import logging
+import os
+import numpy as np
+import pandas as pd
+
+from utils import config, ex_name, rsym, ms_index
+
+logger = logging.getLogger('pyct')
+
+
+class OHLCVCache():
+    """ Local copy of an ohlcv collection in mongo, one file of fixed size records
+        sorted by timestamp per exchange/symbol/timeframe:
+            {ohlcv_cache.dir}/{coll_prefix}{ex}/{symbol}_{timeframe}.bin
+        Records are read with numpy memmap, a range query is a binary search of timestamps
+        and a slice of the memmap, only rows in the range are copied into the DataFrame.
+        The version of ohlcv writes (see EXMongo.get_ohlcv_changes) the cache is synced to
+        is kept next to it in `{symbol}_{timeframe}.version`.
+    """
+
+    columns = ['open', 'high', 'low', 'close', 'volume']
+
+    dtype = np.dtype([('timestamp', np.int64)] + [(col, np.float64) for col in columns])
+
+    def __init__(self, ex, symbol, timeframe, custom_config=None, coll_prefix=''):
+        self._config = custom_config or config
+        self.config = self._config['database']['ohlcv_cache']
+        self.ex = ex_name(ex)
+        self.symbol = symbol
+        self.timeframe = timeframe
+        self.coll_prefix = coll_prefix
+
+        self.dir = os.path.join(self.config['dir'], f"{coll_prefix}{self.ex}")
+        self.data_file = os.path.join(self.dir, f"{rsym(symbol)}_{timeframe}.bin")
+        self.version_file = os.path.join(self.dir, f"{rsym(symbol)}_{timeframe}.version")
+        self.lock_file = self.data_file + '.lock'
+
+    def __len__(self):
+        if not os.path.exists(self.data_file):
+            return 0
+        return os.path.getsize(self.data_file) // self.dtype.itemsize
+
+    def load(self):
+        """ Returns all records as a structured array (read only). """
+        n_recs = len(self)
+
+        if n_recs == 0:
+            return np.empty(0, dtype=self.dtype)
+
+        return np.memmap(self.data_file, dtype=self.dtype, mode='r', shape=(n_recs,))
+
+    def last_timestamp(self):
+        """ Timestamp (ms) of the last cached ohlcv, None if cache is empty. """
+        with self.lock(shared=True):
+            recs = self.load()
+            return int(recs['timestamp'][-1]) if len(recs) > 0 else None
+
+    def version(self):
+        """ Version of ohlcv writes the cache is synced to, None if unknown. """
+        with self.lock(shared=True):
+            if not os.path.exists(self.version_file) or len(self) == 0:
+                return None
+
+            with open(self.version_file) as f:
+                return int(f.read())
+
+    def set_version(self, version):
+        with self.lock():
+            with open(self.version_file, 'w') as f:
+                f.write(str(version))
+
+    def get(self, start_ms, end_ms):
+        """ Returns ohlcv in [start_ms, end_ms) as a DataFrame indexed by timestamp. """
+        # Hold the lock until rows are copied, a truncated memmap can't be read
+        with self.lock(shared=True):
+            recs = self.load()
+            ts = recs['timestamp']
+            lo = np.searchsorted(ts, start_ms, side='left')
+            hi = np.searchsorted(ts, end_ms, side='left')
+            recs = recs[lo:hi]
+
+            # Same index as ohlcv read from mongo (EXMongo._arrays_to_dataframe)
+            return pd.DataFrame({col: np.array(recs[col]) for col in self.columns},
+                                index=ms_index(recs['timestamp'], name='timestamp'),
+                                columns=self.columns)
+
+    def append(self, arrays, replace_from=None):
+        """ Append ohlcv sorted by timestamp.
+            Cached records with timestamp >= `replace_from` (ms) are removed first.
+            Param
+                arrays: dict of arrays by field, 'timestamp' in ms
+        """
+        with self.lock():
+            self._truncate(replace_from)
+
+            if len(arrays['timestamp']) == 0:
+                return
+
+            recs = np.empty(len(arrays['timestamp']), dtype=self.dtype)
+            for field in self.dtype.names:
+                recs[field] = arrays[field]
+
+            with open(self.data_file, 'ab') as f:
+                recs.tofile(f)
+
+    def invalidate(self, from_ms):
+        """ Remove cached records with timestamp >= `from_ms` (ms),
+            they are read from mongo again on next sync.
+        """
+        with self.lock():
+            self._truncate(from_ms)
+
+    def clear(self):
+        with self.lock():
+            for file in [self.data_file, self.version_file]:
+                if os.path.exists(file):
+                    os.remove(file)
+
+    def _truncate(self, from_ms):
+        if from_ms is None or len(self) == 0:
+            return
+
+        keep = int(np.searchsorted(self.load()['timestamp'], from_ms, side='left'))
+
+        with open(self.data_file, 'r+b') as f:
+            f.truncate(keep * self.dtype.itemsize)
+
+    @contextmanager
+    def lock(self, shared=False):
+        """ Lock of the cache file among processes,
+            readers share the lock and a writer holds it exclusively.
+        """
+        os.makedirs(self.dir, exist_ok=True)
+
+        with open(self.lock_file, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
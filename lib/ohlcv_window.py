@@ -0,0 +1,148 @@
+from datetime import timedelta
+
+import logging
+import numpy as np
+import pandas as pd
+
+from utils import \
+    config, \
+    ex_name, \
+    rsym, \
+    dt_ms, \
+    roundup_dt, \
+    utc_now, \
+    tf_td
+
+logger = logging.getLogger('pyct')
+
+
+class OHLCVWindow():
+    """ Latest `data_days` of ohlcvs of an exchange kept in memory for live trading.
+        Every refresh only reads ohlcvs newer than the last one in memory (watermark),
+        the last one is read again because it may still be in progress.
+        DataFrames handed out are views of the buffers which can't be written through,
+        a later refresh doesn't change them except their last ohlcv: it's the one in progress
+        and is replaced in place, so the last row of a view is live. Consumers which keep
+        a view across refreshes must copy it (or at least its last row).
+        One window of an exchange is shared by Signals and all traders through EXMongo.
+    """
+
+    columns = ['open', 'high', 'low', 'close', 'volume']
+
+    def __init__(self, mongo, ex, custom_config=None):
+        self._config = custom_config or config
+        self.mongo = mongo
+        self.ex = ex_name(ex)
+        self.td = timedelta(days=self._config['trading']['strategy']['data_days'])
+        self.buffers = {} # {(symbol, timeframe): _OHLCVBuffer}
+
+    async def refresh(self, symbols, timeframes):
+        """ Read new ohlcvs of symbols and timeframes, drop ohlcvs older than `data_days`. """
+        end = roundup_dt(utc_now(), timedelta(minutes=1))
+        start = end - self.td
+
+        await self.mongo.gather_queries([
+            (f"{self.ex} {sym} {tf} ohlcv window", self._refresh(sym, tf, start, end))
+            for sym in symbols for tf in timeframes])
+
+    async def _refresh(self, symbol, timeframe, start, end):
+        key = (symbol, timeframe)
+        if key not in self.buffers:
+            self.buffers[key] = _OHLCVBuffer(int(self.td / tf_td(timeframe)) + 2, self.columns)
+
+        buf = self.buffers[key]
+        watermark = buf.last_timestamp()
+        read_from = dt_ms(start) if watermark is None else max(watermark, dt_ms(start))
+
+        # Concurrent refreshes of a buffer are safe, both replace ohlcvs from the same watermark
+        collection = f"{self.ex}_ohlcv_{rsym(symbol)}_{timeframe}"
+        arrays = await self.mongo._read_ohlcv_arrays(collection, read_from, dt_ms(end))
+
+        buf.append(arrays, replace_from=watermark)
+        buf.evict(dt_ms(start))
+
+        if len(buf) == 0:
+            raise ValueError(f"Collection {collection} does not exist.")
+
+    def get(self, symbol, timeframe):
+        """ Returns ohlcv of the last refresh as a read only DataFrame indexed by timestamp,
+            its last row is changed by the next refresh (see OHLCVWindow).
+        """
+        return self.buffers[(symbol, timeframe)].view()
+
+
+class _OHLCVBuffer():
+    """ Fixed capacity buffer of ohlcvs sorted by timestamp.
+        Rows are stored contiguously in twice the capacity so a view is a slice,
+        when the end of storage is reached rows in the window are moved to new storage,
+        views handed out before keep pointing to the old one.
+        Only the last row is ever written again (replaced by `append`), the read only flag
+        of a view doesn't protect it because the storage is written directly.
+    """
+
+    def __init__(self, capacity, columns):
+        self.capacity = capacity
+        self.columns = columns
+        self.timestamps = np.empty(2 * capacity, dtype=np.int64) # ms
+        self.values = np.empty((2 * capacity, len(columns)), dtype=np.float64)
+        self.lo = 0
+        self.hi = 0
+
+    def __len__(self):
+        return self.hi - self.lo
+
+    def last_timestamp(self):
+        return int(self.timestamps[self.hi - 1]) if self.hi > self.lo else None
+
+    def append(self, arrays, replace_from=None):
+        """ Append ohlcvs sorted by timestamp, rows with timestamp >= `replace_from` (ms)
+            are replaced. Only the newest `capacity` rows are kept.
+        """
+        if replace_from is not None:
+            self.hi = self.lo + int(np.searchsorted(
+                self.timestamps[self.lo:self.hi], replace_from, side='left'))
+
+        n = len(arrays['timestamp'])
+        if n > self.capacity:
+            arrays = {f: arr[-self.capacity:] for f, arr in arrays.items()}
+            n = self.capacity
+
+        if self.hi + n > len(self.timestamps):
+            self._compact(self.capacity - n)
+
+        self.timestamps[self.hi:self.hi+n] = arrays['timestamp']
+        for i, col in enumerate(self.columns):
+            self.values[self.hi:self.hi+n, i] = arrays[col]
+        self.hi += n
+
+        self.lo = max(self.lo, self.hi - self.capacity)
+
+    def evict(self, before_ms):
+        """ Drop rows with timestamp < `before_ms` (ms). """
+        self.lo += int(np.searchsorted(self.timestamps[self.lo:self.hi], before_ms, side='left'))
+
+    def _compact(self, keep):
+        """ Move the newest `keep` rows to the start of new storage. """
+        lo = max(self.lo, self.hi - keep)
+        timestamps = np.empty_like(self.timestamps)
+        values = np.empty_like(self.values)
+
+        timestamps[:self.hi - lo] = self.timestamps[lo:self.hi]
+        values[:self.hi - lo] = self.values[lo:self.hi]
+
+        self.timestamps = timestamps
+        self.values = values
+        self.hi -= lo
+        self.lo = 0
+
+    def view(self):
+        """ DataFrame of rows in the window sharing storage with the buffer, rows can't be
+            written through it but its last row changes if it's replaced by `append`.
+        """
+        values = self.values[self.lo:self.hi]
+        values.flags.writeable = False
+
+        index = pd.DatetimeIndex(
+            self.timestamps[self.lo:self.hi].astype('datetime64[ms]').astype('datetime64[ns]'),
+            name='timestamp')
+        return pd.DataFrame(values, index=index, columns=self.columns, copy=False)
@@ -9,7 +9,7 @@ import logging
 
 from analysis.hist_data import \
     fetch_ohlcv, \
-    build_ohlcv, \
+    build_ohlcv_incremental, \
     fetch_trades
 
 from db import Datastore
@@ -19,7 +19,6 @@ from utils import \
     roundup_dt, \
     rounddown_dt, \
     ex_name, \
-    tf_td, \
     rsym, \
     ms_dt, \
     MIN_DT, \
@@ -178,10 +177,6 @@ class EXBase():
     async def _start_ohlcv_stream(self, build_ohlcv=False):
 
         async def fetch_ohlcv_to_mongo(symbol, start, end, timeframe):
-            ops = []
-
-            collname = f"{self.exname}_ohlcv_{rsym(symbol)}_{timeframe}"
-            coll = self.mongo.get_collection(self._config['database']['dbname_exchange'], collname)
             res = fetch_ohlcv(self.ex, symbol, start, end, timeframe, log=self.log)
 
             async for ohlcv in res:
@@ -191,24 +186,8 @@ class EXBase():
                 if len(ohlcv) is 0:
                     break
 
-                # [ MTS, OPEN, CLOSE, HIGH, LOW, VOLUME ]
-                for oh in ohlcv:
-                    tmp = {
-                        'timestamp': oh[0],
-                        'open':      oh[1],
-                        'high':      oh[2],
-                        'low':       oh[3],
-                        'close':     oh[4],
-                        'volume':    oh[5]
-                    }
-                    ops.append(
-                        ensure_future(
-                            coll.update_one(
-                                {'timestamp': tmp['timestamp']},
-                                {'$set': tmp},
-                                upsert=True)))
-
-                await execute_mongo_ops(ops)
+                await self.mongo.write_ohlcv(
+                    self.mongo.ohlcv_rows_to_arrays(ohlcv), self.exname, symbol, timeframe)
 
         def all_recently_updated(last_update, interval):
             for _, dt in last_update.items():
@@ -546,19 +525,10 @@ class EXBase():
 
     async def update_ohlcv_start_end(self):
         # Get available ohlcv start / end datetime in db
-        self.ohlcv_start_end = {}
-
-        for market in self.markets:
-            tf = '1m'
-
-            self.ohlcv_start_end[market] = {}
-            self.ohlcv_start_end[market][tf] = {}
-
-            start = await self.mongo.get_ohlcv_start(self.exname, market, tf, exception=False)
-            end = await self.mongo.get_ohlcv_end(self.exname, market, tf, exception=False)
+        tf = '1m'
+        start_end = await self.mongo.get_ohlcvs_start_end(self.exname, self.markets, tf)
 
-            self.ohlcv_start_end[market][tf]['start'] = start
-            self.ohlcv_start_end[market][tf]['end'] = end
+        self.ohlcv_start_end = {market: {tf: start_end[market]} for market in self.markets}
 
     ###############################
     # CUSTOM FUNCTIONS FOR TRADER #
@@ -628,15 +598,8 @@ class EXBase():
     async def build_recent_ohlcvs(self):
         src_tf = '1m'
         tfs = self._config['analysis']['exchanges'][self.exname]['timeframes_all']
+        tfs = [tf for tf in tfs if tf != src_tf]
 
-        # Build ohlcvs from 1m
+        # Build ohlcvs from 1m since the last build
         for market in self.markets:
-            for tf in tfs:
-                if tf != src_tf:
-                    src_end_dt = await self.mongo.get_ohlcv_end(self.exname, market, src_tf)
-                    target_end_dt = await self.mongo.get_ohlcv_end(self.exname, market, tf, exception=False)
-                    target_start_dt = target_end_dt - tf_td(tf) * 5
-
-                    # Build ohlcv starting from 5 bars earlier from latest bar
-                    await build_ohlcv(self.mongo, self.exname, market, src_tf, tf,
-                                    start=target_start_dt, end=src_end_dt)
\ No newline at end of file
+            await build_ohlcv_incremental(self.mongo, self.exname, market, src_tf, tfs)
\ No newline at end of file
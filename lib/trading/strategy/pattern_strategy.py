@@ -317,7 +317,9 @@ class Signals():
                             print(xx)
                             print(yy)
 
-            prev_ohlcvs = ohlcvs
+            # Last rows of ohlcv windows are replaced by the next refresh (see OHLCVWindow)
+            prev_ohlcvs = {market: {tf: ohlcv.copy() for tf, ohlcv in tfs.items()}
+                           for market, tfs in ohlcvs.items()}
             prev_signals = self.signals
             await asyncio.sleep(4 * 60)
 
@@ -7,10 +7,8 @@ import asyncio
 import copy
 import concurrent
 import logging
-import math
 import numpy as np
 import pandas as pd
-import random
 
 from api import APIServer
 from api.notifier import Messenger
@@ -31,7 +29,8 @@ from utils import \
     execute_mongo_ops, \
     async_catch_traceback, \
     is_price_valid, \
-    periodic_routine
+    periodic_routine, \
+    gen_scale_orders
 
 logger = logging.getLogger('pyct')
 
@@ -959,76 +958,12 @@ class SingleEXTrader():
                          max_order_count=20,
                          exact_amount=False):
         """ Scale one order to multiple orders with different prices. """
-        orders = []
-
         min_amount = self.ex.markets_info[symbol]['limits']['amount']['min']
-        order_count = min(int(math.sqrt(2 * amount / min_amount) - 1), max_order_count)
-        order_count = max(order_count, 1)
-        amount_diff_base = amount / ((order_count + 1) * order_count / 2)
-        cur_price = start_price
-        dec = 100000000
-
-        for i in range(order_count):
-            cur_amount = amount_diff_base * (i + 1)
-            cur_price *= random.randint(0.9999 * dec, 1.0001 * dec) / dec
-
-            if not exact_amount:
-                cur_amount *= random.randint(0.9999 * dec, 1.0001 * dec) / dec
-
-            orders.append({
-                "symbol": symbol,
-                "type": type,
-                "side": side,
-                "amount": cur_amount,
-                "price": cur_price,
-            })
-
-            if side == 'buy':
-                cur_price = cur_price - abs(end_price - start_price) / order_count
-            elif side == 'sell':
-                cur_price = cur_price + abs(end_price - start_price) / order_count
-
-        # Merge orders to make amount >= min_amount
-        idx = 0
-        n_orders = len(orders)
-        while idx < n_orders-1:
-            if orders[idx]['amount'] < min_amount:
-                cur_amount = orders[idx]['amount']
-                cur_price = orders[idx]['price']
-                merge_num = 1
-
-                i = idx + 1
-                while (cur_amount < min_amount) \
-                and (i < n_orders):
-                    cur_price += orders[i]['price']
-                    cur_amount += orders[i]['amount']
-                    merge_num += 1
-                    i += 1
-
-                orders[idx]['price'] = cur_price / merge_num
-                orders[idx]['amount'] = cur_amount
-
-                for _ in range(idx+1, i):
-                    del orders[idx+1]
-                    n_orders -= 1
-
-            idx += 1
-
-        # If last order's amount < min_amount,
-        # distribute its amount to other orders proportionally
-        idx = len(orders) - 1
-        if idx > 0 \
-        and orders[idx]['price'] * orders[idx]['amount'] < min_amount:
-            total_amount = 0
-            for i in range(len(orders)-1):
-                total_amount += orders[i]['amount']
-
-            for i in range(len(orders)-1):
-                orders[i]['amount'] += orders[idx]['amount'] / total_amount * orders[i]['amount']
-
-            del orders[idx]
-
-        return orders
+        return gen_scale_orders(symbol, type, side, amount, min_amount,
+                                start_price=start_price,
+                                end_price=end_price,
+                                max_order_count=max_order_count,
+                                exact_amount=exact_amount)
 
     def add_market(self, market):
         if market in self.ex.markets:
@@ -18,6 +18,7 @@ import numpy as np
 import os
 import pandas as pd
 import pipes
+import random
 import sys
 import subprocess
 import traceback
@@ -87,6 +88,11 @@ def dt_ms(dt):
     return calendar.timegm(dt.utctimetuple()) * 1000
 
 
+def ms_index(ms, name=None):
+    """ Convert an array of ms timestamps to DatetimeIndex, milliseconds are kept. """
+    return pd.DatetimeIndex(np.asarray(ms).astype('datetime64[ms]').astype('datetime64[ns]'), name=name)
+
+
 def ms_sec(ms):
     return int(float(ms)/1000)
 
@@ -541,69 +547,77 @@ def alert_sound(duration, words, n=1):
 
 def ohlcv_to_interval(ohlcv, src_tf, target_td):
     """ Convert ohlcv to higher interval (timeframe). """
-    src_td = tf_td(src_tf)
+    return ohlcv_to_intervals(ohlcv, src_tf, [target_td])[target_td]
 
-    if target_td < timedelta(hours=1):
-        tmax = 60 # timeframe is under 1 hour
-    elif target_td < timedelta(days=1):
-        tmax = 24 #  timeframe is under 1 day
 
-    if target_td < src_td:
-        raise ValueError(f"Target interval {target_td} < original interval {src_td}")
+def ohlcv_to_intervals(ohlcv, src_tf, target_tds):
+    """ Convert ohlcv to multiple higher intervals (timeframes),
+        source columns are read once and every interval is grouped with numpy.
+        Intervals under 1 hour restart at every hour and intervals under 1 day
+        restart at every day, eg. 5h bars start at 0, 5, 10, 15 and 20 o'clock.
+        Returns {target_td: DataFrame}
+    """
+    src_td = tf_td(src_tf)
 
-    if (target_td % src_td).seconds != 0:
-        raise ValueError(f"Target interval {target_td} is not a multiple of original interval {src_td}")
+    for target_td in target_tds:
+        if target_td < src_td:
+            raise ValueError(f"Target interval {target_td} < original interval {src_td}")
 
-    if target_td == src_td:
-        return ohlcv
+        if (target_td % src_td).seconds != 0:
+            raise ValueError(f"Target interval {target_td} is not a multiple of original interval {src_td}")
 
-    def gen_target_dt_index(ohlcv, target_td):
-        start = ohlcv.index[0]
-        end = ohlcv.index[-1]
-        std = timedelta(hours=start.hour, minutes=start.minute, seconds=start.second)
-        etd = timedelta(hours=end.hour, minutes=end.minute, seconds=end.second)
+    if len(ohlcv) == 0:
+        return {target_td: ohlcv.copy() for target_td in target_tds}
 
-        start = start - (std % target_td)
-        end = end - (etd % target_td)
-        cur = start
+    ts = ohlcv.index.values.astype('datetime64[ns]').view(np.int64)
+    o = ohlcv['open'].values
+    h = ohlcv['high'].values
+    l = ohlcv['low'].values
+    c = ohlcv['close'].values
+    v = np.nan_to_num(ohlcv['volume'].values.astype(float)) # NaN volume counts as 0 like sum()
 
-        index = []
-        while cur <= end:
-            index.append(cur)
-            prev = cur
-            cur += target_td
+    target_ohlcvs = {}
 
-            if tmax == 60 and (prev.minute + target_td.seconds/60) > tmax:
-                cur -= timedelta(minutes=cur.minute)
-            elif tmax == 24 and (prev.hour + target_td.seconds/60/60) > tmax:
-                cur -= timedelta(hours=cur.hour)
+    for target_td in target_tds:
+        if target_td == src_td:
+            target_ohlcvs[target_td] = ohlcv
+            continue
 
-        return index
+        labels = _interval_starts(ts, target_td)
 
-    target_index = gen_target_dt_index(ohlcv, target_td)
-    target_ohlcv = pd.DataFrame(columns=ohlcv.columns, index=target_index, dtype=float)
-    target_ohlcv.index.name = ohlcv.index.name
+        # Bars of an interval are consecutive because ohlcv is sorted by timestamp
+        starts = np.flatnonzero(np.concatenate([[True], labels[1:] != labels[:-1]]))
+        ends = np.append(starts[1:], len(ts)) - 1
 
-    for start in target_ohlcv.index:
-        end = start + target_td
+        target_ohlcv = pd.DataFrame({
+            'open': o[starts],
+            'high': np.fmax.reduceat(h, starts),
+            'low': np.fmin.reduceat(l, starts),
+            'close': c[ends],
+            'volume': np.add.reduceat(v, starts),
+        }, index=pd.DatetimeIndex(labels[starts].view('datetime64[ns]'), name=ohlcv.index.name),
+            columns=ohlcv.columns, dtype=float)
 
-        if tmax == 60 and (start.minute + target_td.seconds/60) > tmax:
-            end -= timedelta(minutes=end.minute)
-        elif tmax == 24 and (start.hour + target_td.seconds/60/60) > tmax:
-            end -= timedelta(hours=end.hour)
+        target_ohlcvs[target_td] = target_ohlcv.dropna()
 
-        end -= timedelta(seconds=1)
+    return target_ohlcvs
 
-        if len(ohlcv[start:end]) > 0:
-            target_ohlcv.loc[start].open    = ohlcv[start:end].open[0]
-            target_ohlcv.loc[start].close   = ohlcv[start:end].close[-1]
-            target_ohlcv.loc[start].high    = ohlcv[start:end].high.max()
-            target_ohlcv.loc[start].low     = ohlcv[start:end].low.min()
-            target_ohlcv.loc[start].volume  = ohlcv[start:end].volume.sum()
 
-    target_ohlcv = target_ohlcv.dropna()
+def _interval_starts(ts, target_td):
+    """ Start (ns) of the interval every timestamp (ns) is in. """
+    td = int(target_td.total_seconds()) * 10**9
 
-    return target_ohlcv
+    if target_td < timedelta(hours=1):
+        period = 3600 * 10**9
+    elif target_td < timedelta(days=1):
+        period = 86400 * 10**9
+    else:
+        # Intervals of days start from the first day
+        origin = ts[0] - ts[0] % (86400 * 10**9)
+        return origin + (ts - origin) // td * td
+
+    period_starts = ts - ts % period
+    return period_starts + (ts - period_starts) // td * td
 
 
 def print_to_file(data, path):
@@ -808,6 +822,90 @@ def is_price_valid(start_price, end_price, side):
     return not invalid
 
 
+def gen_scale_orders(symbol, type, side, amount, min_amount,
+                     start_price=0,
+                     end_price=0,
+                     max_order_count=20,
+                     exact_amount=False,
+                     rng=None):
+    """ Scale one order to multiple orders with different prices.
+        Param
+            min_amount: float, minimal amount of an order
+            rng: random.Random instance for price and amount jitter (optional),
+                 pass a seeded one to generate same orders in backtests
+    """
+    rng = rng or random
+    orders = []
+
+    order_count = min(int(math.sqrt(2 * amount / min_amount) - 1), max_order_count)
+    order_count = max(order_count, 1)
+    amount_diff_base = amount / ((order_count + 1) * order_count / 2)
+    cur_price = start_price
+    dec = 100000000
+
+    for i in range(order_count):
+        cur_amount = amount_diff_base * (i + 1)
+        cur_price *= rng.randint(int(0.9999 * dec), int(1.0001 * dec)) / dec
+
+        if not exact_amount:
+            cur_amount *= rng.randint(int(0.9999 * dec), int(1.0001 * dec)) / dec
+
+        orders.append({
+            "symbol": symbol,
+            "type": type,
+            "side": side,
+            "amount": cur_amount,
+            "price": cur_price,
+        })
+
+        if side == 'buy':
+            cur_price = cur_price - abs(end_price - start_price) / order_count
+        elif side == 'sell':
+            cur_price = cur_price + abs(end_price - start_price) / order_count
+
+    # Merge orders to make amount >= min_amount
+    idx = 0
+    n_orders = len(orders)
+    while idx < n_orders-1:
+        if orders[idx]['amount'] < min_amount:
+            cur_amount = orders[idx]['amount']
+            cur_price = orders[idx]['price']
+            merge_num = 1
+
+            i = idx + 1
+            while (cur_amount < min_amount) \
+            and (i < n_orders):
+                cur_price += orders[i]['price']
+                cur_amount += orders[i]['amount']
+                merge_num += 1
+                i += 1
+
+            orders[idx]['price'] = cur_price / merge_num
+            orders[idx]['amount'] = cur_amount
+
+            for _ in range(idx+1, i):
+                del orders[idx+1]
+                n_orders -= 1
+
+        idx += 1
+
+    # If last order's amount < min_amount,
+    # distribute its amount to other orders proportionally
+    idx = len(orders) - 1
+    if idx > 0 \
+    and orders[idx]['price'] * orders[idx]['amount'] < min_amount:
+        total_amount = 0
+        for i in range(len(orders)-1):
+            total_amount += orders[i]['amount']
+
+        for i in range(len(orders)-1):
+            orders[i]['amount'] += orders[idx]['amount'] / total_amount * orders[i]['amount']
+
+        del orders[idx]
+
+    return orders
+
+
 def periodic_routine(fn, interval, *args, **kwargs):
     """ Convert a function into a endless while loop
         that is executed every `interval` seconds.
@@ -5,8 +5,8 @@ import logging
 import os
 
 from db import EXMongo
-from analysis.hist_data import build_ohlcv
-from utils import tf_td, config, load_keys, rsym
+from analysis.hist_data import build_ohlcv, build_ohlcv_incremental
+from utils import config, load_keys, rsym
 
 logger = logging.getLogger('pyct')
 
@@ -15,7 +15,9 @@ def parse_args():
     import argparse
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('--from-start', action='store_true', help="Build ohlcvs from first data of source ohlcv")
+    parser.add_argument('--from-start', action='store_true',
+        help="Drop built ohlcvs and rebuild them from first data of source ohlcv, "
+             "otherwise only bars since the last build are rebuilt")
     argv = parser.parse_args()
 
     return argv
@@ -32,30 +34,25 @@ async def main():
     target_tfs = config['analysis']['exchanges'][exchange]['timeframes_all']
     symbols = config['analysis']['exchanges'][exchange]['markets_all']
 
-    for symbol in symbols:
-        for target_tf in target_tfs:
+    target_tfs = [tf for tf in target_tfs if tf != src_tf]
 
-            if argv.from_start:
-                # Drop the collection
+    for symbol in symbols:
+        if argv.from_start:
+            # Drop the collections
+            for target_tf in target_tfs:
                 coll = f"{coll_prefix}{exchange}_ohlcv_{rsym(symbol)}_{target_tf}"
                 coll = mongo.get_collection(config['database']['dbname_exchange'], coll)
                 await coll.drop()
+            await mongo.clear_build_watermarks(exchange, symbol)
+
+            # All timeframes are built from one read of source ohlcv
+            logger.info(f"Building {exchange} {symbol} {target_tfs} ohlcv from start")
+            await build_ohlcv(mongo, exchange, symbol, src_tf, target_tfs,
+                              upsert=True, coll_prefix=coll_prefix)
 
-                await build_ohlcv(mongo, exchange, symbol, src_tf, target_tf,
-                                  upsert=True, coll_prefix=coll_prefix)
-                logger.info(f"Building {exchange} {symbol} {target_tf} ohlcv from start")
-
-            else:
-                src_end_dt = await mongo.get_ohlcv_end(exchange, symbol, src_tf)
-                target_end_dt = await mongo.get_ohlcv_end(exchange, symbol, target_tf)
-                target_start_dt = target_end_dt - tf_td(target_tf) * 5
-                logger.info(f"Building {exchange} {symbol} {target_tf} ohlcv "
-                            f"from {target_start_dt} to {src_end_dt}")
-
-                # Build ohlcv starting from 5 bars earlier from latest bar
-                await build_ohlcv(mongo, exchange, symbol, src_tf, target_tf,
-                                  start=target_start_dt, end=src_end_dt,
-                                  upsert=True, coll_prefix=coll_prefix)
+        else:
+            logger.info(f"Building {exchange} {symbol} {target_tfs} ohlcv since last build")
+            await build_ohlcv_incremental(mongo, exchange, symbol, src_tf, target_tfs)
 
     # Build indexes
     if argv.from_start:
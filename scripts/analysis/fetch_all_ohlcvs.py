@@ -1,71 +1,53 @@
 from setup import run
 
 
-from asyncio import ensure_future
 from datetime import datetime, timedelta
 
 import logging
-import pymongo
 
 from db import EXMongo
-from analysis.hist_data import fetch_ohlcv
+from analysis.hist_data import fetch_ohlcv, find_ohlcv_gaps
 from utils import \
     init_ccxt_exchange, \
-    execute_mongo_ops, \
     config, \
+    ex_name, \
+    ms_dt, \
+    tf_td, \
     utc_now
 
 logger = logging.getLogger('pyct')
 
 
-async def fetch_ohlcv_to_mongo(coll, exchange, symbol, timeframe, start, end, upsert=True):
+async def fetch_ohlcv_to_mongo(mongo, exchange, symbol, timeframe, start, end, upsert=True):
 
     res = fetch_ohlcv(exchange, symbol, start, end, timeframe)
-    bulk_ops = []
 
     async for ohlcv in res:
-        ops = []
-
         if len(ohlcv) is 0:
             break
 
-        # [ MTS, OPEN, CLOSE, HIGH, LOW, VOLUME ]
-        for oh in ohlcv:
-            rec = {
-                'timestamp': oh[0],
-                'open':      oh[1],
-                'high':      oh[2],
-                'low':       oh[3],
-                'close':     oh[4],
-                'volume':    oh[5]
-            }
-
-            if upsert:
-                ops.append(
-                    pymongo.UpdateOne(
-                        {'timestamp': rec['timestamp']},
-                        {'$set': rec},
-                        upsert=True))
-            else:
-                ops.append(rec)
-
-        if upsert:
-            # Divide ops into 3 threads
-            div = int(len(ops) / 3)
-            bulk_ops = [
-                coll.bulk_write(ops[:div]),
-                coll.bulk_write(ops[div:div*2]),
-                coll.bulk_write(ops[div*2:]),
-            ]
-            await execute_mongo_ops(bulk_ops)
-        else:
-            bulk_ops.append(ensure_future(coll.insert_many(ops)))
-            if len(bulk_ops) > 10:
-                await execute_mongo_ops(bulk_ops)
-                ops = []
-
-    if not upsert:
-        await execute_mongo_ops(bulk_ops)
+        await mongo.write_ohlcv(mongo.ohlcv_rows_to_arrays(ohlcv), exchange, symbol, timeframe,
+                                upsert=upsert)
+
+
+async def repair_ohlcv_gaps(mongo, exchange, symbol, timeframe, upsert=True):
+    """ Refetch only ranges of missing ohlcv between the first and the last ohlcv,
+        gaps the exchange has no ohlcv for stay saved in `{ex}_gaps`.
+    """
+    ex = ex_name(exchange)
+    start = await mongo.get_ohlcv_start(ex, symbol, timeframe)
+    end = await mongo.get_ohlcv_end(ex, symbol, timeframe) + tf_td(timeframe)
+
+    gaps = await find_ohlcv_gaps(mongo, ex, symbol, timeframe, start, end)
+    logger.info(f"Found {len(gaps)} gaps of {symbol} {timeframe}")
+
+    for gap_start, gap_end in gaps:
+        await fetch_ohlcv_to_mongo(mongo, exchange, symbol, timeframe,
+                                   ms_dt(gap_start), ms_dt(gap_end), upsert=upsert)
+
+    if len(gaps) > 0:
+        gaps = await find_ohlcv_gaps(mongo, ex, symbol, timeframe, start, end)
+        logger.info(f"{len(gaps)} gaps of {symbol} {timeframe} remain after refetching")
 
 
 def parse_args():
@@ -73,8 +55,11 @@ def parse_args():
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--no-upsert', dest='upsert', action='store_false',
-        help="Disable upsert while inserting data, can reduce insertion time and cpu usage, "
-             "only use this option if no ohlcv in database")
+        help="Insert ohlcv without checking existing ones, ranges without ohlcv in database "
+             "are always inserted instead of upserted")
+    parser.add_argument('--repair-gaps', action='store_true',
+        help="Refetch only missing ohlcv between the first and the last ohlcv in database "
+             "instead of fetching new ones")
     argv = parser.parse_args()
 
     return argv
@@ -85,9 +70,7 @@ async def main():
 
     mongo = EXMongo()
 
-    db = config['database']['dbname_exchange']
     ex = 'bitfinex'
-    coll_tamplate = '{}_ohlcv_{}_{}'
 
     exchange = init_ccxt_exchange(ex)
 
@@ -101,12 +84,14 @@ async def main():
         ohlcv_pairs = ohlcv_pairs[::-1]  # reverse the order
 
         for symbol, timeframe in ohlcv_pairs:
-            _symbol = ''.join(symbol.split('/'))  # remove '/'
-            coll = mongo.get_collection(db, coll_tamplate.format(ex, _symbol, timeframe))
+            if argv.repair_gaps:
+                await repair_ohlcv_gaps(mongo, exchange, symbol, timeframe, upsert=argv.upsert)
+                continue
+
             start = await mongo.get_ohlcv_end(ex, symbol, timeframe) - timedelta(hours=5)
             end = utc_now()
 
-            await fetch_ohlcv_to_mongo(coll, exchange, symbol, timeframe, start, end, upsert=argv.upsert)
+            await fetch_ohlcv_to_mongo(mongo, exchange, symbol, timeframe, start, end, upsert=argv.upsert)
 
             logger.info(f"Finished fetching {symbol} {timeframe}")
 
@@ -12,7 +12,7 @@ import numpy as np
 import pandas as pd
 import sys
 
-from analysis.backtest import ParamOptimizer
+from analysis.backtest import ParamOptimizer, ParamGrid
 from analysis.strategy import PatternStrategy
 from db import EXMongo
 from utils import \
@@ -60,40 +60,22 @@ async def generate_params(mongo, ex, argv):
     optimizer.optimize_range('stochrsi_rsi_upper', 80, 85, 5)
     optimizer.optimize_range('stochrsi_rsi_lower', 20, 25, 5)
 
-    combs = optimizer.count()
-    print(f"Generating {combs} parameter sets of {name}")
+    grid = optimizer.get_grid()
+    print(f"Generating {len(grid)} parameter sets of {name}")
 
     coll_meta = mongo.get_collection(mongo.config['dbname_analysis'], f'param_set_meta')
     coll = mongo.get_collection(mongo.config['dbname_analysis'], f'param_set_{name}')
 
-    # Update meta data
+    # Only axes of the grid are stored, param sets are decoded from index on demand
     res = await coll_meta.remove({'name': name})
     await coll_meta.insert_one({
         'name': name,
-        'columns': list(optimizer.param_d.keys()),
+        **grid.to_meta(),
         'datetime': rounddown_dt(utc_now(), timedelta(minutes=1)),
-        'count': 0,
     })
 
-    # Drop old params collection
+    # Drop params collection generated by older versions
     res = await coll.drop()
-    await coll.create_index([('idx', pymongo.ASCENDING)], unique=True)
-
-    # Generate params
-    buffer = []
-    for i, params in enumerate(optimizer.get_combinations()):
-        buffer.append({
-            'idx': i+1,
-            'params': params
-        })
-
-        if len(buffer) >= 10000:
-            await coll.insert_many(buffer)
-            buffer = []
-
-    # Update total count in meta data
-    count = await coll.count()
-    await coll_meta.update({'name': name}, {'$set': {'count': count}})
 
 
 async def optimize_params(mongo, ex, argv):
@@ -101,18 +83,12 @@ async def optimize_params(mongo, ex, argv):
     markets = argv.symbols and [m.strip() for m in argv.symbols.split(',')]
 
     coll_meta = mongo.get_collection(mongo.config['dbname_analysis'], f'param_set_meta')
-    coll = mongo.get_collection(mongo.config['dbname_analysis'], f'param_set_{name}')
+    meta = await coll_meta.find_one({'name': name})
 
-    if not await mongo.coll_exist(coll):
+    if not meta:
         raise ValueError(f"Parameter set `{name}` does not exist.")
 
-    columns = (await coll_meta.find_one({'name': name}))['columns']
-    combs = await coll.find({}, {'_id': False}).sort([('idx', 1)]).to_list(length=INF)
-
-    idxs = np.array([c['idx'] for c in combs])
-    params = np.array([c['params'] for c in combs])
-
-    combs = pd.DataFrame(data=params, index=idxs, columns=columns)
+    grid = ParamGrid.from_meta(meta)
 
     markets = markets or config['analysis']['exchanges'][ex]['markets_all']
     tftd = tf_td(config['analysis']['indicator_tf'])
@@ -130,7 +106,10 @@ async def optimize_params(mongo, ex, argv):
         strategy = PatternStrategy(ex)
         optimizer = ParamOptimizer(mongo, strategy)
 
-        await optimizer.run(combs, period, ex, market, name=name)
+        if argv.walk_forward:
+            await optimizer.run_walk_forward(grid, period, ex, market, name=name)
+        else:
+            await optimizer.run(grid, period, ex, market, name=name)
 
         end_time = datetime.now()
         logger.info(f"{market} optimization took {end_time-start_time}")
@@ -151,6 +130,8 @@ def parse_args():
 
     # Options for optimize
     parser.add_argument('--symbols', type=str, help="Symbols to optimize, eg. --symbols='BTC/USD, ETH/USD'")
+    parser.add_argument('--walk-forward', action='store_true',
+        help="Use rolling in-sample/out-of-sample windows and reuse results of previous runs")
 
     argv = parser.parse_args()
 
@@ -7,13 +7,14 @@ import argparse
 import copy
 import pickle
 
-from analysis.backtest import Backtest, BacktestRunner, get_data_feed
+from analysis.backtest import Backtest, BacktestRunner, TickBacktest, get_data_feed
+from analysis.robustness import RobustnessAnalyzer
 from analysis.strategy import PatternStrategy
 from db import EXMongo
 from utils import config, print_to_file
 
 
-async def test_single_period(mongo, market, plot, log_signal):
+async def test_single_period(mongo, market, plot, log_signal, robustness=False):
 
     # dt = (datetime(2017, 8, 1), datetime(2018, 3, 5))
     dt = (datetime(2018, 3, 15), datetime(2019, 1, 1))
@@ -62,6 +63,9 @@ async def test_single_period(mongo, market, plot, log_signal):
     print(market, ':', round(report['PL(%)'], 2), '%')
     print('\n-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=\n')
 
+    if robustness:
+        print(RobustnessAnalyzer.from_backtest(backtest).percentiles())
+
     print_to_file(backtest.margin_PLs, '../../log/backtest/margin_pl.log')
     print_to_file(backtest.trader.wallet_history, '../../log/backtest/wallet_history.log')
     print_to_file(backtest.trader.order_history[ex], '../../log/backtest/order_history.log')
@@ -75,45 +79,128 @@ async def test_single_period(mongo, market, plot, log_signal):
     return report
 
 
-async def test_special_periods_of_markets(mongo, plot, log_signal):
+MARKETS = [
+    "BTC/USD",
+    "BCH/USD",
+    "ETH/USD",
+    "XRP/USD",
+
+    "EOS/USD",
+    "LTC/USD",
+    "NEO/USD",
+    "OMG/USD",
 
-    markets = [
-        "BTC/USD",
-        "BCH/USD",
-        "ETH/USD",
-        "XRP/USD",
+    "ETC/USD",
+    "DASH/USD",
+    "IOTA/USD",
+    "XMR/USD",
+    "ZEC/USD",
 
-        "EOS/USD",
-        "LTC/USD",
-        "NEO/USD",
-        "OMG/USD",
+    "BTG/USD",
+    "EDO/USD",
+    "ETP/USD",
+    "SAN/USD",
+]
 
-        "ETC/USD",
-        "DASH/USD",
-        "IOTA/USD",
-        "XMR/USD",
-        "ZEC/USD",
 
-        "BTG/USD",
-        "EDO/USD",
-        "ETP/USD",
-        "SAN/USD",
-    ]
+async def test_special_periods_of_markets(mongo, plot, log_signal, robustness=False):
 
+    markets = MARKETS
     total_pl = 0
 
     for market in markets:
-        report = await test_single_period(mongo, market, plot, log_signal)
+        report = await test_single_period(mongo, market, plot, log_signal, robustness)
         total_pl += report['PL(%)']
 
     print(f"Total PL(%): {total_pl/len(markets):.2f} %")
 
 
+async def test_portfolio(mongo, plot, log_signal):
+    """ Run all markets in one backtest over a shared wallet. """
+    dt = (datetime(2018, 3, 15), datetime(2019, 1, 1))
+    ex = 'bitfinex'
+
+    _config = copy.deepcopy(config)
+    _config['analysis']['exchanges'][ex]['markets'] = MARKETS
+    _config['analysis']['log_signal'] = log_signal
+    _config['backtest']['fast_mode'] = True
+    _config['backtest']['portfolio']['enable'] = True
+
+    strategy = PatternStrategy(ex, custom_config=_config)
+    strategy.set_params(await mongo.get_params(ex))
+
+    start = dt[0]
+    end = dt[1]
+
+    data = await get_data_feed(mongo, _config, start, end)
+
+    backtest = Backtest(strategy,
+                        data_feed=data,
+                        start=start,
+                        end=end,
+                        enable_plot=plot,
+                        custom_config=_config)
+
+    report = backtest.run()
+
+    print('-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=\n')
+    for market, mrep in report['markets'].items():
+        print(f"{market:<10}: {mrep['PL(%)']:8.2f} % "
+              f"(#P {mrep['#_profit_trades']}, #L {mrep['#_loss_trades']})")
+    print(f"\nTotal PL(%): {report['PL(%)']:.2f} %")
+    print('\n-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=\n')
+
+    print_to_file(backtest.trader.order_history[ex], '../../log/backtest/order_history.log')
+
+    return report
+
+
+async def test_tick_replay(mongo, market, log_signal):
+    """ Replay every trade of a market and compare fills with ohlcv model. """
+    dt = (datetime(2018, 3, 15), datetime(2018, 6, 15))
+    ex = 'bitfinex'
+
+    _config = copy.deepcopy(config)
+    _config['analysis']['exchanges'][ex]['markets'] = [market]
+    _config['analysis']['log_signal'] = log_signal
+    _config['backtest']['fast_mode'] = False
+
+    strategy = PatternStrategy(ex, custom_config=_config)
+    strategy.set_params(await mongo.get_params(ex))
+
+    start = dt[0]
+    end = dt[1]
+
+    data = await get_data_feed(mongo, _config, start, end)
+
+    backtest = TickBacktest(strategy,
+                            data_feed=data,
+                            start=start,
+                            end=end,
+                            mongo=mongo,
+                            custom_config=_config)
+
+    report = await backtest.run()
+
+    print('-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=\n')
+    print(market, ':', round(report['PL(%)'], 2), '%')
+    pprint(report['slippage'])
+    print('\n-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=\n')
+
+    return report
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
 
     parser.add_argument('--plot', action='store_true', help="Plot backtest results")
     parser.add_argument('--log-signal', action='store_true', help="Print strategy signal")
+    parser.add_argument('--portfolio', action='store_true',
+        help="Run all markets in one backtest over a shared wallet")
+    parser.add_argument('--tick-replay', type=str, metavar='MARKET',
+        help="Replay every trade of a market and report fill slippage")
+    parser.add_argument('--robustness', action='store_true',
+        help="Print percentiles of PL and drawdown over resampled trade sequences")
 
     argv = parser.parse_args()
 
@@ -125,7 +212,12 @@ async def main():
 
     mongo = EXMongo(ssl=config['database']['ssl'])
 
-    await test_special_periods_of_markets(mongo, argv.plot, argv.log_signal)
+    if argv.portfolio:
+        await test_portfolio(mongo, argv.plot, argv.log_signal)
+    elif argv.tick_replay:
+        await test_tick_replay(mongo, argv.tick_replay, argv.log_signal)
+    else:
+        await test_special_periods_of_markets(mongo, argv.plot, argv.log_signal, argv.robustness)
 
 
 if __name__ == '__main__':
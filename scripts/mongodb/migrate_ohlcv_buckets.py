@@ -0,0 +1,90 @@
+from setup import run
+
+import argparse
+import logging
+import time
+
+from db import EXMongo
+from utils import config
+
+logger = logging.getLogger('pyct')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--collections', nargs='*', default=[],
+        help="Ohlcv collections to convert, default is all ohlcv collections")
+    argv = parser.parse_args()
+
+    return argv
+
+
+async def coll_stats(db, collname):
+    stats = await db.command('collStats', collname)
+    return {
+        '#docs': stats['count'],
+        'size(MB)': round(stats['size'] / 1024 / 1024, 2),
+        'index_size(MB)': round(stats['totalIndexSize'] / 1024 / 1024, 2),
+    }
+
+
+async def read_latency(mongo, collname, days=30):
+    """ Seconds to read the last `days` of ohlcv of a collection. """
+    last = (await mongo.get_collection(mongo.config['dbname_exchange'], collname)
+        .find({}).sort([('timestamp', -1)]).limit(1).to_list(length=1))[0]
+    last = last['t'][-1] if mongo.ohlcv_buckets else last['timestamp']
+
+    s = time.time()
+    await mongo._read_ohlcv_arrays(collname, last - days * 24 * 60 * 60 * 1000)
+    return round(time.time() - s, 3)
+
+
+async def migrate(mongo, collname):
+    """ Convert a collection of one ohlcv per doc to one day bucket per doc,
+        buckets are written to a new collection which then replaces the old one.
+    """
+    db = mongo.get_database(mongo.config['dbname_exchange'])
+    tmp_collname = f"{collname}_buckets"
+    tmp_coll = mongo.get_collection(db.name, tmp_collname)
+
+    mongo.ohlcv_buckets = False
+    before = await coll_stats(db, collname)
+    before['read_30d(s)'] = await read_latency(mongo, collname)
+    arrays = await mongo._read_ohlcv_arrays(collname)
+
+    await tmp_coll.drop()
+    await mongo._write_ohlcv_buckets(tmp_coll, arrays, upsert=False)
+    await tmp_coll.create_index('timestamp', unique=True)
+    await tmp_coll.rename(collname, dropTarget=True)
+
+    mongo.ohlcv_buckets = True
+    after = await coll_stats(db, collname)
+    after['read_30d(s)'] = await read_latency(mongo, collname)
+
+    logger.info(f"{collname}: {before} -> {after}")
+
+
+async def main():
+    argv = parse_args()
+    mongo = EXMongo()
+
+    db = mongo.get_database(config['database']['dbname_exchange'])
+    collnames = argv.collections or [
+        name for name in sorted(await db.list_collection_names()) if '_ohlcv_' in name]
+
+    # Stop ohlcv streams and builders first, they write one ohlcv per doc
+    # until `ohlcv_buckets` is enabled
+    for collname in collnames:
+        doc = await db[collname].find_one({}, {'_id': 0})
+
+        if doc is None or 't' in doc:
+            logger.info(f"Skip {collname}, it's empty or already converted")
+            continue
+
+        await migrate(mongo, collname)
+
+    logger.info("Enable `database.ohlcv_buckets` in config to read/write converted collections")
+
+
+if __name__ == '__main__':
+    run(main)
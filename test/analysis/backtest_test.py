@@ -1,12 +1,46 @@
 from setup import run
 
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from pprint import pprint
 
-from analysis.backtest import Backtest, BacktestRunner, ParamOptimizer
+import copy
+
+from analysis.backtest import Backtest, BacktestRunner, ParamOptimizer, TickBacktest, get_data_feed
 from analysis.strategy import SingleExchangeStrategy, PatternStrategy
 from db import EXMongo
+from utils import config
+
+
+async def _run_backtest(mongo, start, end, options, strategy_cls=PatternStrategy, before_run=None):
+    """ Run a backtest of `strategy_cls` with config['backtest'] updated by `options`,
+        `before_run(backtest)` is called right before the backtest runs.
+        Returns (backtest, report)
+    """
+    _config = copy.deepcopy(config)
+    for k, v in options.items():
+        if isinstance(v, dict):
+            _config['backtest'][k].update(v)
+        else:
+            _config['backtest'][k] = v
+
+    strategy = strategy_cls('bitfinex', custom_config=_config)
+    strategy.set_params({'common': _config['analysis']['params']['common']})
+
+    data_feed = await get_data_feed(mongo, _config, start, end)
+    backtest = Backtest(strategy, data_feed, start, end, custom_config=_config)
+
+    if before_run:
+        before_run(backtest)
+
+    return backtest, backtest.run()
+
+
+class StopPatternStrategy(PatternStrategy):
+    """ PatternStrategy with stop loss and stop profit (trailing stop) enabled. """
+
+    def execute_signal_at(self, dt, ss, market, stop_loss=False, stop_profit=False):
+        super().execute_signal_at(dt, ss, market, stop_loss=True, stop_profit=True)
 
 
 async def test_run(backtest):
@@ -73,13 +107,244 @@ async def test_backtest_runner_run_period_with_shift_step(mongo):
     pprint(summary)
 
 
+async def test_backtest_portfolio(mongo):
+    start, end = datetime(2018, 1, 1), datetime(2018, 3, 1)
+    _config = copy.deepcopy(config)
+    _config['analysis']['exchanges']['bitfinex']['markets'] = ['BTC/USD', 'ETH/USD', 'XRP/USD']
+    _config['backtest']['fast_mode'] = True
+    _config['backtest']['portfolio']['enable'] = True
+    _config['backtest']['portfolio']['max_fund'] = 5000
+
+    strategy = PatternStrategy('bitfinex', custom_config=_config)
+    strategy.set_params({'common': _config['analysis']['params']['common']})
+
+    data_feed = await get_data_feed(mongo, _config, start, end)
+    backtest = Backtest(strategy, data_feed, start, end, custom_config=_config)
+    report = backtest.run()
+    pprint(report['markets'])
+
+    total_pl = sum(mrep['PL'] for mrep in report['markets'].values())
+    assert abs(total_pl - sum(backtest.margin_PLs)) < 1e-6
+
+
+async def test_backtest_intrabar(mongo):
+    start, end = datetime(2018, 1, 1), datetime(2018, 3, 1)
+    backtest, report = await _run_backtest(
+        mongo, start, end, {'fast_mode': True, 'margin': True, 'intrabar': True},
+        strategy_cls=StopPatternStrategy)
+
+    pprint(report)
+
+    # Stops found in 1m bars close positions at the 1m bar touching the stop price,
+    # not at an indicator_tf bar
+    tf = config['analysis']['indicator_tf']
+    ohlcvs = backtest.ohlcvs['bitfinex']
+    stops = [order for order in backtest.trader.order_history['bitfinex'].values()
+             if order['margin'] and not order['canceled'] and order['close_time'] < end
+             and order['close_time'] not in ohlcvs[order['market']][tf].index]
+    assert len(stops) > 0
+
+    for order in stops:
+        bar = ohlcvs[order['market']]['1m'].loc[order['close_time']]
+        assert order['open_time'] < order['close_time']
+
+        if order['side'] == 'buy':
+            assert bar.low <= order['close_price']
+        else:
+            assert bar.high >= order['close_price']
+
+
+async def test_backtest_scale_order(mongo):
+    start, end = datetime(2018, 1, 1), datetime(2018, 3, 1)
+    ladders = [] # (order, market price, fill)
+
+    def spy_scale_order(backtest):
+        trader = backtest.trader
+        op_scale_order = trader.op_scale_order
+
+        def scale_order(order, now):
+            fill = op_scale_order(order, now)
+            # Orders are copied because op_ fields are removed from order history after a run
+            ladders.append((copy.deepcopy(order), trader.cur_price(order['ex'], order['market'], now),
+                            copy.deepcopy(fill)))
+            return fill
+
+        trader.op_scale_order = scale_order
+
+    reports = []
+    for _ in range(2):
+        ladders.clear()
+        _, report = await _run_backtest(
+            mongo, start, end, {'fast_mode': True, 'scale_order': {'enable': True}},
+            before_run=spy_scale_order)
+        reports.append(report)
+
+    pprint(reports[0])
+
+    # Ladders are generated with seeded jitter
+    assert reports[0]['PL(%)'] == reports[1]['PL(%)']
+
+    # Some ladders are only partly filled, filled rungs are below (buy) or above (sell)
+    # the market price
+    filled = [(order, price, fill[1]) for order, price, fill in ladders if fill is not None]
+    assert len(filled) > 0
+    assert any(fill['amount'] < order['amount'] * (1 - 1e-9) for order, _, fill in filled)
+
+    for order, price, fill in filled:
+        assert fill['amount'] <= order['amount'] * (1 + 1e-9)
+
+        if order['side'] == 'buy':
+            assert fill['op_fill_price'] < price
+        else:
+            assert fill['op_fill_price'] > price
+
+
+async def test_tick_backtest(mongo):
+    start, end = datetime(2018, 1, 1), datetime(2018, 1, 20)
+    _config = copy.deepcopy(config)
+    _config['analysis']['exchanges']['bitfinex']['markets'] = ['BTC/USD']
+    _config['backtest']['fast_mode'] = False
+
+    strategy = PatternStrategy('bitfinex', custom_config=_config)
+    strategy.set_params({'common': _config['analysis']['params']['common']})
+
+    data_feed = await get_data_feed(mongo, _config, start, end)
+    backtest = TickBacktest(strategy, data_feed, start, end, mongo, custom_config=_config)
+    report = await backtest.run()
+    pprint(report['slippage'])
+
+    # Every margin position is opened and closed by a fill
+    n_trades = report['#_profit_trades'] + report['#_loss_trades']
+    assert report['slippage']['#_fills'] == n_trades * 2
+
+
+async def test_slow_run_skip_idle_ticks(mongo):
+    start, end = datetime(2018, 1, 1), datetime(2018, 2, 1)
+    reports = []
+    n_ticks = []
+
+    def count_ticks(backtest):
+        tick = backtest.trader.tick
+        n_ticks.append(0)
+
+        def counted_tick():
+            n_ticks[-1] += 1
+            return tick()
+
+        backtest.trader.tick = counted_tick
+
+    for skip in [False, True]:
+        _, report = await _run_backtest(
+            mongo, start, end, {'fast_mode': False, 'skip_idle_ticks': skip},
+            before_run=count_ticks)
+        reports.append(report)
+
+    pprint(reports[1])
+    print(f"{n_ticks[1]} of {n_ticks[0]} ticks are executed")
+
+    # Skipping idle ticks runs fewer ticks with the same result
+    assert n_ticks[1] < n_ticks[0]
+    assert reports[0]['PL(%)'] == reports[1]['PL(%)']
+    assert reports[0]['#_profit_trades'] == reports[1]['#_profit_trades']
+
+
+async def test_backtest_profile(mongo):
+    start, end = datetime(2018, 1, 1), datetime(2018, 3, 1)
+    _config = copy.deepcopy(config)
+    _config['backtest']['profile']['enable'] = True
+    _config['backtest']['profile']['memory'] = True
+
+    strategy = PatternStrategy('bitfinex', custom_config=_config)
+    strategy.set_params({'common': _config['analysis']['params']['common']})
+
+    data_feed = await get_data_feed(mongo, _config, start, end)
+    backtest = Backtest(strategy, data_feed, start, end, custom_config=_config)
+    report = backtest.run()
+
+    pprint(report['profile'])
+    assert report['profile']['fast_run']['#_calls'] == 1
+    assert 'strategy.fast_run' in report['profile']
+    assert 'analyze_orders' in report['profile']
+
+
 async def test_param_optimizer(mongo):
     period = (datetime(2017, 8, 1), datetime(2018, 3, 5))
     strategy = PatternStrategy('bitfinex')
     optimizer = ParamOptimizer(mongo, strategy)
 
     optimizer.optimize_range('trade_portion', 0.1, 0.2, 0.1)
-    await optimizer.run(period)
+    await optimizer.run(optimizer.get_grid(), period, 'bitfinex', 'BTC/USD', name='test')
+
+
+async def test_param_optimizer_walk_forward(mongo):
+    period = (datetime(2018, 1, 1), datetime(2018, 6, 1))
+    strategy = PatternStrategy('bitfinex')
+    optimizer = ParamOptimizer(mongo, strategy)
+
+    optimizer.optimize_range('stochrsi_upper', 60, 80, 10)
+    optimizer.optimize_range('stochrsi_lower', 20, 40, 10)
+    grid = optimizer.get_grid()
+
+    wf = config['analysis']['walk_forward']
+    db = mongo.config['dbname_analysis']
+    await mongo.get_collection(db, 'param_optimization_wf_test').drop()
+
+    # Count backtests of param sets, one call per segment,
+    # then one for top-K re-evaluation and one for out-of-sample check
+    calls = []
+    backtest_params = optimizer._backtest_params
+
+    def count_backtest_params(*args, **kwargs):
+        calls.append(args[1])
+        return backtest_params(*args, **kwargs)
+
+    optimizer._backtest_params = count_backtest_params
+
+    await optimizer.run_walk_forward(grid, period, 'bitfinex', 'BTC/USD', name='test')
+    assert len(calls) == wf['in_sample_days'] // wf['step_days'] + 2
+
+    # Window slides by one step, only the new segment is backtested
+    calls.clear()
+    period = (period[0], period[1] + timedelta(days=wf['step_days']))
+    await optimizer.run_walk_forward(grid, period, 'bitfinex', 'BTC/USD', name='test')
+    assert len(calls) == 1 + 2
+    assert len(calls[0]) == len(grid)
+
+    # Best param set of the window is a member of the grid
+    coll = mongo.get_collection(db, 'param_optimization_test')
+    summary = (await coll.find({'name': 'test', 'ex': 'bitfinex', 'symbol': 'BTC/USD'})
+                         .sort([('end', -1)]).limit(1).to_list(length=1))[0]
+    param = grid.decode(summary['param_idx'])
+    for col, axis in zip(grid.columns, grid.axes):
+        assert param[col] in axis
+
+
+async def test_param_optimizer_pruning(mongo):
+    period = (datetime(2018, 1, 1), datetime(2018, 4, 1))
+    _config = copy.deepcopy(config)
+    _config['backtest']['pruning']['enable'] = True
+    _config['backtest']['pruning']['top_k'] = 3
+
+    strategy = PatternStrategy('bitfinex', custom_config=_config)
+    optimizer = ParamOptimizer(mongo, strategy, custom_config=_config)
+
+    optimizer.optimize_range('stochrsi_upper', 60, 80, 5)
+    optimizer.optimize_range('stochrsi_lower', 20, 40, 5)
+    grid = optimizer.get_grid()
+
+    await optimizer.run(grid, period, 'bitfinex', 'BTC/USD', name='test_pruning')
+
+    store = optimizer.get_result_store('test_pruning', 'bitfinex', 'BTC/USD', period)
+    recs = store.load()
+    print(f"{recs['pruned'].sum()} of {len(recs)} runs are pruned")
+
+    top = store.top_k(3)
+    pprint(top)
+
+    # Every param set has a result, pruned ones are never ranked
+    assert recs['param_idx'].tolist() == list(range(1, len(grid) + 1))
+    assert recs['pruned'].sum() > 0
+    assert not top['pruned'].any()
 
 
 async def main():
@@ -97,7 +362,23 @@ async def main():
     # print('------------------------------')
     # await test_backtest_runner_run_period_with_shift_step(mongo)
     # print('------------------------------')
+    # await test_backtest_portfolio(mongo)
+    # print('------------------------------')
+    # await test_backtest_intrabar(mongo)
+    # print('------------------------------')
+    # await test_backtest_scale_order(mongo)
+    # print('------------------------------')
+    # await test_tick_backtest(mongo)
+    # print('------------------------------')
+    # await test_slow_run_skip_idle_ticks(mongo)
+    # print('------------------------------')
+    # await test_backtest_profile(mongo)
+    # print('------------------------------')
     # await test_param_optimizer(mongo)
+    # print('------------------------------')
+    # await test_param_optimizer_walk_forward(mongo)
+    # print('------------------------------')
+    # await test_param_optimizer_pruning(mongo)
 
 if __name__ == '__main__':
     run(main)
@@ -5,9 +5,15 @@ from copy import deepcopy
 from datetime import datetime
 from pprint import pprint
 import logging
+import numpy as np
+import pandas as pd
 
 from analysis.backtest import Backtest
-from analysis.backtest_trader import SimulatedTrader
+from analysis.backtest_trader import \
+    SimulatedTrader, \
+    IntrabarIndex, \
+    ladder_fills, \
+    trailing_stop_hits
 from db import EXMongo
 from utils import \
     Timer, \
@@ -50,6 +56,23 @@ async def test_feed_ohlcv_trades(trader, mongo):
     pprint(trader.trades['bitfinex'])
 
 
+async def test_feed_ohlcv_window(trader, mongo):
+    ohlcvs = {}
+    ohlcvs[ex_name(exchange)] = await mongo.get_ohlcvs_of_symbols(exchange, symbols, timeframes, start, end)
+
+    # Incremental feed should be the same as slicing by label
+    cur_time = trader.timer.now()
+    while cur_time < datetime(2017, 4, 1, 12):
+        cur_time = trader.timer.now()
+        next_time = trader.timer.next()
+        trader.feed_data(start, next_time, ohlcvs)
+
+        for sym in symbols:
+            for tf in timeframes:
+                ohlcv = ohlcvs[ex_name(exchange)][sym][tf]
+                assert trader.ohlcvs['bitfinex'][sym][tf].equals(ohlcv[start:next_time])
+
+
 async def test_normarl_order_execution(order_type, trader, mongo):
     ohlcvs = {}
     ohlcvs[ex_name(exchange)] = await mongo.get_ohlcvs_of_symbols(exchange, symbols, timeframes, start, end)
@@ -152,6 +175,115 @@ async def test_margin_order_execution(order_type, trader, mongo):
     pprint(trader.order_records)
 
 
+async def test_position_stop_triggers(trader, mongo):
+    ohlcvs = {}
+    ohlcvs[ex_name(exchange)] = await mongo.get_ohlcvs_of_symbols(exchange, symbols, timeframes, start, end)
+
+    ex = 'bitfinex'
+    buy_time = datetime(2017, 4, 1, 7, 33)
+    stop_loss = 0.005
+    order = None
+
+    cur_time = trader.timer.now()
+    while cur_time < end:
+        cur_time = trader.timer.now()
+        next_time = trader.timer.next()
+        trader.feed_data(start, next_time, ohlcvs)
+        trader.tick()
+
+        if order is None and cur_time >= buy_time:
+            price = trader.cur_price(ex, MARKET)
+            amount = trader.wallet[ex]['USD'] * 0.9 / price
+            order = trader.generate_order(ex, MARKET, 'buy', 'limit', amount, price,
+                                          margin=True, stop_loss=stop_loss)
+            order = trader.open(order)
+
+    # Position is closed at stop price once a bar's low crosses it
+    ohlcv = ohlcvs[ex][MARKET][trader.trigger_tfs[ex]]
+    position = trader.order_history[ex].get(order['#'])
+
+    if position is not None and position.get('close_reason') == 'stop_loss':
+        stop_price = position['open_price'] * (1 - stop_loss)
+        assert position['close_price'] == stop_price
+        assert ohlcv[position['open_time']:position['close_time']].low.min() <= stop_price
+    else:
+        assert trader.is_position_open(order)
+        assert ohlcv[order['open_time']:end].low.min() > order['open_price'] * (1 - stop_loss)
+
+    pprint(trader.order_records)
+
+
+def _intrabar_index():
+    """ 1h parent bars 00:00-02:00 of 2018-01-01 with 1m bars of 00:00 and 02:00 only. """
+    sub_times = pd.date_range('2018-01-01 00:00', periods=60, freq='1min').append(
+                pd.date_range('2018-01-01 02:00', periods=60, freq='1min'))
+    sub = pd.DataFrame({'high': 101.0, 'low': 100.0}, index=sub_times)
+    sub.iloc[10] = [104, 103]
+    sub.iloc[37] = [101, 95]
+    sub.iloc[60 + 5] = [92, 90]
+
+    parent = pd.DataFrame({'high': [104.0, 106, 101], 'low': [95.0, 97, 90]},
+                          index=pd.date_range('2018-01-01', periods=3, freq='1h'))
+
+    return IntrabarIndex(sub, parent, '1h')
+
+
+def test_intrabar_first_touch():
+    index = _intrabar_index()
+    start, end = datetime(2018, 1, 1), datetime(2018, 1, 1, 2)
+
+    assert index.first_touch(95, True, start, end) == pd.Timestamp('2018-01-01 00:37')
+    assert index.first_touch(93, True, start, end) == pd.Timestamp('2018-01-01 02:05')
+    assert index.first_touch(95, True, datetime(2018, 1, 1, 1), None) == pd.Timestamp('2018-01-01 02:05')
+    assert index.first_touch(104, False, start, end) == pd.Timestamp('2018-01-01 00:10')
+    assert index.first_touch(110, False, start, end) is None
+
+    # Parent bar without 1m data is touched at its label
+    assert index.first_touch(105, False, start, end) == pd.Timestamp('2018-01-01 01:00')
+
+
+def test_intrabar_first_trailing_touch():
+    index = _intrabar_index()
+
+    # Long stop trails high 104 of 00:10 by 3 and is hit by low of the next 1m bar
+    assert index.first_trailing_touch(100, 3, True, datetime(2018, 1, 1), None) == \
+        (pd.Timestamp('2018-01-01 00:11'), 101)
+
+    # Short stop trails low 90 of 02:05 by 3, high of 02:05 doesn't reach it
+    assert index.first_trailing_touch(100, 3, False, datetime(2018, 1, 1, 2), None) == \
+        (pd.Timestamp('2018-01-01 02:06'), 93)
+
+    # Parent bar without 1m data is hit at its label and trailing level
+    assert index.first_trailing_touch(100, 3, True, datetime(2018, 1, 1, 1), None) == \
+        (pd.Timestamp('2018-01-01 01:00'), 103)
+
+    assert index.first_trailing_touch(100, 10, True, datetime(2018, 1, 1), None) is None
+
+
+def test_trailing_stop_hits():
+    position = {'open_price': 100, 'stop_profit': 0.02, 'side': 'buy', 'trail_price': 100}
+    levels, hit = trailing_stop_hits(position,
+                                     np.array([101., 104, 103, 105]),
+                                     np.array([99., 103, 101, 104]))
+    assert (levels == [99, 102, 102, 103]).all()
+    assert (hit == [False, False, True, False]).all()
+
+    position = {'open_price': 100, 'stop_profit': 0.02, 'side': 'sell', 'trail_price': 100}
+    levels, hit = trailing_stop_hits(position,
+                                     np.array([101., 97, 99, 96]),
+                                     np.array([99., 96, 97, 95]))
+    assert (levels == [101, 98, 98, 97]).all()
+    assert (hit == [False, False, True, False]).all()
+
+
+def test_ladder_fills():
+    lows = np.array([99., 97, 98, 94])
+    highs = np.array([101., 103, 102, 106])
+
+    assert (ladder_fills(lows, highs, 'buy', np.array([98., 96, 90])) == [1, 3, -1]).all()
+    assert (ladder_fills(lows, highs, 'sell', np.array([102., 105, 110])) == [1, 3, -1]).all()
+
+
 # TODO: Finish verify trader's trading algorithm
 # def verify_trading_algorithm():
 #     start = datetime(2017, 10, 10)
@@ -205,6 +337,11 @@ async def test_margin_order_execution(order_type, trader, mongo):
 
 
 async def main():
+    test_intrabar_first_touch()
+    test_intrabar_first_trailing_touch()
+    test_trailing_stop_hits()
+    test_ladder_fills()
+
     mongo = EXMongo()
     timer = Timer(start, timer_interval)
     trader = SimulatedTrader(timer)
@@ -213,6 +350,9 @@ async def main():
     await test_feed_ohlcv_trades(trader, mongo)
     print('------------------------------')
     trader.reset()
+    await test_feed_ohlcv_window(trader, mongo)
+    print('------------------------------')
+    trader.reset()
     await test_normarl_order_execution('limit', trader, mongo)
     print('------------------------------')
     trader.reset()
@@ -224,6 +364,9 @@ async def main():
     trader.reset()
     await test_margin_order_execution('market', trader, mongo)
     print('------------------------------')
+    trader.reset()
+    await test_position_stop_triggers(trader, mongo)
+    print('------------------------------')
 
 
 if __name__ == '__main__':
@@ -10,14 +10,19 @@ from analysis.hist_data import \
     fetch_my_trades, \
     find_missing_ohlcv, \
     fill_missing_ohlcv, \
-    build_ohlcv
+    find_ohlcv_gaps, \
+    build_ohlcv, \
+    build_ohlcv_incremental
 from db import EXMongo
 from utils import \
     ms_sec, \
     ms_dt, \
+    dt_ms, \
     config, \
     load_keys, \
-    init_ccxt_exchange
+    init_ccxt_exchange, \
+    ohlcv_to_interval, \
+    tf_td
 
 from trading.exchanges import Bitfinex
 
@@ -90,6 +95,26 @@ async def test_fill_ohlcv_missing_timestamp():
     print('#missing_ohlcv', len(missing_ohlcv))
 
 
+async def test_find_ohlcv_gaps():
+    mongo = EXMongo()
+    exchange = 'bitfinex'
+    symbol = 'BTC/USD'
+    tf = '8h'
+    coll = mongo.get_collection(config['database']['dbname_exchange'], f"bitfinex_ohlcv_BTCUSD_{tf}")
+
+    start = datetime(2017, 8, 1)
+    end = datetime(2018, 4, 6)
+
+    gaps = await find_ohlcv_gaps(mongo, exchange, symbol, tf, start, end)
+    td = dt_ms(start + tf_td(tf)) - dt_ms(start)
+    missing = [ts for gs, ge in gaps for ts in range(gs, ge, td)]
+    assert missing == await find_missing_ohlcv(coll, start, end, tf)
+
+    saved = await mongo.get_ohlcv_gaps(exchange, symbol, tf)
+    saved = saved[(saved[:, 0] >= dt_ms(start)) & (saved[:, 1] <= dt_ms(end))]
+    assert saved.tolist() == gaps.tolist()
+
+
 async def test_build_ohlcv():
     src_tf = '1m'
     target_tf = '3h'
@@ -101,6 +126,88 @@ async def test_build_ohlcv():
                       coll_prefix='test_')
 
 
+async def test_build_multiple_ohlcvs():
+    src_tf = '1m'
+    target_tfs = ['3h', '5h', '18h']
+    symbol = 'BTC/USD'
+    exchange = 'bitfinex'
+    start = datetime(2018, 1, 1)
+    end = datetime(2018, 2, 1)
+    mongo = EXMongo()
+
+    await build_ohlcv(mongo, exchange, symbol, src_tf, target_tfs,
+                      start=start, end=end, coll_prefix='test_')
+
+    src = await mongo.get_ohlcv(exchange, symbol, src_tf, start, end)
+    for tf in target_tfs:
+        built = await mongo.get_ohlcv(exchange, symbol, tf, start, end, coll_prefix='test_')
+        expected = ohlcv_to_interval(src, src_tf, tf_td(tf))
+        assert built.index.equals(expected.index)
+
+
+async def test_resample_ohlcv_in_mongo():
+    src_tf = '1m'
+    symbol = 'BTC/USD'
+    exchange = 'bitfinex'
+    start = datetime(2018, 1, 1, 3, 30)
+    end = datetime(2018, 2, 1)
+    mongo = EXMongo()
+
+    src = await mongo.get_ohlcv(exchange, symbol, src_tf, start, end)
+
+    for tf in ['15m', '1h', '5h', '18h', '3d']:
+        res = await mongo.resample_ohlcv(exchange, symbol, src_tf, tf, start, end)
+        expected = ohlcv_to_interval(src, src_tf, tf_td(tf))
+        assert res.index.equals(expected.index)
+        assert ((res - expected).abs() < 1e-6).all().all()
+
+
+async def test_build_ohlcv_incremental():
+    src_tf = '1m'
+    target_tfs = ['1h', '5h']
+    symbol = 'BTC/USD'
+    exchange = 'bitfinex'
+    start = datetime(2018, 1, 1)
+    end = datetime(2018, 1, 5)
+    mongo = EXMongo()
+    db = config['database']['dbname_exchange']
+
+    colls = [f"test_bitfinex_ohlcv_BTCUSD_{tf}" for tf in [src_tf] + target_tfs] \
+            + ['test_bitfinex_build_watermarks']
+    for coll in colls:
+        await mongo.get_collection(db, coll).drop()
+
+    # Source ohlcv arrive in two parts
+    src = await mongo.get_ohlcv(exchange, symbol, src_tf, start, end)
+    mid = datetime(2018, 1, 3, 12, 30)
+    await mongo.insert_ohlcv(src[:mid].copy(), exchange, symbol, src_tf, coll_prefix='test_')
+    await build_ohlcv_incremental(mongo, exchange, symbol, src_tf, target_tfs, coll_prefix='test_')
+    watermarks = await mongo.get_build_watermarks(exchange, symbol, target_tfs, coll_prefix='test_')
+
+    # Mark the first bar of every timeframe, which mustn't be rebuilt
+    for tf in target_tfs:
+        coll = mongo.get_collection(db, f"test_bitfinex_ohlcv_BTCUSD_{tf}")
+        await coll.update_one({'timestamp': dt_ms(start)}, {'$set': {'close': -1}})
+
+    await mongo.insert_ohlcv(src[mid:].copy(), exchange, symbol, src_tf, coll_prefix='test_')
+    await build_ohlcv_incremental(mongo, exchange, symbol, src_tf, target_tfs, coll_prefix='test_')
+    new_watermarks = await mongo.get_build_watermarks(exchange, symbol, target_tfs, coll_prefix='test_')
+
+    # Second build only rewrites bars from the first watermark
+    for tf in target_tfs:
+        built = await mongo.get_ohlcv(exchange, symbol, tf, start, end, coll_prefix='test_')
+        expected = ohlcv_to_interval(src, src_tf, tf_td(tf))
+        rebuilt = built.index >= watermarks[tf]
+
+        assert new_watermarks[tf] > watermarks[tf]
+        assert built.close.iloc[0] == -1
+        assert built.index.equals(expected.index)
+        assert ((built[rebuilt] - expected[rebuilt]).abs() < 1e-6).all().all()
+
+    for coll in colls:
+        await mongo.get_collection(db, coll).drop()
+
+
 async def main():
     print('-----------------------------')
     await test_fetch_ohlcv()
@@ -113,7 +220,15 @@ async def main():
     print('-----------------------------')
     await test_fill_ohlcv_missing_timestamp()
     print('-----------------------------')
+    await test_find_ohlcv_gaps()
+    print('-----------------------------')
     await test_build_ohlcv()
+    print('-----------------------------')
+    await test_build_multiple_ohlcvs()
+    print('-----------------------------')
+    await test_build_ohlcv_incremental()
+    print('-----------------------------')
+    await test_resample_ohlcv_in_mongo()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,76 @@
+from setup import run
+
+
+from datetime import datetime
+from pprint import pprint
+
+import copy
+import numpy as np
+import tempfile
+
+from analysis.backtest import ParamGrid
+from analysis.result_store import ResultStore
+from utils import config
+
+
+def gen_reports(grid, idxs):
+    reports = []
+    for idx, param in grid.iter_params(idxs):
+        reports.append([idx, {
+            'PL(%)': param['stochrsi_upper'] - param['stochrsi_lower'],
+            'PL_Eff': 0,
+            '#_profit_trades': 1,
+            '#_loss_trades': 1,
+            'max_drawdown(%)': 10,
+        }])
+    return reports
+
+
+def test_result_store():
+    _config = copy.deepcopy(config)
+    _config['analysis']['result_store_dir'] = tempfile.mkdtemp()
+
+    grid = ParamGrid([range(60, 85, 5), range(20, 50, 5)], ['stochrsi_upper', 'stochrsi_lower'])
+    period = (datetime(2018, 1, 1), datetime(2018, 3, 1))
+    store = ResultStore('test', 'bitfinex', 'BTC/USD', period, custom_config=_config)
+
+    store.append(gen_reports(grid, np.arange(1, 21)))
+    store.append(gen_reports(grid, np.arange(15, len(grid) + 1))) # resumed with overlap
+    assert len(store) == len(grid)
+
+    top = store.top_k(3)
+    pprint(top)
+    assert top['PL(%)'].iloc[0] == 80 - 20
+
+    best = store.best()
+    assert grid.decode(best['param_idx'])['stochrsi_upper'] == 80
+
+    effects = store.marginal_effect(grid)
+    pprint(effects['stochrsi_upper'])
+    assert (np.diff(effects['stochrsi_upper']['mean']) > 0).all()
+
+    hm = store.heatmap(grid, 'stochrsi_upper', 'stochrsi_lower')
+    pprint(hm)
+    assert hm.loc[20, 80] == 60
+
+    # A pruned run is left out of aggregations
+    reports = gen_reports(grid, [1])
+    reports[0][1].update({'PL(%)': -100, 'pruned': True})
+    store.append(reports)
+
+    effects = store.marginal_effect(grid)
+    assert effects['stochrsi_upper']['count'][60] == len(grid.axes[1]) - 1
+    assert effects['stochrsi_upper']['mean'][60] == np.mean([60 - l for l in range(25, 50, 5)])
+    assert store.marginal_effect(grid, include_pruned=True)['stochrsi_upper']['count'][60] == len(grid.axes[1])
+    assert store.heatmap(grid, 'stochrsi_upper', 'stochrsi_lower', agg='count').loc[20, 60] == 0
+
+    store.clear()
+    assert len(store) == 0
+
+
+def main():
+    test_result_store()
+
+
+if __name__ == '__main__':
+    run(main)
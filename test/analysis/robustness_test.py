@@ -0,0 +1,73 @@
+from setup import run
+
+
+from datetime import datetime, timedelta
+from pprint import pprint
+
+import copy
+import numpy as np
+import pandas as pd
+
+from analysis.robustness import RobustnessAnalyzer
+from utils import config
+
+
+def gen_orders(closes, n):
+    """ Positions opened and closed at random bars of `closes`. """
+    rng = np.random.RandomState(0)
+    orders = []
+
+    for _ in range(n):
+        open_pos = rng.randint(0, len(closes) - 100)
+        close_pos = open_pos + rng.randint(10, 100)
+        side = 'buy' if rng.rand() < 0.5 else 'sell'
+        sign = 1 if side == 'buy' else -1
+
+        orders.append({
+            'market': 'BTC/USD',
+            'side': side,
+            'margin': True,
+            'canceled': False,
+            'amount': 1,
+            'open_time': closes.index[open_pos],
+            'close_time': closes.index[close_pos],
+            'open_price': closes.iloc[open_pos],
+            'PL': (closes.iloc[close_pos] - closes.iloc[open_pos]) * sign,
+        })
+
+    return orders
+
+
+def test_robustness_analyzer():
+    _config = copy.deepcopy(config)
+    index = pd.date_range(datetime(2018, 1, 1), periods=10000, freq='1min')
+    closes = pd.Series(np.linspace(100, 200, len(index)), index=index)
+    ohlcv = pd.DataFrame({'close': closes})
+    orders = gen_orders(closes, 200)
+
+    # Without entry delay, every resample is a permutation-like draw of the same trades
+    _config['analysis']['robustness']['max_entry_delay'] = 0
+    analyzer = RobustnessAnalyzer(orders, 1000, custom_config=_config)
+    pl, drawdown = analyzer.resample(1000)
+    assert len(pl) == 1000
+    assert (drawdown >= 0).all()
+
+    # Price only rises, so a delayed entry makes longs worse and shorts better
+    _config['analysis']['robustness']['max_entry_delay'] = 5
+    analyzer = RobustnessAnalyzer(orders, 1000, {'BTC/USD': ohlcv}, custom_config=_config)
+    longs = np.array([order['side'] == 'buy' for order in sorted(orders, key=lambda o: o['close_time'])])
+    assert (np.diff(analyzer.returns[longs], axis=1) < 0).all()
+    assert (np.diff(analyzer.returns[~longs], axis=1) > 0).all()
+
+    res = analyzer.percentiles()
+    pprint(res)
+    assert res['PL(%)'].is_monotonic_increasing
+    assert analyzer.percentiles().equals(res) # seeded
+
+
+def main():
+    test_robustness_analyzer()
+
+
+if __name__ == '__main__':
+    run(main)
@@ -3,10 +3,12 @@ from setup import run
 
 from datetime import datetime
 
+import copy
 import motor.motor_asyncio as motor
 
 from analysis.hist_data import fill_missing_ohlcv
 from db import EXMongo, Datastore
+from ohlcv_cache import OHLCVCache
 from utils import init_ccxt_exchange, config
 
 from pprint import pprint as pp
@@ -102,6 +104,123 @@ def test_datastore_sync():
     assert dd.attr2 == [8, 8, 8]
 
 
+async def test_ohlcv_cache(mongo):
+    _config = copy.deepcopy(config)
+    _config['database']['ohlcv_cache']['enable'] = True
+    _config['database']['ohlcv_cache']['dir'] = '../data/test_ohlcv_cache'
+
+    # Clients of different processes, only cached_mongo reads from the cache
+    cached_mongo = EXMongo(custom_config=_config)
+    writer_mongo = EXMongo(custom_config=_config)
+    writer_mongo.ohlcv_cache = False
+
+    cache = OHLCVCache('bitfinex', 'BTC/USD', '1m', custom_config=_config, coll_prefix='test_')
+    cache.clear()
+
+    start = datetime(2018, 1, 1)
+    end = datetime(2018, 2, 1)
+    expected = await writer_mongo.get_ohlcv('bitfinex', 'BTC/USD', '1m', start, end)
+
+    coll = mongo.get_collection(config['database']['dbname_exchange'], 'test_bitfinex_ohlcv_BTCUSD_1m')
+    await coll.drop()
+    await writer_mongo.insert_ohlcv(expected.copy(), 'bitfinex', 'BTC/USD', '1m', coll_prefix='test_')
+
+    for _ in range(2): # sync from mongo, then read from cache
+        res = await cached_mongo.get_ohlcv('bitfinex', 'BTC/USD', '1m', start, end, coll_prefix='test_')
+        assert res.index.equals(expected.index)
+        assert (res[expected.columns].values == expected.values).all()
+
+    # A write of another client (process) makes cached ohlcv after the first written one stale
+    revised = expected[-10:].copy()
+    revised['close'] += 1
+    await writer_mongo.insert_ohlcv(revised, 'bitfinex', 'BTC/USD', '1m', coll_prefix='test_')
+
+    res = await cached_mongo.get_ohlcv('bitfinex', 'BTC/USD', '1m', start, end, coll_prefix='test_')
+    assert (res.close.values[-10:] == revised.close.values).all()
+    assert (res.close.values[:-10] == expected.close.values[:-10]).all()
+
+    await coll.drop()
+    cache.clear()
+
+
+async def test_ohlcv_buckets(mongo):
+    _config = copy.deepcopy(config)
+    _config['database']['ohlcv_buckets'] = True
+    bucket_mongo = EXMongo(custom_config=_config)
+
+    start = datetime(2018, 1, 1)
+    end = datetime(2018, 1, 10)
+    expected = await mongo.get_ohlcv('bitfinex', 'BTC/USD', '1m', start, end)
+
+    coll = bucket_mongo.get_collection(_config['database']['dbname_exchange'],
+                                       'test_bitfinex_ohlcv_BTCUSD_1m')
+    await coll.drop()
+
+    # Second write merges into existing buckets
+    await bucket_mongo.insert_ohlcv(expected[:5000].copy(), 'bitfinex', 'BTC/USD', '1m', coll_prefix='test_')
+    await bucket_mongo.insert_ohlcv(expected[4000:-1000].copy(), 'bitfinex', 'BTC/USD', '1m', coll_prefix='test_')
+
+    # Insert-only writes also merge into the existing bucket of the day
+    await bucket_mongo.insert_ohlcv(expected[-1000:].copy(), 'bitfinex', 'BTC/USD', '1m',
+                                    coll_prefix='test_', upsert=False)
+    assert await coll.count_documents({}) == 9
+
+    res = await bucket_mongo.get_ohlcv('bitfinex', 'BTC/USD', '1m',
+                                       datetime(2018, 1, 2, 12), end, coll_prefix='test_')
+    assert res.equals(expected[datetime(2018, 1, 2, 12):])
+    await coll.drop()
+
+
+async def test_get_ohlcvs_start_end(mongo):
+    symbols = ['BTC/USD', 'ETH/USD', 'XRP/USD']
+
+    # Second call reads only last ohlcv
+    for _ in range(2):
+        start_end = await mongo.get_ohlcvs_start_end('bitfinex', symbols, '1m')
+
+        for sym in symbols:
+            assert start_end[sym]['start'] == await mongo.get_ohlcv_start('bitfinex', sym, '1m')
+            assert start_end[sym]['end'] == await mongo.get_ohlcv_end('bitfinex', sym, '1m')
+
+
+async def test_get_ohlcvs_of_symbols_concurrently(mongo):
+    start = datetime(2018, 1, 1)
+    end = datetime(2018, 2, 1)
+    symbols = ['BTC/USD', 'ETH/USD']
+    timeframes = ['1m', '1h']
+
+    ohlcvs = await mongo.get_ohlcvs_of_symbols('bitfinex', symbols, timeframes, start, end)
+
+    for sym in symbols:
+        for tf in timeframes:
+            expected = await mongo.get_ohlcv('bitfinex', sym, tf, start, end)
+            assert ohlcvs[sym][tf].equals(expected)
+
+
+async def test_get_latest_ohlcvs(mongo):
+    symbols = ['BTC/USD', 'ETH/USD']
+    timeframes = ['1m', '1h']
+
+    # First call reads all `data_days` of ohlcvs, the second one only new ohlcvs
+    ohlcvs = await mongo.get_latest_ohlcvs('bitfinex', symbols, timeframes)
+    window = mongo.ohlcv_windows['bitfinex']
+    views = {sym: window.get(sym, '1m') for sym in symbols}
+    copies = {sym: view.copy() for sym, view in views.items()}
+
+    ohlcvs = await mongo.get_latest_ohlcvs('bitfinex', symbols, timeframes)
+
+    # Views handed out before a refresh only change in their last (in progress) row
+    for sym in symbols:
+        assert views[sym][:-1].equals(copies[sym][:-1])
+        assert views[sym].index.equals(copies[sym].index)
+
+    for sym in symbols:
+        ohlcv = window.get(sym, '1m')
+        expected = await mongo.get_ohlcv('bitfinex', sym, '1m', ohlcv.index[0], ohlcv.index[-1])
+        assert ohlcv[:-1].equals(expected[ohlcv.columns])
+        assert ohlcvs[sym]['1m'].index[-1] == ohlcv.index[-1]
+
+
 async def main():
     mongo = EXMongo()
 
@@ -114,6 +233,16 @@ async def main():
     print('------------------------------')
     await test_get_ohlcv_trade_start_end(mongo)
     print('------------------------------')
+    await test_ohlcv_cache(mongo)
+    print('------------------------------')
+    await test_ohlcv_buckets(mongo)
+    print('------------------------------')
+    await test_get_ohlcvs_start_end(mongo)
+    print('------------------------------')
+    await test_get_ohlcvs_of_symbols_concurrently(mongo)
+    print('------------------------------')
+    await test_get_latest_ohlcvs(mongo)
+    print('------------------------------')
     test_datastore()
     print('------------------------------')
     test_datastore_sync()
@@ -9,6 +9,8 @@ cmds = [
     ["python", "analysis/hist_data_test.py"],
     ["python", "analysis/backtest_trader_test.py"],
     ["python", "analysis/backtest_test.py"],
+    ["python", "analysis/result_store_test.py"],
+    ["python", "analysis/robustness_test.py"],
     ["python", "analysis/plot_test.py"],
     ["python", "analysis/strategy_test.py"]
 ]